@@ -0,0 +1,127 @@
+"""
+Compares connections/sec through links that forward their port with socat and with NAT rules.
+
+Every connection is opened, sends a small payload, waits for it to be echoed back and is
+closed, so the result is dominated by per-connection setup cost (a socat fork vs. a conntrack
+entry) rather than bandwidth.
+
+Setup:
+
+    # next to the client link, expose an echo server as the link's service (EXPOSE=tcp://host:7777)
+    python benchmarks/forward_port.py echo --port 7777
+
+    # on the gateway, bring up one link per mode
+    FRACTAL_GATEWAY_FORWARD_MODE=socat fractal link up <gateway> socat.example.com --tcp-forwarding
+    FRACTAL_GATEWAY_FORWARD_MODE=nat fractal link up <gateway> nat.example.com --tcp-forwarding
+
+    # from anywhere, point the benchmark at the forward ports of both links
+    python benchmarks/forward_port.py run socat=gateway.example.com:40001 nat=gateway.example.com:40002
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+PAYLOAD = b"fractal" * 8
+
+
+async def _echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while data := await reader.read(65536):
+            writer.write(data)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_echo(host: str, port: int) -> None:
+    server = await asyncio.start_server(_echo, host, port, backlog=4096)
+    print(f"Echoing on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+async def _connect_once(host: str, port: int, timeout: float) -> float:
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(PAYLOAD)
+        await writer.drain()
+        await asyncio.wait_for(reader.readexactly(len(PAYLOAD)), timeout)
+    finally:
+        writer.close()
+    return time.perf_counter() - start
+
+
+async def measure(
+    host: str, port: int, duration: float, concurrency: int, timeout: float
+) -> dict[str, float]:
+    """
+    Opens connections with `concurrency` workers for `duration` seconds.
+
+    Returns:
+    - Dict, with the connections/sec, the number of failed connections and latency percentiles.
+    """
+    latencies: list[float] = []
+    failures = 0
+    deadline = time.perf_counter() + duration
+
+    async def worker() -> None:
+        nonlocal failures
+        while time.perf_counter() < deadline:
+            try:
+                latencies.append(await _connect_once(host, port, timeout))
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "conn_per_sec": len(latencies) / elapsed,
+        "failures": failures,
+        "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+    }
+
+
+async def run(targets: list[str], duration: float, concurrency: int, timeout: float) -> None:
+    print(f"{'target':<16}{'conn/sec':>12}{'failures':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for target in targets:
+        name, _, address = target.rpartition("=")
+        host, port = address.rsplit(":", 1)
+        result = await measure(host, int(port), duration, concurrency, timeout)
+        print(
+            f"{name or address:<16}{result['conn_per_sec']:>12.1f}{result['failures']:>10}"
+            f"{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    echo = commands.add_parser("echo", help="run a TCP echo server to expose through the links")
+    echo.add_argument("--host", default="0.0.0.0")
+    echo.add_argument("--port", type=int, default=7777)
+
+    bench = commands.add_parser("run", help="measure connections/sec through each target")
+    bench.add_argument("targets", nargs="+", help="[name=]host:port")
+    bench.add_argument("--duration", type=float, default=10.0)
+    bench.add_argument("--concurrency", type=int, default=64)
+    bench.add_argument("--timeout", type=float, default=5.0)
+
+    args = parser.parse_args()
+    if args.command == "echo":
+        asyncio.run(serve_echo(args.host, args.port))
+    else:
+        asyncio.run(run(args.targets, args.duration, args.concurrency, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
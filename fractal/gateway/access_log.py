@@ -0,0 +1,295 @@
+"""
+Per-link traffic analytics from the gateway's structured access logs.
+
+nginx writes one JSON object per request (HTTP) or session (SNI passthrough) into
+`ACCESS_LOG_PATHS` with buffered writes (see `nginx.conf.template`). The ingestor reads the
+logs incrementally from where it left off, keeps request rates, status codes and upstream
+latency histograms per link, and rotates logs once they've been consumed.
+"""
+
+import json
+import logging
+import math
+import time
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+if TYPE_CHECKING:
+    from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+HTTP_ACCESS_LOG_PATH = "/var/log/nginx/links/access.json"
+STREAM_ACCESS_LOG_PATH = "/var/log/nginx/links/stream.json"
+ACCESS_LOG_PATHS = (HTTP_ACCESS_LOG_PATH, STREAM_ACCESS_LOG_PATH)
+
+# consumed logs are rotated once they grow past this size
+MAX_LOG_SIZE = 64 * 1024 * 1024
+
+STATS_FILENAME = "gateway-stats.yaml"
+
+# upper bounds (seconds) of the upstream latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+
+# minutes of per-minute request counts kept for rates
+RATE_WINDOW = 60
+
+
+def parse_upstream_time(value: Any) -> Optional[float]:
+    """
+    Parses nginx's upstream timings. Requests that were retried against several upstreams
+    report one comma separated time per upstream ("0.004, 0.010"), requests that never
+    reached an upstream report "-".
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    if not value:
+        return None
+
+    total = None
+    for part in str(value).replace(":", ",").split(","):
+        part = part.strip()
+        if part and part != "-":
+            total = (total or 0.0) + float(part)
+    return total
+
+
+@dataclass
+class LinkStats:
+    requests: int = 0
+    bytes_sent: int = 0
+    statuses: Counter = field(default_factory=Counter)
+    latency: list[int] = field(default_factory=lambda: [0] * len(LATENCY_BUCKETS))
+    # minute (unix time // 60) -> requests, for the last RATE_WINDOW minutes
+    minutes: dict[int, int] = field(default_factory=dict)
+
+    def record(self, entry: dict[str, Any]) -> None:
+        self.requests += 1
+        self.bytes_sent += int(entry.get("bytes_sent") or 0)
+        self.statuses[f"{str(entry.get('status', 0))[0]}xx"] += 1
+
+        # HTTP requests are timed until the upstream's response, SNI sessions until connected
+        if entry.get("kind") == "stream":
+            upstream_time = parse_upstream_time(entry.get("upstream_connect_time"))
+        else:
+            upstream_time = parse_upstream_time(entry.get("upstream_response_time"))
+        if upstream_time is not None:
+            self.latency[bisect_left(LATENCY_BUCKETS, upstream_time)] += 1
+
+        minute = int(float(entry.get("time") or time.time()) // 60)
+        self.minutes[minute] = self.minutes.get(minute, 0) + 1
+        if len(self.minutes) > RATE_WINDOW:
+            for old in sorted(self.minutes)[:-RATE_WINDOW]:
+                del self.minutes[old]
+
+    def rate(self, minutes: int = 1, now: Optional[float] = None) -> float:
+        """
+        Returns the requests per second over the last `minutes` complete minutes.
+        """
+        current = int((now or time.time()) // 60)
+        count = sum(self.minutes.get(current - i, 0) for i in range(1, minutes + 1))
+        return count / (minutes * 60)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """
+        Returns the upper bound (seconds) of the histogram bucket holding the q-th percentile.
+        """
+        total = sum(self.latency)
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency):
+            seen += count
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "bytes_sent": self.bytes_sent,
+            "statuses": dict(self.statuses),
+            "latency": list(self.latency),
+            "minutes": dict(self.minutes),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "LinkStats":
+        return cls(
+            requests=data["requests"],
+            bytes_sent=data["bytes_sent"],
+            statuses=Counter(data["statuses"]),
+            latency=list(data["latency"]),
+            minutes={int(minute): count for minute, count in data["minutes"].items()},
+        )
+
+
+@dataclass
+class LogPosition:
+    inode: int
+    offset: int
+
+
+class AccessLogIngestor:
+    """
+    Maintains per-link stats from the gateway's access logs.
+    """
+
+    def __init__(self):
+        self.links: dict[str, LinkStats] = {}
+        self.positions: dict[str, LogPosition] = {}
+        self._partial = b""
+
+    def feed(self, chunk: bytes) -> int:
+        """
+        Ingests the complete lines of `chunk`. An incomplete last line is kept until the
+        next chunk completes it.
+
+        Returns:
+        - int, the number of bytes of complete lines consumed (including previous partials).
+        """
+        data = self._partial + chunk
+        end = data.rfind(b"\n") + 1
+        self._partial = data[end:]
+
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                logger.warning("Skipping malformed access log line: %r" % line[:200])
+                continue
+            host = entry.get("host")
+            if not host:
+                continue
+            self.links.setdefault(host, LinkStats()).record(entry)
+
+        return end
+
+    def _read(self, container: "Container", path: str, offset: int) -> int:
+        """
+        Ingests `path` from `offset`. Returns the offset of the first byte not consumed.
+        """
+        self._partial = b""
+        result = container.exec_run(["tail", "-c", f"+{offset + 1}", path], stream=True)
+        for chunk in result.output:
+            offset += self.feed(chunk)
+        return offset
+
+    def ingest(self, container: "Container", paths: Iterable[str] = ACCESS_LOG_PATHS) -> None:
+        """
+        Reads what was logged since the last call from the gateway container.
+        """
+        for path in paths:
+            files = _stat_files(container, [path, f"{path}.1"])
+            current = files.get(path)
+            rotated = files.get(f"{path}.1")
+            position = self.positions.get(path)
+
+            offset = 0
+            if position and rotated and rotated[0] == position.inode:
+                # rotated since the last call, finish the previous file first
+                self._read(container, f"{path}.1", position.offset)
+            elif (
+                position
+                and current
+                and current[0] == position.inode
+                and current[1] >= position.offset
+            ):
+                offset = position.offset
+
+            if not current:
+                self.positions.pop(path, None)
+                continue
+
+            offset = self._read(container, path, offset)
+            self.positions[path] = LogPosition(inode=current[0], offset=offset)
+
+            if offset >= MAX_LOG_SIZE:
+                _rotate_log(container, path)
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "positions": {
+                path: {"inode": position.inode, "offset": position.offset}
+                for path, position in self.positions.items()
+            },
+            "links": {fqdn: stats.to_dict() for fqdn, stats in self.links.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "AccessLogIngestor":
+        ingestor = cls()
+        ingestor.positions = {
+            path: LogPosition(**position) for path, position in data.get("positions", {}).items()
+        }
+        ingestor.links = {
+            fqdn: LinkStats.from_dict(stats) for fqdn, stats in data.get("links", {}).items()
+        }
+        return ingestor
+
+    def summary(self, now: Optional[float] = None) -> list[dict[str, Any]]:
+        def ms(seconds: Optional[float]) -> str:
+            if seconds is None:
+                return "-"
+            if seconds == math.inf:
+                return f">{LATENCY_BUCKETS[-2] * 1000:.0f}"
+            return f"{seconds * 1000:.0f}"
+
+        return [
+            {
+                "fqdn": fqdn,
+                "requests": stats.requests,
+                "req/s (1m)": f"{stats.rate(1, now):.2f}",
+                "req/s (15m)": f"{stats.rate(15, now):.2f}",
+                "2xx": stats.statuses.get("2xx", 0),
+                "3xx": stats.statuses.get("3xx", 0),
+                "4xx": stats.statuses.get("4xx", 0),
+                "5xx": stats.statuses.get("5xx", 0),
+                "p50 ms": ms(stats.percentile(0.5)),
+                "p95 ms": ms(stats.percentile(0.95)),
+                "p99 ms": ms(stats.percentile(0.99)),
+            }
+            for fqdn, stats in sorted(self.links.items())
+        ]
+
+
+def _stat_files(container: "Container", paths: list[str]) -> dict[str, tuple[int, int]]:
+    """
+    Returns the inode and size of the paths that exist in the container.
+    """
+    result = container.exec_run(["stat", "-c", "%n %i %s", *paths], demux=True)
+    stdout, _ = result.output
+    files = {}
+    for line in (stdout or b"").decode().splitlines():
+        path, inode, size = line.rsplit(" ", 2)
+        files[path] = (int(inode), int(size))
+    return files
+
+
+def _rotate_log(container: "Container", path: str) -> None:
+    logger.info("Rotating access log %s" % path)
+    result = container.exec_run(["sh", "-c", 'mv "$1" "$1.1" && nginx -s reopen', "sh", path])
+    if result.exit_code != 0:
+        logger.warning("Failed to rotate access log %s: %s" % (path, result.output.decode()))
+
+
+def load_ingestor() -> AccessLogIngestor:
+    from fractal.cli.utils import read_user_data
+
+    try:
+        data, _ = read_user_data(STATS_FILENAME)
+    except FileNotFoundError:
+        return AccessLogIngestor()
+    return AccessLogIngestor.from_dict(data or {})
+
+
+def save_ingestor(ingestor: AccessLogIngestor) -> None:
+    from fractal.cli.utils import write_user_data
+
+    write_user_data(ingestor.to_dict(), STATS_FILENAME)
@@ -0,0 +1,349 @@
+"""
+Resident gateway agent.
+
+Commands that other devices run on a gateway over SSH (`fractal link up`, `fractal link
+create`, ...) each pay for a process start, Django setup and a database connection. The agent is a long-lived process (`fractal gateway agent`) that keeps
+Django, the database connections and the container inventory warm and runs those commands
+for the CLI over a Unix domain socket.
+
+Commands decorated with `served_by_agent` forward their invocation to the agent when its
+socket is available, before Django is set up, and replay the output and exit code the agent
+captured. Without an agent they run in-process as usual. An operation's output is
+buffered and sent as a single response, so commands with large outputs (`fractal gateway
+export`) always run in-process.
+
+The protocol is one JSON object per line in each direction:
+
+    {"operation": "link.up", "args": [...], "kwargs": {...}}
+    {"exit_code": 0, "stdout": "<base64>", "stderr": "<base64>"}
+
+`fractal gateway agent --stdio` speaks it over stdin/stdout, so a single SSH connection
+can carry any number of operations.
+"""
+
+import base64
+import functools
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Iterator, Optional
+
+from fractal.cli.utils import data_dir
+
+logger = logging.getLogger(__name__)
+
+AGENT_SOCKET_PATH = os.environ.get(
+    "FRACTAL_GATEWAY_AGENT_SOCKET", os.path.join(data_dir, "gateway-agent.sock")
+)
+# set to 0 to always run commands in-process
+AGENT_ENABLED = os.environ.get("FRACTAL_GATEWAY_AGENT", "1") != "0"
+CONNECT_TIMEOUT = 1.0
+PING = "agent.ping"
+
+# marks the threads that run operations inside of the agent
+_serving = threading.local()
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+class _CapturingStream(io.TextIOBase):
+    """
+    Stands in for sys.stdout/sys.stderr in the agent. Threads running an operation write to
+    their own buffer, every other thread writes to the original stream.
+    """
+
+    def __init__(self, stream: IO[str]):
+        self._stream = stream
+        self._local = threading.local()
+
+    @property
+    def _captured(self) -> Optional[io.BytesIO]:
+        return getattr(self._local, "captured", None)
+
+    def write(self, s: str) -> int:
+        captured = self._captured
+        if captured is None:
+            return self._stream.write(s)
+        captured.write(s.encode())
+        return len(s)
+
+    def flush(self) -> None:
+        if self._captured is None:
+            self._stream.flush()
+
+    def isatty(self) -> bool:
+        return self._captured is None and self._stream.isatty()
+
+    @property
+    def encoding(self) -> str:  # type: ignore
+        return "utf-8"
+
+    @property
+    def buffer(self) -> IO[bytes]:
+        return self._captured or self._stream.buffer  # type: ignore
+
+    @contextmanager
+    def capture(self) -> Iterator[io.BytesIO]:
+        self._local.captured = io.BytesIO()
+        try:
+            yield self._local.captured
+        finally:
+            self._local.captured = None
+
+
+def _install_capture() -> tuple[_CapturingStream, _CapturingStream]:
+    if not isinstance(sys.stdout, _CapturingStream):
+        sys.stdout = _CapturingStream(sys.stdout)  # type: ignore
+    if not isinstance(sys.stderr, _CapturingStream):
+        sys.stderr = _CapturingStream(sys.stderr)  # type: ignore
+    return sys.stdout, sys.stderr  # type: ignore
+
+
+def _close_db_connections() -> None:
+    # each request runs in its own thread, with its own database connections
+    try:
+        from django.conf import settings
+        from django.db import connections
+    except ImportError:
+        return
+    if settings.configured:
+        connections.close_all()
+
+
+def served_by_agent(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Decorator for controller methods the gateway agent can run. Must be applied on top of
+    `use_django` so that forwarded invocations don't set up Django.
+
+    Invocations that are forwarded to the agent return None.
+    """
+    operation = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if AGENT_ENABLED and not getattr(_serving, "active", False):
+            try:
+                response = call_agent(f"{self.PLUGIN_NAME}.{operation}", args, kwargs)
+            except AgentUnavailable:
+                pass
+            else:
+                return replay(response)
+        return func(self, *args, **kwargs)
+
+    # the agent has Django set up already and calls the method underneath `use_django`
+    wrapper.agent_operation = getattr(func, "__wrapped__", func)  # type: ignore
+    return wrapper
+
+
+def replay(response: dict[str, Any]) -> None:
+    """
+    Writes the output of an operation the agent ran and exits with its exit code.
+    """
+    sys.stdout.flush()
+    sys.stdout.buffer.write(base64.b64decode(response["stdout"]))
+    sys.stdout.buffer.flush()
+    sys.stderr.buffer.write(base64.b64decode(response["stderr"]))
+    sys.stderr.buffer.flush()
+    if response["exit_code"]:
+        sys.exit(response["exit_code"])
+
+
+def call_agent(
+    operation: str,
+    args: Any = (),
+    kwargs: Optional[dict[str, Any]] = None,
+    path: Optional[str] = None,
+) -> dict[str, Any]:
+    """
+    Runs an operation on the gateway agent.
+
+    Raises:
+    - AgentUnavailable: if no agent is listening on the socket.
+    """
+    path = path or AGENT_SOCKET_PATH
+    if not os.path.exists(path):
+        raise AgentUnavailable(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(path)
+    except OSError as err:
+        sock.close()
+        # stale socket of an agent that is gone
+        raise AgentUnavailable(f"{path}: {err}")
+
+    request = {"operation": operation, "args": list(args), "kwargs": kwargs or {}}
+    with sock:
+        # operations may take long (link up waits for containers), only connecting is bounded
+        sock.settimeout(None)
+        with sock.makefile("rwb") as stream:
+            stream.write(json.dumps(request, default=str).encode() + b"\n")
+            stream.flush()
+            line = stream.readline()
+
+    if not line:
+        raise AgentUnavailable(f"{path}: agent closed the connection")
+    return json.loads(line)
+
+
+def get_agent_operations() -> dict[str, tuple[type, Callable[..., Any]]]:
+    """
+    Returns the operations of the gateway and link controllers, by "<plugin>.<method>".
+    """
+    from fractal.gateway.controllers.gateway import FractalGatewayController
+    from fractal.gateway.controllers.link import FractalLinkController
+
+    return collect_operations(FractalGatewayController, FractalLinkController)
+
+
+def collect_operations(*controllers: type) -> dict[str, tuple[type, Callable[..., Any]]]:
+    operations = {}
+    for controller in controllers:
+        for name in dir(controller):
+            operation = getattr(getattr(controller, name), "agent_operation", None)
+            if operation:
+                operations[f"{controller.PLUGIN_NAME}.{name}"] = (controller, operation)
+    return operations
+
+
+class GatewayAgent:
+    """
+    Runs the operations of `served_by_agent` controller methods for the CLI.
+
+    Parameters:
+    - operations: Dict, "<plugin>.<method>" -> (controller class, method).
+    - extra_kwargs: Dict, keyword arguments passed to every operation (i.e. the project_name
+        that `use_django` would pass).
+    """
+
+    def __init__(
+        self,
+        operations: dict[str, tuple[type, Callable[..., Any]]],
+        extra_kwargs: Optional[dict[str, Any]] = None,
+    ):
+        self.operations = operations
+        self.extra_kwargs = extra_kwargs or {}
+        self.stdout, self.stderr = _install_capture()
+        self._server: Optional[socketserver.ThreadingUnixStreamServer] = None
+
+    def handle(self, request: dict[str, Any]) -> dict[str, Any]:
+        if request.get("operation") == PING:
+            return {"exit_code": 0, "stdout": "", "stderr": ""}
+
+        exit_code = 0
+        with self.stdout.capture() as stdout, self.stderr.capture() as stderr:
+            _serving.active = True
+            try:
+                if request.get("operation") not in self.operations:
+                    print(f"Unknown operation: {request.get('operation')}", file=sys.stderr)
+                    raise SystemExit(2)
+                controller, operation = self.operations[request["operation"]]
+                operation(
+                    controller(),
+                    *request.get("args", []),
+                    **{**request.get("kwargs", {}), **self.extra_kwargs},
+                )
+            except SystemExit as err:
+                if isinstance(err.code, str):
+                    print(err.code, file=sys.stderr)
+                    exit_code = 1
+                else:
+                    exit_code = err.code or 0
+            except Exception:
+                traceback.print_exc()
+                exit_code = 1
+            finally:
+                _serving.active = False
+
+        return {
+            "exit_code": exit_code,
+            "stdout": base64.b64encode(stdout.getvalue()).decode(),
+            "stderr": base64.b64encode(stderr.getvalue()).decode(),
+        }
+
+    def handle_stream(self, rfile: IO[bytes], wfile: IO[bytes]) -> None:
+        for line in rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.handle(json.loads(line))
+            except ValueError as err:
+                response = {
+                    "exit_code": 2,
+                    "stdout": "",
+                    "stderr": base64.b64encode(f"Invalid request: {err}\n".encode()).decode(),
+                }
+            wfile.write(json.dumps(response).encode() + b"\n")
+            wfile.flush()
+
+    def serve(self, path: Optional[str] = None) -> None:
+        """
+        Serves operations on a Unix domain socket until `shutdown` is called.
+        """
+        path = path or AGENT_SOCKET_PATH
+        agent = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    agent.handle_stream(self.rfile, self.wfile)
+                finally:
+                    _close_db_connections()
+
+        try:
+            call_agent(PING, path=path)
+        except AgentUnavailable:
+            if os.path.exists(path):
+                os.unlink(path)
+        else:
+            raise RuntimeError(f"A gateway agent is already listening on {path}")
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        os.chmod(path, 0o600)
+        logger.info("Gateway agent listening on %s" % path)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def shutdown(self) -> None:
+        if self._server:
+            self._server.shutdown()
+
+
+def bridge_stdio(path: Optional[str] = None) -> None:
+    """
+    Forwards requests read from stdin to the agent's socket and writes its responses to
+    stdout, for callers that reach the agent through an SSH connection.
+    """
+    path = path or AGENT_SOCKET_PATH
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+    stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+
+    def forward_responses():
+        while data := sock.recv(65536):
+            stdout.write(data)
+            stdout.flush()
+
+    responses = threading.Thread(target=forward_responses, daemon=True)
+    responses.start()
+    with sock:
+        while data := stdin.read1(65536):  # type: ignore
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+        responses.join()
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+
+from .inventory import GATEWAY_LINK_LABEL, ContainerRecord
+from .utils import LINK_FQDN_LABEL, get_link_container_name
+
+
+def _link_record(
+    fqdn: str,
+    name: Optional[str] = None,
+    state: str = "running",
+    health: Optional[str] = None,
+    forward_port: Optional[str] = None,
+) -> ContainerRecord:
+    name = name or get_link_container_name(fqdn)
+    return ContainerRecord(
+        id=name,
+        name=name,
+        labels={GATEWAY_LINK_LABEL: "true", LINK_FQDN_LABEL: fqdn},
+        ports={"5555/tcp": [{"HostIp": "", "HostPort": forward_port}]} if forward_port else {},
+        state=state,
+        health=health,
+        attrs={"Name": name},
+    )
+
+
+class FakeContainer:
+    def __init__(self, client: "FakeClient", attrs):
+        self.client = client
+        self.name = attrs["Name"]
+
+    def start(self):
+        self.client.calls.append(("start", self.name))
+
+    def restart(self):
+        self.client.calls.append(("restart", self.name))
+
+    def remove(self, force=False):
+        self.client.containers_by_name.pop(self.name, None)
+        self.client.calls.append(("remove", self.name))
+
+    def rename(self, name):
+        record = self.client.containers_by_name.pop(self.name)
+        record.name = name
+        self.client.containers_by_name[name] = record
+        self.client.calls.append(("rename", self.name, name))
+
+    def exec_run(self, cmd):
+        handshake = self.client.handshakes.get(self.name, "0")
+        return SimpleNamespace(exit_code=0, output=f"peerkey\t{handshake}\n".encode())
+
+
+class FakeClient:
+    """
+    The parts of a docker client that act on link containers, with the containers by name and
+    what was done to them.
+    """
+
+    def __init__(self, *records: ContainerRecord):
+        self.containers_by_name = {record.name: record for record in records}
+        self.handshakes: dict[str, str] = {}
+        self.calls: list = []
+        self.containers = SimpleNamespace(prepare_model=lambda attrs: FakeContainer(self, attrs))
+
+
+@pytest.fixture
+def link_record():
+    """
+    Builds the inventory record of a link container.
+    """
+    return _link_record
+
+
+@pytest.fixture
+def fake_client():
+    """
+    Builds a fake docker client holding the given link container records.
+    """
+    return FakeClient
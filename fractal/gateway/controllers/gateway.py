@@ -1,25 +1,27 @@
-import asyncio
 import json
 import os
 import sys
+import time
 import traceback
 import uuid
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Any, Optional
 
-from asgiref.sync import async_to_sync
 from clicz import cli_method
-from django.db import transaction
-from django.db.models import Q, Subquery
 from fractal.cli.fmt import display_data
 from fractal.gateway.exceptions import PortAlreadyAllocatedError
-from fractal.gateway.utils import check_port_availability, launch_gateway
-from fractal_database import ssh
-from fractal_database.controllers.fractal_database_controller import (
-    FractalDatabaseController,
+from fractal.gateway.transport import (
+    JSON_FORMAT,
+    dump_replication_event,
+    encode_replication_event,
+    iter_replication_batches,
+    iter_ssh_output,
+    negotiate_format,
+    replicate_batches,
 )
 from fractal_database.utils import is_db_initialized, use_django
 
 if TYPE_CHECKING:
+    from fractal.gateway.models import Gateway
     from fractal_database.models import Device
 
 
@@ -28,6 +30,8 @@ class FractalGatewayController:
     HTTP_GATEWAY_PORT = 80
     HTTPS_GATEWAY_PORT = 443
 
+    # not served by the agent: its protocol relays an operation's output in a single
+    # message, which would hold whole exports in memory a second time
     @use_django
     @cli_method
     def export(
@@ -41,7 +45,7 @@ class FractalGatewayController:
         ---
         Args:
             gateway_name: The name of the Gateway to export. Defaults to "fractal-gateway".
-            format: The format to export the Gateway in. Options are "json" or "python". Defaults to "json".
+            format: The format to export the Gateway in. Options are "json", "msgpack", "msgpack+zstd" or "python". Binary formats fall back to "json" when unavailable. Defaults to "json".
             silent: If True, the output will not be printed to stdout. Defaults to False.
         """
         from fractal.gateway.models import Gateway
@@ -53,29 +57,14 @@ class FractalGatewayController:
             exit(1)
 
         match format:
-            case "json":
-                gateway_fixture = gateway.to_fixture(with_relations=True, json=True)
-                gateway_fixture = json.loads(gateway_fixture)
-                gateway_fixture = {
-                    "replication_id": str(uuid.uuid4()),
-                    "payload": [*gateway_fixture],
-                }
-
-                # include device memberships in the fixture
-                device_memberships = gateway.device_memberships.prefetch_related(
-                    "device__domains"
-                ).all()
-                for membership in device_memberships:
-                    gateway_fixture["payload"].extend(
-                        json.loads(membership.to_fixture(with_relations=True, json=True))
-                    )
-                    domains = membership.device.domains.all()
-                    for domain in domains:
-                        gateway_fixture["payload"].extend(
-                            json.loads(domain.to_fixture(with_relations=True, json=True))
-                        )
-
-                gateway_fixture = json.dumps(gateway_fixture)
+            case "json" | "msgpack" | "msgpack+zstd":
+                gateway_fixture = self._build_export_event(gateway)
+                # downgrade to the best format available locally, receivers detect the format
+                format = negotiate_format(format)
+                if format == "json":
+                    gateway_fixture = json.dumps(gateway_fixture)
+                else:
+                    gateway_fixture = dump_replication_event(gateway_fixture, format)
 
             case "python":
                 gateway_fixture = gateway.to_fixture(with_relations=True, queryset=True)
@@ -93,33 +82,79 @@ class FractalGatewayController:
                 exit(1)
 
         if not silent:
-            print(gateway_fixture)
+            if isinstance(gateway_fixture, bytes):
+                sys.stdout.buffer.write(gateway_fixture)
+                sys.stdout.buffer.flush()
+            else:
+                print(gateway_fixture)
+
+        return gateway_fixture
+
+    def _build_export_event(self, gateway: "Gateway") -> dict[str, Any]:
+        gateway_fixture = json.loads(gateway.to_fixture(with_relations=True, json=True))
+        gateway_fixture = {
+            "replication_id": str(uuid.uuid4()),
+            "payload": [*gateway_fixture],
+        }
+
+        # include device memberships in the fixture
+        device_memberships = gateway.device_memberships.prefetch_related("device__domains").all()
+        for membership in device_memberships:
+            gateway_fixture["payload"].extend(
+                json.loads(membership.to_fixture(with_relations=True, json=True))
+            )
+            domains = membership.device.domains.all()
+            for domain in domains:
+                gateway_fixture["payload"].extend(
+                    json.loads(domain.to_fixture(with_relations=True, json=True))
+                )
 
         return gateway_fixture
 
     @use_django
     @cli_method
-    def list(self, format: str = "table", **kwargs):
+    def list(
+        self,
+        format: str = "table",
+        domain: Optional[str] = None,
+        page: Optional[str] = None,
+        page_size: Optional[str] = None,
+        **kwargs,
+    ):
         """
-        List Gateways.
+        List Gateways. Rows are read in chunks and the jsonl format prints them as they're read.
         ---
         Args:
-            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+            format: The format to display the data in. Options are "table", "json" or "jsonl". Defaults to "table".
+            domain: Only list the gateways that serve this domain.
+            page: The page to list, starting at 1. Requires page_size.
+            page_size: The number of gateways per page. Lists all gateways by default.
         """
+        from fractal.gateway.listing import display_rows, iterate_rows, paginate
         from fractal.gateway.models import Gateway
 
-        gateways = Gateway.objects.all()
-        if not gateways.exists():
-            print("No gateways found")
-            exit(0)
+        gateways = Gateway.objects.order_by("name")
+        if domain:
+            gateways = gateways.filter(device_memberships__device__domains__uri=domain).distinct()
 
-        data = [{"id": str(gateway.pk), "name": gateway.name} for gateway in gateways]
-        display_data(data, title="Gateways", format=format)
+        try:
+            gateways = paginate(gateways.values("pk", "name"), page=page, page_size=page_size)
+            rows = (
+                {"id": str(row["pk"]), "name": row["name"]} for row in iterate_rows(gateways)
+            )
+            count = display_rows(rows, title="Gateways", format=format)
+        except ValueError as err:
+            print(f"Error listing gateways: {err}", file=sys.stderr)
+            exit(1)
+
+        if not count and format != "jsonl":
+            print("No gateways found")
 
     @use_django
     def _init(self, gateway_name: str, fqdn: str, **kwargs):
         from fractal.gateway.models import Gateway
         from fractal.gateway.signals import create_gateway_and_homeserver_for_current_db
+        from fractal.gateway.utils import check_port_availability
 
         gateway_name = "fractal-gateway"
         try:
@@ -154,6 +189,7 @@ class FractalGatewayController:
 
     @use_django
     def _init_remote(self, ssh_url: str, ssh_port: str, fqdn: str, gateway_name: str, **kwargs):
+        from fractal_database import ssh
         from fractal_database.models import Database
 
         try:
@@ -193,6 +229,10 @@ class FractalGatewayController:
 
         # initialize the Fractal Database if it doesn't exist
         if not is_db_initialized():
+            from fractal_database.controllers.fractal_database_controller import (
+                FractalDatabaseController,
+            )
+
             fdb_controller = FractalDatabaseController()
             fdb_controller.init(
                 project_name=gateway_name, quiet=True, exist_ok=True, as_instance=True
@@ -248,36 +288,59 @@ class FractalGatewayController:
         current_device = Device.current_device()
 
         with database.as_current_database():
+            print("Syncing Gateway into local database")
+            gateway_uuid = None
+            load_gateway = False
+
+            def gateway_batches():
+                nonlocal gateway_uuid, load_gateway
+                for replication_id, records in self._stream_export(gateway_ssh, ssh_port):
+                    if gateway_uuid is None:
+                        for item in records:
+                            if item["model"] == "gateway.gateway":
+                                gateway_uuid = item["pk"]
+                                break
+                        else:
+                            # should never happen
+                            print(
+                                "Gateway did not return a gateway fixture",
+                                file=sys.stderr,
+                            )
+                            exit(1)
+
+                        # check to see if the gateway has already been loaded once into the local database
+                        load_gateway = not Gateway.objects.filter(pk=gateway_uuid).exists()
+
+                    if load_gateway:
+                        yield replication_id, records
+
             try:
-                result = ssh(gateway_ssh, "-p", str(ssh_port), "fractal gateway export")
+                # records are replicated batch by batch as they arrive, all or nothing
+                replicate_batches(gateway_batches(), replicate_fixture)
             except Exception as err:
-                print(f"Failed to connect to Gateway:\n{err.stderr.decode()}", file=sys.stderr)
+                stderr = err.stderr.decode() if hasattr(err, "stderr") else str(err)
+                print(f"Failed to connect to Gateway:\n{stderr}", file=sys.stderr)
                 exit(1)
 
-            print("Syncing Gateway into local database")
-            gateway_replication_event = json.loads(result.strip())
-            for item in gateway_replication_event["payload"]:
-                if item["model"] == "gateway.gateway":
-                    gateway_uuid = item["pk"]
-                    break
-            else:
-                # should never happen
+            # an export that streamed nothing doesn't raise
+            if gateway_uuid is None:
                 print(
-                    f"Gateway did not return a gateway fixture:\n{json.dumps(gateway_replication_event, indent=4)}",
+                    f"Gateway {gateway_ssh} did not export anything. Is fractal installed and a Gateway initialized on it?",
                     file=sys.stderr,
                 )
                 exit(1)
 
-            # check to see if the gateway has already been loaded once into the local database
+            # after loading, fetch the gateway
             try:
                 gateway = Gateway.objects.get(pk=gateway_uuid)
             except Gateway.DoesNotExist:
-                # load the gateway into the local database
-                asyncio.run(replicate_fixture(json.dumps(gateway_replication_event), None))
-
-                # after loading, fetch the gateway
-                gateway = Gateway.objects.get(pk=gateway_uuid)
+                print(
+                    f"Gateway {gateway_uuid} exported by {gateway_ssh} was not loaded into the local database",
+                    file=sys.stderr,
+                )
+                exit(1)
 
+            if load_gateway:
                 # ensure a local replication channel exists for the gateway for any
                 # replication logs related to it
                 LocalReplicationChannel.objects.get_or_create(
@@ -306,6 +369,24 @@ class FractalGatewayController:
 
         print(f"Added Database {database.name} to Gateway {gateway.name}")
 
+    def _stream_export(self, gateway_ssh: str, ssh_port: str):
+        """
+        Streams the Gateway's export over SSH in the most compact format both ends support.
+
+        Yields:
+        - tuple[replication_id, records]
+        """
+        format = negotiate_format()
+        command = f"fractal gateway export --format {format}"
+        try:
+            yield from iter_replication_batches(iter_ssh_output(gateway_ssh, ssh_port, command))
+        except Exception as err:
+            # gateways that predate binary exports reject the format before writing anything
+            if format == JSON_FORMAT or b"Invalid format" not in getattr(err, "stderr", b""):
+                raise err
+            command = f"fractal gateway export --format {JSON_FORMAT}"
+            yield from iter_replication_batches(iter_ssh_output(gateway_ssh, ssh_port, command))
+
     @use_django
     @cli_method
     def add(self, gateway_name: str, database_name: str, ssh_port: str = "22", **kwargs):
@@ -353,6 +434,7 @@ class FractalGatewayController:
             gateway_name: Name of the Gateway.
             database_name: Name of the Database to register the Gateway as a service with.
         """
+        from django.db.models import Q, Subquery
         from fractal.gateway.models import Gateway
         from fractal_database.models import Database, Device, LocalReplicationChannel
         from fractal_database_matrix.models import MatrixReplicationChannel
@@ -443,25 +525,21 @@ class FractalGatewayController:
 
         # for each device, provide all of their respective matrix credentials
         for gateway_device in gateway_devices:
-            device_replication_event = replication_event.copy()
-            import pdb
-
-            pdb.set_trace()
+            device_replication_event = {
+                **replication_event,
+                "payload": [*replication_event["payload"]],
+            }
             for cred in gateway_device.matrixcredentials_set.all():
                 device_replication_event["payload"].extend(
                     json.loads(cred.to_fixture(with_relations=True, json=True))
                 )
 
-            device_replication_event = json.dumps(device_replication_event)
-
             # load the replication event into the gateway
             try:
-                result = ssh(
+                self._sync_via_ssh(
                     gateway_device.ssh_config["host"],
-                    "-p",
                     str(gateway_device.ssh_config["port"]),
-                    "fractal db sync -",
-                    _in=device_replication_event,
+                    device_replication_event,
                 )
             except Exception as err:
                 print(f"Failed to connect to Gateway:\n{err.stderr.decode()}", file=sys.stderr)
@@ -469,6 +547,306 @@ class FractalGatewayController:
 
         print(f"Successfully registered Gateway {gateway.name} for {database.name}")
 
+    def _sync_via_ssh(self, ssh_url: str, ssh_port: str, event: dict[str, Any]) -> None:
+        """
+        Streams a replication event into a Gateway device using the most compact format
+        available, falling back to `fractal db sync` on Gateways without `fractal gateway sync`.
+        """
+        from fractal_database import ssh
+
+        format = negotiate_format()
+        if format != JSON_FORMAT:
+            try:
+                ssh(
+                    ssh_url,
+                    "-p",
+                    ssh_port,
+                    "fractal gateway sync -",
+                    _in=encode_replication_event(event, format),
+                )
+                return
+            except Exception as err:
+                # argparse exits with 2 when the remote doesn't know the sync command
+                if getattr(err, "exit_code", None) != 2:
+                    raise err
+
+        ssh(ssh_url, "-p", ssh_port, "fractal db sync -", _in=json.dumps(event))
+
+    @use_django
+    @cli_method
+    def sync(self, source: str, batch_size: str = "500", **kwargs):
+        """
+        Replicates a JSON or binary replication event into the local database.
+        Binary events are replicated in batches as they are read, in a single transaction.
+        ---
+        Args:
+            source: Path of the file containing the replication event. Use - to read from stdin.
+            batch_size: Number of records to replicate at a time. Defaults to 500.
+        """
+        from fractal_database.replication.tasks import replicate_fixture
+
+        stream = sys.stdin.buffer if source == "-" else open(source, "rb")
+
+        def read_chunks():
+            while chunk := stream.read1(65536):
+                yield chunk
+
+        try:
+            batches = iter_replication_batches(read_chunks(), int(batch_size))
+            replicate_batches(batches, replicate_fixture)
+        except Exception as err:
+            print(f"Failed to sync replication event: {err}", file=sys.stderr)
+            exit(1)
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+
+    @use_django
+    @cli_method
+    def distribution(self, gateway_name: str, format: str = "table", **kwargs):
+        """
+        Show how many links are placed on each of a Gateway's hosts (devices).
+        ---
+        Args:
+            gateway_name: Name of the Gateway.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+        """
+        from fractal.gateway.models import Gateway
+
+        try:
+            gateway = Gateway.objects.get(name=gateway_name)
+        except Gateway.DoesNotExist:
+            print(f"Error: Could not find Gateway {gateway_name}", file=sys.stderr)
+            exit(1)
+
+        counts = gateway.get_link_distribution()
+        total = sum(counts.values()) or 1
+        data = [
+            {"host": host, "links": count, "share": f"{count / total:.0%}"}
+            for host, count in counts.items()
+        ]
+        display_data(data, title=f"Link distribution of {gateway.name}", format=format)
+
+    @use_django
+    @cli_method
+    def rebalance(self, gateway_name: str, apply: bool = False, format: str = "table", **kwargs):
+        """
+        Shard a Gateway's links across its hosts (devices) by consistent hashing on their
+        FQDN. Only links whose host changes are moved. Shows the moves without --apply.
+        ---
+        Args:
+            gateway_name: Name of the Gateway.
+            apply: Record the new placements and shard new links from now on. Moved links go down on their old host and stay down until they are brought up again.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+        """
+        from fractal.gateway.models import Gateway
+
+        try:
+            gateway = Gateway.objects.get(name=gateway_name)
+        except Gateway.DoesNotExist:
+            print(f"Error: Could not find Gateway {gateway_name}", file=sys.stderr)
+            exit(1)
+
+        moves = gateway.rebalance_links(apply=apply)
+        if not moves:
+            print("All links are on their host")
+            return
+
+        names = {str(device.pk): device.name for device in gateway.get_hosts()}
+        data = [
+            {
+                "fqdn": move.fqdn,
+                "from": names.get(move.source, move.source or "unassigned"),  # type: ignore
+                "to": names.get(move.target, move.target),
+            }
+            for _, move in moves
+        ]
+        display_data(data, title="Moved links" if apply else "Planned moves", format=format)
+        if apply:
+            # the client of a link needs a new compose snippet to reach it on its new host,
+            # until then the reconciler of the old host removes the link's container
+            print(
+                "Moved links are down until they are brought up again on their new host: "
+                "run `fractal link up` for each and redeploy their clients with the new "
+                "compose snippet.",
+                file=sys.stderr,
+            )
+
+    @use_django
+    @cli_method
+    def gc(
+        self,
+        dry_run: bool = False,
+        interval: Optional[str] = None,
+        format: str = "table",
+        **kwargs,
+    ):
+        """
+        Remove link containers and link hub peers that no longer belong to a link hosted on
+        this device (deleted or re-pointed links). Frees their ports. NOTE: Must run on a
+        Gateway device.
+        ---
+        Args:
+            dry_run: Only show the orphaned links. Defaults to False.
+            interval: Collect garbage every interval seconds instead of once.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+        """
+        from fractal.gateway.models import Link
+        from fractal.gateway.teardown import collect_garbage
+        from fractal_database.models import Device
+
+        try:
+            device = Device.current_device()
+        except Exception:
+            device = None
+
+        while True:
+            orphans = collect_garbage(Link.hosted_fqdns(device), dry_run=dry_run)
+            if orphans:
+                data = [
+                    {"name": orphan.name, "fqdn": orphan.fqdn or "", "hub peer": not orphan.record}
+                    for orphan in orphans
+                ]
+                title = "Orphaned links" if dry_run else "Removed orphaned links"
+                display_data(data, title=title, format=format)
+            elif not interval:
+                print("No orphaned links found")
+
+            if not interval:
+                return
+            time.sleep(int(interval))
+
+    @use_django
+    @cli_method
+    def reconcile(
+        self,
+        interval: str = "30",
+        once: bool = False,
+        concurrency: str = "4",
+        rate: str = "5",
+        format: str = "table",
+        **kwargs,
+    ):
+        """
+        Continuously converge this device's gateway and link containers to the database:
+        start or create the gateway, start stopped and restart unhealthy link containers and
+        delete the containers of links that are gone. Runs every interval seconds and whenever
+        a gateway or link container changes. NOTE: Must run on a Gateway device.
+        ---
+        Args:
+            interval: Seconds between reconciliation passes. Defaults to 30.
+            once: Run a single pass and exit. Defaults to False.
+            concurrency: Number of containers acted on at once. Defaults to 4.
+            rate: Maximum number of container actions started per second. Defaults to 5.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+        """
+        from fractal.gateway.reconcile import Reconciler
+
+        reconciler = Reconciler(concurrency=int(concurrency), rate=float(rate))
+
+        def show(results):
+            if not results:
+                return
+            data = [
+                {
+                    "container": result.action.name,
+                    "action": result.action.kind,
+                    "fqdn": result.action.fqdn or "",
+                    "error": result.error or "",
+                }
+                for result in results
+            ]
+            display_data(data, title="Reconciled", format=format)
+
+        if once:
+            results = reconciler.reconcile()
+            if not results:
+                print("Gateway is up to date")
+            show(results)
+            if any(not result.ok for result in results):
+                exit(1)
+            return
+
+        reconciler.run(float(interval), on_pass=show)
+
+    @use_django
+    @cli_method
+    def agent(self, socket: Optional[str] = None, stdio: bool = False, **kwargs):
+        """
+        Run the gateway agent: a long-lived process that keeps Django, the database and the
+        container inventory warm and runs link up/create/down and gateway export for the CLI
+        over a Unix domain socket. Those commands use the agent automatically when it runs.
+        NOTE: Must run on a Gateway device.
+        ---
+        Args:
+            socket: Path of the agent's socket. Defaults to gateway-agent.sock in the fractal data directory.
+            stdio: Serve requests read from stdin instead, forwarding them to a running agent if there is one. For use through an SSH connection.
+        """
+        from fractal.gateway.agent import (
+            AgentUnavailable,
+            GatewayAgent,
+            bridge_stdio,
+            call_agent,
+            get_agent_operations,
+        )
+        from fractal.gateway.inventory import start_inventory
+        from fractal.gateway.replacement import watch_in_process
+
+        if stdio:
+            try:
+                call_agent("agent.ping", path=socket)
+            except AgentUnavailable:
+                pass
+            else:
+                bridge_stdio(socket)
+                return
+
+        stdin, stdout = sys.stdin.buffer, sys.stdout.buffer
+        agent = GatewayAgent(
+            get_agent_operations(), extra_kwargs={"project_name": kwargs.get("project_name")}
+        )
+        # start watching containers before the first request needs them
+        start_inventory()
+        # link ups served by the agent promote their replacements from its threads
+        watch_in_process()
+
+        if stdio:
+            agent.handle_stream(stdin, stdout)
+            return
+
+        try:
+            agent.serve(socket)
+        except RuntimeError as err:
+            print(f"Error: {err}", file=sys.stderr)
+            exit(1)
+        except KeyboardInterrupt:
+            pass
+
+    @use_django
+    @cli_method
+    def well_known(self, interval: str = "60", once: bool = False, **kwargs):
+        """
+        Serve `.well-known/matrix/client` documents directly from the Gateway's nginx.
+        Documents are recomputed every interval seconds and republished when homeserver
+        priorities or health change. NOTE: Must run on a Gateway device.
+        ---
+        Args:
+            interval: Seconds between refreshes. Defaults to 60.
+            once: Publish the documents once and exit. Defaults to False.
+        """
+        from fractal.gateway.well_known import refresh_well_known, watch_well_known
+
+        if once:
+            try:
+                refresh_well_known()
+            except Exception as err:
+                print(f"Failed to publish well-known documents: {err}", file=sys.stderr)
+                exit(1)
+            print("Published well-known documents to the Gateway")
+            return
+
+        watch_well_known(int(interval))
+
     @use_django
     @cli_method
     def add_domain(self, domain: str, gateway_name: str, **kwargs):
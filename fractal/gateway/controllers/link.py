@@ -1,14 +1,13 @@
 import asyncio
+import json
 import sys
 from sys import exit
 from typing import TYPE_CHECKING, Optional
 
-import tldextract
 from clicz import cli_method
 from fractal.cli.fmt import display_data
-from fractal_database import ssh
+from fractal.gateway.agent import served_by_agent
 from fractal_database.utils import use_django
-from taskiq.kicker import AsyncKicker
 
 if TYPE_CHECKING:
     from fractal.gateway.models import Gateway
@@ -21,32 +20,164 @@ class FractalLinkController:
 
     @use_django
     @cli_method
-    def list(self, format: str = "table", **kwargs):
+    def list(
+        self,
+        format: str = "table",
+        gateway: Optional[str] = None,
+        domain: Optional[str] = None,
+        state: Optional[str] = None,
+        page: Optional[str] = None,
+        page_size: Optional[str] = None,
+        **kwargs,
+    ):
         """
-        List all Links.
+        List Links. Rows are read in chunks and the jsonl format prints them as they're read.
         ---
         Args:
-            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
-
+            format: The format to display the data in. Options are "table", "json" or "jsonl". Defaults to "table".
+            gateway: Only list the links of domains served by this gateway (by id).
+            domain: Only list the links of this domain.
+            state: Only list links in this state. Options are "up", "down" or "failing".
+            page: The page to list, starting at 1. Requires page_size.
+            page_size: The number of links per page. Lists all links by default.
         """
+        from fractal.gateway.listing import display_rows, iterate_rows, paginate
         from fractal.gateway.models import Link
 
-        links = Link.objects.all()
-        if not links.exists():
+        try:
+            links = paginate(
+                Link.filter_links(gateway=gateway, domain=domain, state=state).values(
+                    "subdomain",
+                    "domain__uri",
+                    "forward_port",
+                    "last_up_ok",
+                    "placement_device__name",
+                ),
+                page=page,
+                page_size=page_size,
+            )
+            rows = (
+                {
+                    "fqdn": (
+                        f"{row['subdomain']}.{row['domain__uri']}"
+                        if row["subdomain"]
+                        else row["domain__uri"]
+                    ),
+                    "state": Link.get_state(row["forward_port"], row["last_up_ok"]),
+                    "forward_port": row["forward_port"],
+                    "device": row["placement_device__name"],
+                }
+                for row in iterate_rows(links)
+            )
+            count = display_rows(rows, title="Links", format=format)
+        except ValueError as err:
+            print(f"Error listing links: {err}", file=sys.stderr)
+            exit(1)
+
+        if not count and format != "jsonl":
             print("No links found")
-            exit(0)
 
-        # TODO: Include health information when available (link is running)
-        data = [
-            {
-                "fqdn": link.domain,
-                "gateways": ", ".join([gateway.name for gateway in link.gateways.all()]),
-            }
-            for link in links
-        ]
+    @cli_method
+    def stats(
+        self,
+        fqdn: Optional[str] = None,
+        format: str = "table",
+        watch: Optional[str] = None,
+        **kwargs,
+    ):
+        """
+        Show per-link traffic from the Gateway's access logs: request rates, status codes
+        and upstream latency percentiles. Only new log lines are read on each run.
+        NOTE: Must run on a Gateway device.
+        ---
+        Args:
+            fqdn: Only show the link with this fully qualified domain name.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+            watch: Keep ingesting and redisplay the stats every watch seconds.
+        """
+        import time
+
+        from fractal.gateway.access_log import load_ingestor, save_ingestor
+        from fractal.gateway.utils import get_gateway_container
 
-        display_data(data, title="Links", format=format)
+        ingestor = load_ingestor()
+        gateway = get_gateway_container()
+
+        while True:
+            ingestor.ingest(gateway)
+            save_ingestor(ingestor)
+
+            data = ingestor.summary()
+            if fqdn:
+                data = [row for row in data if row["fqdn"] == fqdn]
+            if not data:
+                print("No link traffic found")
+            else:
+                display_data(data, title="Link Stats", format=format)
+
+            if not watch:
+                return
+            time.sleep(int(watch))
+
+    @cli_method
+    def metrics(
+        self,
+        format: str = "table",
+        watch: Optional[str] = None,
+        idle_after: str = "86400",
+        reclaim: bool = False,
+        **kwargs,
+    ):
+        """
+        Sample WireGuard transfer and handshake counters of every link on the Gateway and
+        show per-link rates, handshake age and whether the link is idle. Idle links can be
+        reclaimed: their containers are removed and they keep their forward port, so a link
+        up brings them back as they were.
+        NOTE: Must run on a Gateway device.
+        ---
+        Args:
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+            watch: Keep sampling every watch seconds (feeds the metrics endpoint).
+            idle_after: Seconds without traffic after which a link is flagged as idle. Defaults to 86400.
+            reclaim: Take idle links down after each sample. Defaults to False.
+        """
+        import time
+
+        import docker
+        from fractal.gateway.inventory import start_inventory
+        from fractal.gateway.link_metrics import load_collector, save_collector
+        from fractal.gateway.teardown import take_links_down
+
+        client = docker.from_env()
+        collector = load_collector()
+        if watch:
+            # sampling repeatedly, keep the link containers in memory instead of listing them
+            start_inventory()
+
+        while True:
+            collector.collect(client)
+
+            data = collector.summary(idle_after=int(idle_after))
+            if not data:
+                print("No links found")
+            else:
+                display_data(data, title="Link Metrics", format=format)
 
+            idle = collector.idle_links(int(idle_after)) if reclaim else []
+            if idle:
+                results = take_links_down(idle, client)
+                # a link that is brought up again starts a new series
+                for fqdn in idle:
+                    collector.series.pop(fqdn, None)
+                data = [{"fqdn": fqdn, "was up": was_up} for fqdn, was_up in results.items()]
+                display_data(data, title="Reclaimed idle links", format=format)
+            save_collector(collector)
+
+            if not watch:
+                return
+            time.sleep(int(watch))
+
+    @served_by_agent
     @use_django
     @cli_method
     def create(
@@ -62,16 +193,16 @@ class FractalLinkController:
             output_as_json: Whether to output the link as a JSON fixture. Defaults to False.
             force: Whether to continue if the link already exists. Defaults to False.
         """
+        import tldextract
         from fractal.gateway.models import Gateway, Link
 
-        gateway = Gateway.objects.filter(pk=gateway_id)
-        if not gateway.exists():
+        gateway = Gateway.objects.filter(pk=gateway_id).first()
+        if not gateway:
             print(
                 f"Error creating link: Could not find gateway by the id of {gateway_id}.",
                 file=sys.stderr,
             )
             exit(1)
-        gateway = gateway.first()
 
         with gateway.as_current_database():
             url = tldextract.extract(fqdn)
@@ -112,6 +243,7 @@ class FractalLinkController:
                 print(f"Added link to the following gateway: {gateway.name}")
             return link
 
+    @served_by_agent
     @use_django
     @cli_method
     def up(
@@ -120,6 +252,7 @@ class FractalLinkController:
         link_fqdn: str,
         tcp_forwarding: bool = False,
         forward_port: Optional[str] = None,
+        aliases: Optional[str] = None,
         **kwargs,
     ):
         """
@@ -130,7 +263,9 @@ class FractalLinkController:
             link_fqdn: Fully qualified domain name for the link (i.e. subdomain.mydomain.com).
             tcp_forwarding: Whether to enable TCP forwarding. Defaults to False.
             forward_port: The port to map as the center port in the link. Will generate a random forward port by default.
+            aliases: Comma separated FQDNs of other links that are served through this link's tunnel.
         """
+        import tldextract
         from fractal.gateway.models import Domain, Gateway, Link
         from fractal.gateway.tasks import link_up
         from fractal.gateway.utils import build_gateway_containers
@@ -159,25 +294,118 @@ class FractalLinkController:
             )
             exit(1)
 
-        try:
-            Link.objects.get(domain=domain, subdomain=subdomain)
-        except Link.DoesNotExist:
+        if not Link.objects.filter(domain=domain, subdomain=subdomain).exists():
             print(
                 f"Error: Could not find link {link_fqdn} in your local database",
                 file=sys.stderr,
             )
             exit(1)
 
-        gateway_link_public_key, link_address, client_private_key, forward_port = asyncio.run(
-            link_up(link_fqdn, tcp_forwarding, forward_port)
+        alias_fqdns = [fqdn.strip() for fqdn in (aliases or "").split(",") if fqdn.strip()]
+        for alias in alias_fqdns:
+            try:
+                Link.get_by_url(alias)
+            except Link.DoesNotExist:
+                print(
+                    f"Error: Could not find link {alias} in your local database",
+                    file=sys.stderr,
+                )
+                exit(1)
+
+        # read by Link._up_via_ssh on the device that asked for the link
+        link_config = asyncio.run(
+            link_up(link_fqdn, tcp_forwarding, forward_port, alias_fqdns or None)
         )
-        link_config = {
-            "gateway_link_public_key": gateway_link_public_key,
-            "link_address": link_address,
-            "client_private_key": client_private_key,
-            "forward_port": forward_port,
-        }
-        print(",".join(link_config.values()))
+        print(json.dumps(link_config))
+
+    @served_by_agent
+    @use_django
+    @cli_method
+    def down(
+        self,
+        link_fqdns: Optional[str] = None,
+        all: bool = False,
+        domain: Optional[str] = None,
+        gateway_id: Optional[str] = None,
+        format: str = "table",
+        **kwargs,
+    ):
+        """
+        Take links down. Their containers (or link hub peers) are removed and their forward
+        ports are released. NOTE: Must run on a Gateway device, unless gateway_id is given.
+        ---
+        Args:
+            link_fqdns: Comma separated FQDNs of the links to take down.
+            all: Take down every link hosted on this device (or served by the gateway). Defaults to False.
+            domain: Take down every link of a domain hosted on this device (or served by the gateway).
+            gateway_id: Take the links down on the devices of this gateway they were placed on, over SSH or the gateway's replication channel, like link up.
+            format: The format to display the data in. Options are "table" or "json". Defaults to "table".
+        """
+        from django.db import transaction
+        from fractal.gateway.models import Gateway, Link
+        from fractal.gateway.teardown import take_links_down
+        from fractal_database.models import Device
+
+        gateway = None
+        if gateway_id:
+            gateway = Gateway.objects.filter(pk=gateway_id).first()
+            if not gateway:
+                print(f"Error: Could not find gateway {gateway_id}", file=sys.stderr)
+                exit(1)
+
+        if link_fqdns:
+            fqdns = [fqdn.strip() for fqdn in link_fqdns.split(",") if fqdn.strip()]
+        elif all or domain:
+            if gateway:
+                fqdns = [link.fqdn for link in gateway.get_links()]
+            else:
+                try:
+                    device = Device.current_device()
+                except Exception:
+                    device = None
+                fqdns = Link.hosted_fqdns(device)
+            if domain:
+                fqdns = [fqdn for fqdn in fqdns if fqdn == domain or fqdn.endswith(f".{domain}")]
+        else:
+            print("Error: Specify link FQDNs, --domain or --all", file=sys.stderr)
+            exit(1)
+
+        if not fqdns:
+            print("No links to take down")
+            return
+
+        if gateway:
+            links = list(Link.filter_fqdns(fqdns))
+            missing = set(fqdns) - {link.fqdn for link in links}
+            if missing:
+                print(f"Error: Could not find links {', '.join(sorted(missing))}", file=sys.stderr)
+                exit(1)
+
+            async def take_down():
+                return await asyncio.gather(
+                    *(link.down(gateway) for link in links), return_exceptions=True
+                )
+
+            data = [
+                {"fqdn": link.fqdn, "error": str(result) if result else ""}
+                for link, result in zip(links, asyncio.run(take_down()))
+            ]
+            display_data(data, title="Links taken down", format=format)
+            if any(row["error"] for row in data):
+                exit(1)
+            return
+
+        results = take_links_down(fqdns)
+
+        # released forward ports can be allocated to other links
+        brought_down = [fqdn for fqdn, was_up in results.items() if was_up]
+        with transaction.atomic():
+            for link in Link.filter_fqdns(brought_down).filter(forward_port__isnull=False):
+                link.forward_port = None
+                link.save_changed()
+
+        data = [{"fqdn": fqdn, "was up": was_up} for fqdn, was_up in results.items()]
+        display_data(data, title="Links taken down", format=format)
 
 
 Controller = FractalLinkController
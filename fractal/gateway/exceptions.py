@@ -14,3 +14,15 @@ class GatewayNetworkNotFound(Exception):
     def __init__(self, network: str):
         self.network = network
         super().__init__(f"Gateway container with name {network} not found")
+
+
+class GatewayReloadError(Exception):
+    def __init__(self, output: str):
+        self.output = output
+        super().__init__(f"Failed to reload gateway configuration:\n{output}")
+
+
+class LinkHubError(Exception):
+    def __init__(self, output: str):
+        self.output = output
+        super().__init__(f"Link hub command failed:\n{output}")
@@ -0,0 +1,209 @@
+"""
+Link hub mode.
+
+Instead of one gateway link container per link, a single hub container hosts one WireGuard
+interface with a peer per link (see `resources/gateway-link/hub.sh`). The gateway routes each
+link's HTTP and HTTPS(SNI) traffic to the pair of hub ports that forward to the link's peer,
+so the per-link overhead is a peer entry and two NAT rules.
+
+Enabled on a Gateway device with `FRACTAL_GATEWAY_LINK_MODE=hub`. Links with TCP forwarding
+still get a dedicated container since Docker can't publish ports on a running container.
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+import docker
+from docker import DockerClient
+from docker.errors import APIError
+from docker.models.containers import Container
+from fractal.gateway.exceptions import (
+    GatewayNetworkNotFound,
+    LinkHubError,
+    PortAlreadyAllocatedError,
+)
+from fractal.gateway.inventory import GATEWAY_LINK_LABEL
+from fractal.gateway.networks import GATEWAY_NETWORK_NAME, find_network
+from fractal.gateway.routes import sync_link_routes
+from fractal.gateway.utils import (
+    GATEWAY_LINK_IMAGE_TAG,
+    build_gateway_containers,
+    find_container,
+    get_link_container_name,
+    get_port_from_error,
+)
+
+logger = logging.getLogger(__name__)
+
+LINK_HUB_CONTAINER_NAME = "fractal-gateway-link-hub"
+LINK_HUB_LABEL = "f.gateway.link.hub"
+LINK_HUB_PORT = int(os.environ.get("FRACTAL_GATEWAY_LINK_HUB_PORT", "18520"))
+LINK_HUB_ADDRESS = "10.1.0.1"
+LINK_HUB_PREFIX_LENGTH = 16
+
+
+def link_hub_enabled() -> bool:
+    return os.environ.get("FRACTAL_GATEWAY_LINK_MODE", "container") == "hub"
+
+
+@dataclass
+class HubPeer:
+    name: str
+    index: int
+    address: str
+    http_port: int
+    https_port: int
+    fqdn: str
+    pubkey: str
+
+
+def get_link_hub(client: DockerClient, create: bool = True) -> Optional[Container]:
+    """
+    Returns the link hub container, launching it if it doesn't exist.
+
+    Parameters:
+    - client: DockerClient, the Docker client to use for the operation.
+    - create: Bool, whether to launch the hub if it doesn't exist. Defaults to True.
+    """
+    record = find_container(LINK_HUB_CONTAINER_NAME, client)
+    if record:
+        hub: Container = client.containers.prepare_model(record.attrs)  # type: ignore
+        if not record.running and create:
+            hub.start()
+        return hub
+
+    if not create:
+        return None
+
+    build_gateway_containers()
+
+    # the hub is a single container, it stays on the first network shard
+    network = find_network(GATEWAY_NETWORK_NAME, client)
+    if not network:
+        raise GatewayNetworkNotFound(GATEWAY_NETWORK_NAME)
+
+    logger.info("Launching link hub container %s" % LINK_HUB_CONTAINER_NAME)
+    try:
+        return client.containers.run(
+            image=GATEWAY_LINK_IMAGE_TAG,
+            name=LINK_HUB_CONTAINER_NAME,
+            network=network.name,  # type: ignore
+            restart_policy={"Name": "unless-stopped"},
+            cap_add=["NET_ADMIN"],
+            labels={GATEWAY_LINK_LABEL: "true", LINK_HUB_LABEL: "true"},
+            detach=True,
+            environment={"LINK_HUB": "true"},
+            ports={"18521/udp": LINK_HUB_PORT},
+        )  # type: ignore
+    except APIError as err:
+        container: Container = client.containers.get(LINK_HUB_CONTAINER_NAME)  # type: ignore
+        container.remove()
+        port_number = get_port_from_error(err.explanation)  # type: ignore
+        if port_number:
+            raise PortAlreadyAllocatedError(port_number)
+        raise err
+
+
+def _hub_exec(hub: Container, *args: str) -> str:
+    result = hub.exec_run(["hub.sh", *args])
+    if result.exit_code != 0:
+        raise LinkHubError(result.output.decode())
+    return result.output.decode().strip()
+
+
+def parse_hub_peers(output: str) -> list[HubPeer]:
+    peers = []
+    for line in output.splitlines():
+        name, index, address, http_port, https_port, fqdn, pubkey = line.split()
+        peers.append(
+            HubPeer(
+                name=name,
+                index=int(index),
+                address=address,
+                http_port=int(http_port),
+                https_port=int(https_port),
+                fqdn=fqdn,
+                pubkey=pubkey,
+            )
+        )
+    return peers
+
+
+def list_hub_peers(hub: Container) -> list[HubPeer]:
+    return parse_hub_peers(_hub_exec(hub, "list"))
+
+
+def add_hub_peer(
+    link_fqdn: str, link_pubkey: str, client: Optional[DockerClient] = None
+) -> tuple[str, str, str]:
+    """
+    Adds (or updates) the peer of a link on the link hub and routes the link's traffic to it.
+
+    Returns:
+    - tuple[wireguard_pubkey, link_address, tunnel_address], the hub's WireGuard public key,
+        the address the client connects to and the client's address inside of the tunnel.
+    """
+    client = client or docker.from_env()
+    hub = get_link_hub(client)
+    name = get_link_container_name(link_fqdn)
+
+    hub_pubkey, peer_address = _hub_exec(hub, "add", name, link_pubkey, link_fqdn).split()  # type: ignore
+
+    # the link may have had a dedicated container before the hub was enabled
+    record = find_container(name, client)
+    if record:
+        logger.info("Removing dedicated link container %s in favor of the link hub" % name)
+        client.containers.prepare_model(record.attrs).remove(force=True)
+
+    sync_link_routes(client)
+
+    return (
+        hub_pubkey,
+        f"{link_fqdn}:{LINK_HUB_PORT}",
+        f"{peer_address}/{LINK_HUB_PREFIX_LENGTH}",
+    )
+
+
+def remove_hub_peer(
+    link_fqdn: str, client: Optional[DockerClient] = None, sync_routes: bool = True
+) -> None:
+    """
+    Removes the peer of a link from the link hub along with its route.
+
+    Parameters:
+    - sync_routes: Bool, whether to republish the gateway's routes. Callers removing several
+        peers republish them once when done. Defaults to True.
+    """
+    client = client or docker.from_env()
+    hub = get_link_hub(client, create=False)
+    if not hub:
+        return
+
+    _hub_exec(hub, "remove", get_link_container_name(link_fqdn))
+    if sync_routes:
+        sync_link_routes(client)
+
+
+def remove_stale_hub_peers(link_fqdns: list[str], client: Optional[DockerClient] = None) -> bool:
+    """
+    Removes the hub peers of links that are moving to a dedicated container, i.e. because
+    they're brought up with TCP forwarding or aliases, or hub mode was turned off. The
+    counterpart of `add_hub_peer` removing a link's dedicated container. Routes aren't
+    republished, the caller does when its container is up.
+
+    Returns:
+    - bool, whether any peer was removed.
+    """
+    client = client or docker.from_env()
+    hub = get_link_hub(client, create=False)
+    if not hub:
+        return False
+
+    names = {get_link_container_name(fqdn) for fqdn in link_fqdns}
+    stale = [peer for peer in list_hub_peers(hub) if peer.name in names]
+    for peer in stale:
+        logger.info("Removing link hub peer %s in favor of a dedicated container" % peer.name)
+        _hub_exec(hub, "remove", peer.name)
+    return bool(stale)
@@ -0,0 +1,320 @@
+import logging
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+import docker
+from docker import DockerClient
+from docker.errors import NotFound
+from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_LABEL = "f.gateway"
+GATEWAY_LINK_LABEL = "f.gateway.link"
+WATCHED_LABELS = (GATEWAY_LABEL, GATEWAY_LINK_LABEL)
+
+RECONNECT_DELAY = 1.0
+# seconds long-lived processes wait for the inventory's first sync (see start_inventory)
+SYNC_TIMEOUT = 5.0
+# seconds to wait for the inventory to see a container that was just started or renamed
+CATCH_UP_TIMEOUT = 5.0
+# events that don't change anything the inventory keeps track of
+IGNORED_ACTIONS = ("exec_", "attach", "resize", "top", "archive-path", "extract-to-dir")
+
+HEALTH_RE = re.compile(r"\((healthy|unhealthy|health: starting)\)")
+
+
+@dataclass
+class ContainerRecord:
+    id: str
+    name: str
+    labels: dict[str, str]
+    ports: dict[str, Optional[list[dict[str, str]]]]
+    state: str
+    health: Optional[str] = None
+    attrs: dict[str, Any] = field(default_factory=dict, repr=False)
+
+    @classmethod
+    def from_inspect(cls, attrs: dict[str, Any]) -> "ContainerRecord":
+        state = attrs["State"]
+        return cls(
+            id=attrs["Id"],
+            name=attrs["Name"].lstrip("/"),
+            labels=attrs["Config"]["Labels"] or {},
+            ports=attrs["NetworkSettings"]["Ports"] or {},
+            state=state["Status"],
+            health=(state.get("Health") or {}).get("Status"),
+            attrs=attrs,
+        )
+
+    @classmethod
+    def from_summary(cls, attrs: dict[str, Any]) -> "ContainerRecord":
+        """
+        Builds a record from an entry of the (sparse) container list endpoint.
+        """
+        ports: dict[str, Optional[list[dict[str, str]]]] = {}
+        for port in attrs.get("Ports") or []:
+            key = f"{port['PrivatePort']}/{port['Type']}"
+            bindings = ports.setdefault(key, None)
+            if "PublicPort" in port:
+                ports[key] = [
+                    *(bindings or []),
+                    {"HostIp": port.get("IP", ""), "HostPort": str(port["PublicPort"])},
+                ]
+
+        health = HEALTH_RE.search(attrs.get("Status", ""))
+        return cls(
+            id=attrs["Id"],
+            name=attrs["Names"][0].lstrip("/"),
+            labels=attrs.get("Labels") or {},
+            ports=ports,
+            state=attrs["State"],
+            health=health.group(1).replace("health: ", "") if health else None,
+            attrs=attrs,
+        )
+
+    def host_port(self, port: str) -> Optional[str]:
+        """
+        Returns the host port published for a container port (i.e. "18521/udp").
+        """
+        bindings = self.ports.get(port)
+        if not bindings:
+            return None
+        return bindings[0]["HostPort"]
+
+    @property
+    def running(self) -> bool:
+        return self.state == "running"
+
+    @property
+    def image_id(self) -> str:
+        # summaries and inspect results name the image id differently
+        return self.attrs.get("ImageID") or self.attrs["Image"]
+
+
+class ContainerInventory:
+    """
+    In-memory inventory of the gateway and gateway link containers on the Docker host.
+
+    A background thread subscribes to the Docker events API and keeps the inventory up to
+    date, resynchronizing with a single list call per label whenever the event stream
+    (re)connects. Readers never talk to Docker.
+    """
+
+    def __init__(self, client: DockerClient):
+        self.client = client
+        self._records: dict[str, ContainerRecord] = {}
+        # bumped on every change so that waiters can tell whether they missed one
+        self.generation = 0
+        self._changed = threading.Condition()
+        self._synced = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._events = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="fractal-gateway-inventory", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._events is not None:
+            self._events.close()
+
+    def wait_synced(self, timeout: Optional[float] = None) -> bool:
+        return self._synced.wait(timeout)
+
+    def resync(self) -> None:
+        """
+        Replaces the inventory with the current state of the Docker host.
+        """
+        records = {}
+        for label in WATCHED_LABELS:
+            for summary in self.client.api.containers(all=True, filters={"label": label}):
+                record = ContainerRecord.from_summary(summary)
+                records[record.id] = record
+
+        with self._changed:
+            self._records = records
+            self._notify()
+
+    def _notify(self) -> None:
+        # callers hold self._changed
+        self.generation += 1
+        self._changed.notify_all()
+
+    def wait_changed(self, generation: int, timeout: Optional[float] = None) -> int:
+        """
+        Waits until the inventory changes after `generation`.
+
+        Returns:
+        - int, the current generation. Equal to `generation` on timeout.
+        """
+        with self._changed:
+            self._changed.wait_for(lambda: self.generation != generation, timeout)
+            return self.generation
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                # subscribe from before the list so that no change falls in between
+                since = int(time.time())
+                self.resync()
+                self._events = self.client.events(
+                    decode=True, since=since, filters={"type": "container"}
+                )
+                self._synced.set()
+                for event in self._events:
+                    self._handle_event(event)
+            except Exception as err:
+                if self._stopped.is_set():
+                    break
+                logger.warning("Docker event stream interrupted, resynchronizing: %s" % err)
+
+            self._synced.clear()
+            self._stopped.wait(RECONNECT_DELAY)
+
+    def _handle_event(self, event: dict[str, Any]) -> None:
+        action = event.get("Action", "")
+        if action.startswith(IGNORED_ACTIONS):
+            return
+
+        attributes = event.get("Actor", {}).get("Attributes", {})
+        if not any(label in attributes for label in WATCHED_LABELS):
+            return
+
+        container_id = event["Actor"]["ID"]
+        if action == "destroy":
+            with self._changed:
+                self._records.pop(container_id, None)
+                self._notify()
+            return
+
+        try:
+            record = ContainerRecord.from_inspect(self.client.api.inspect_container(container_id))
+        except NotFound:
+            with self._changed:
+                self._records.pop(container_id, None)
+                self._notify()
+            return
+
+        with self._changed:
+            self._records[record.id] = record
+            self._notify()
+
+    def get(self, name: str) -> Optional[ContainerRecord]:
+        with self._changed:
+            for record in self._records.values():
+                if record.name == name:
+                    return record
+        return None
+
+    def list(self, label: str, value: Optional[str] = None) -> list[ContainerRecord]:
+        """
+        Returns the containers that have the given label, optionally with the given value.
+        """
+        with self._changed:
+            return [
+                record
+                for record in self._records.values()
+                if label in record.labels and (value is None or record.labels[label] == value)
+            ]
+
+    def wait_for(
+        self,
+        name: str,
+        predicate: Callable[[ContainerRecord], bool],
+        timeout: Optional[float] = None,
+    ) -> Optional[ContainerRecord]:
+        """
+        Waits until the container with the given name satisfies `predicate`.
+
+        Returns:
+        - Optional[ContainerRecord], the matching record or None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._changed:
+            while True:
+                record = self.get(name)
+                if record and predicate(record):
+                    return record
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def container(self, record: ContainerRecord) -> Container:
+        """
+        Returns a Docker SDK container for a record without an API round-trip.
+        """
+        return self.client.containers.prepare_model(record.attrs)  # type: ignore
+
+
+_inventory: Optional[ContainerInventory] = None
+_inventory_lock = threading.Lock()
+
+
+def start_inventory(timeout: float = SYNC_TIMEOUT) -> Optional[ContainerInventory]:
+    """
+    Starts the process wide container inventory and waits for its first sync. The inventory
+    keeps a thread and a Docker event subscription running, so only long-lived processes
+    (the agent and the reconciler) start it. Short-lived CLI processes query Docker directly.
+
+    Returns:
+    - Optional[ContainerInventory], None if the inventory could not synchronize with Docker
+        within `timeout` seconds.
+    """
+    global _inventory
+
+    with _inventory_lock:
+        if _inventory is None:
+            try:
+                _inventory = ContainerInventory(docker.from_env())
+            except Exception as err:
+                logger.warning("Failed to start container inventory: %s" % err)
+                return None
+            _inventory.start()
+
+    if not _inventory.wait_synced(timeout):
+        return None
+    return _inventory
+
+
+def get_inventory(timeout: float = 0) -> Optional[ContainerInventory]:
+    """
+    Returns the process wide container inventory if this process started it (see
+    `start_inventory`). Doesn't start it and by default doesn't wait for it to synchronize.
+
+    Returns:
+    - Optional[ContainerInventory], None if the inventory wasn't started or isn't in sync with
+        Docker within `timeout` seconds. Callers should fall back to querying Docker directly.
+    """
+    inventory = _inventory
+    if inventory is None or not inventory.wait_synced(timeout):
+        return None
+    return inventory
+
+
+def wait_for_container(name: str, container_id: str, timeout: float = CATCH_UP_TIMEOUT) -> bool:
+    """
+    Waits until the running inventory sees the container `container_id` running as `name`,
+    so that its readers (i.e. collect_link_routes) see a container that was just started or
+    renamed. Returns right away when the inventory isn't running.
+
+    Returns:
+    - bool, False if the inventory didn't catch up within `timeout` seconds.
+    """
+    inventory = get_inventory()
+    if not inventory:
+        return True
+    record = inventory.wait_for(
+        name, lambda record: record.id == container_id and record.running, timeout=timeout
+    )
+    if not record:
+        logger.warning("Container inventory didn't see %s running in time" % name)
+    return record is not None
@@ -0,0 +1,355 @@
+"""
+Per-link WireGuard transfer and handshake accounting.
+
+Every interval the collector gathers `wg show link0 dump` from all gateway link containers
+in one pass (one exec per container, in parallel, or a single exec in the link hub) and
+appends a sample (time, rx bytes, tx bytes, latest handshake) per link to a fixed size ring.
+The rings are used to flag idle links and stale handshakes and to feed the metrics endpoint.
+"""
+
+import base64
+import json
+import logging
+import os
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+# 24 hours of samples at the default interval
+DEFAULT_INTERVAL = 60
+RING_SIZE = 1440
+MAX_WORKERS = 16
+
+# links without traffic for this long are candidates for reclamation
+DEFAULT_IDLE_AFTER = 24 * 60 * 60
+# WireGuard re-handshakes every 2 minutes while a tunnel is in use
+STALE_HANDSHAKE_AFTER = 5 * 60
+
+METRICS_FILENAME = "gateway-link-metrics.json"
+
+HUB_DUMP_SEPARATOR = "---"
+
+
+@dataclass
+class PeerSample:
+    pubkey: str
+    latest_handshake: int
+    rx: int
+    tx: int
+
+
+def parse_wg_dump(output: str) -> list[PeerSample]:
+    """
+    Parses the peers of `wg show <iface> dump`. The first line describes the interface, every
+    other line a peer: pubkey, preshared key, endpoint, allowed ips, latest handshake,
+    rx bytes, tx bytes, persistent keepalive.
+    """
+    peers = []
+    for line in output.strip().splitlines()[1:]:
+        fields = line.split("\t")
+        if len(fields) < 8:
+            continue
+        peers.append(
+            PeerSample(
+                pubkey=fields[0],
+                latest_handshake=int(fields[4]),
+                rx=int(fields[5]),
+                tx=int(fields[6]),
+            )
+        )
+    return peers
+
+
+class LinkSeries:
+    """
+    Fixed size ring of (time, rx, tx, latest handshake) samples of a link.
+    """
+
+    def __init__(self, size: int = RING_SIZE):
+        self.size = size
+        self.times = array("d", [0.0] * size)
+        self.rx = array("q", [0] * size)
+        self.tx = array("q", [0] * size)
+        self.handshakes = array("q", [0] * size)
+        self.count = 0
+
+    def _index(self, age: int) -> int:
+        """
+        Returns the ring index of the sample `age` samples before the latest one.
+        """
+        return (self.count - 1 - age) % self.size
+
+    def __len__(self) -> int:
+        return min(self.count, self.size)
+
+    def append(self, timestamp: float, rx: int, tx: int, latest_handshake: int) -> None:
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.rx[index] = rx
+        self.tx[index] = tx
+        self.handshakes[index] = latest_handshake
+        self.count += 1
+
+    def latest(self) -> Optional[tuple[float, int, int, int]]:
+        if not self.count:
+            return None
+        i = self._index(0)
+        return self.times[i], self.rx[i], self.tx[i], self.handshakes[i]
+
+    def rates(self, window: float) -> tuple[float, float]:
+        """
+        Returns the average (rx, tx) bytes per second over the last `window` seconds. Counters
+        that went backwards (the link container restarted) count from zero.
+        """
+        if len(self) < 2:
+            return 0.0, 0.0
+
+        newest = self._index(0)
+        rx = tx = 0
+        start = self.times[newest]
+        for age in range(1, len(self)):
+            i, later = self._index(age), self._index(age - 1)
+            if self.times[newest] - self.times[i] > window:
+                break
+            rx += self.rx[later] - self.rx[i] if self.rx[later] >= self.rx[i] else self.rx[later]
+            tx += self.tx[later] - self.tx[i] if self.tx[later] >= self.tx[i] else self.tx[later]
+            start = self.times[i]
+
+        elapsed = self.times[newest] - start
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return rx / elapsed, tx / elapsed
+
+    def last_active(self) -> Optional[float]:
+        """
+        Returns when the link last transferred data, None if it didn't in the kept samples.
+        """
+        for age in range(0, len(self) - 1):
+            i, earlier = self._index(age), self._index(age + 1)
+            if self.rx[i] != self.rx[earlier] or self.tx[i] != self.tx[earlier]:
+                return self.times[i]
+        return None
+
+    def idle(self, idle_after: float, now: Optional[float] = None) -> bool:
+        """
+        Whether the link has been sampled for at least `idle_after` seconds without traffic.
+        """
+        if not self.count:
+            return False
+        now = now or time.time()
+        oldest = self.times[self._index(len(self) - 1)]
+        if now - oldest < idle_after:
+            return False
+        last_active = self.last_active()
+        return last_active is None or now - last_active >= idle_after
+
+    def to_dict(self) -> dict[str, Any]:
+        def encode(values: array) -> str:
+            return base64.b64encode(values.tobytes()).decode()
+
+        return {
+            "size": self.size,
+            "count": self.count,
+            "times": encode(self.times),
+            "rx": encode(self.rx),
+            "tx": encode(self.tx),
+            "handshakes": encode(self.handshakes),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "LinkSeries":
+        series = cls(data["size"])
+        series.count = data["count"]
+        for name in ("times", "rx", "tx", "handshakes"):
+            values = getattr(series, name)
+            values[:] = array(values.typecode, base64.b64decode(data[name]))
+        return series
+
+
+def _dump_link_container(container: "Container") -> str:
+    result = container.exec_run(["wg", "show", "link0", "dump"])
+    if result.exit_code != 0:
+        raise Exception(result.output.decode())
+    return result.output.decode()
+
+
+class LinkMetricsCollector:
+    def __init__(self, size: int = RING_SIZE):
+        self.size = size
+        self.series: dict[str, LinkSeries] = {}
+
+    def record(self, fqdn: str, sample: PeerSample, timestamp: float) -> None:
+        series = self.series.setdefault(fqdn, LinkSeries(self.size))
+        series.append(timestamp, sample.rx, sample.tx, sample.latest_handshake)
+
+    def collect(self, client: "DockerClient") -> None:
+        """
+        Samples the WireGuard counters of every link on the gateway.
+        """
+        from fractal.gateway.hub import (
+            LINK_HUB_LABEL,
+            get_link_hub,
+            parse_hub_peers,
+        )
+        from fractal.gateway.inventory import ContainerRecord, get_inventory
+        from fractal.gateway.utils import LINK_FQDN_LABEL
+
+        inventory = get_inventory()
+        if inventory:
+            records = inventory.list(LINK_FQDN_LABEL)
+        else:
+            records = [
+                ContainerRecord.from_summary(summary)
+                for summary in client.api.containers(filters={"label": LINK_FQDN_LABEL})
+            ]
+        records = [
+            record
+            for record in records
+            if record.running and LINK_HUB_LABEL not in record.labels
+        ]
+
+        def dump(record: ContainerRecord) -> tuple[str, str]:
+            return record.labels[LINK_FQDN_LABEL], _dump_link_container(
+                client.containers.prepare_model(record.attrs)  # type: ignore
+            )
+
+        timestamp = time.time()
+        if records:
+            with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(records))) as executor:
+                futures = [executor.submit(dump, record) for record in records]
+            for future in futures:
+                try:
+                    fqdn, output = future.result()
+                except Exception as err:
+                    logger.warning("Failed to sample link container: %s" % err)
+                    continue
+                # dedicated link containers have a single peer, the link's client
+                for sample in parse_wg_dump(output)[:1]:
+                    self.record(fqdn, sample, timestamp)
+
+        hub = get_link_hub(client, create=False)
+        if hub:
+            result = hub.exec_run(
+                ["sh", "-c", f"hub.sh list && echo {HUB_DUMP_SEPARATOR} && wg show link0 dump"]
+            )
+            if result.exit_code != 0:
+                logger.warning("Failed to sample link hub: %s" % result.output.decode())
+                return
+            peers, dump_output = result.output.decode().split(f"{HUB_DUMP_SEPARATOR}\n", 1)
+            fqdns = {peer.pubkey: peer.fqdn for peer in parse_hub_peers(peers)}
+            for sample in parse_wg_dump(dump_output):
+                if sample.pubkey in fqdns:
+                    self.record(fqdns[sample.pubkey], sample, timestamp)
+
+    def idle_links(self, idle_after: float = DEFAULT_IDLE_AFTER) -> list[str]:
+        return sorted(fqdn for fqdn, series in self.series.items() if series.idle(idle_after))
+
+    def summary(
+        self, window: float = 5 * 60, idle_after: float = DEFAULT_IDLE_AFTER
+    ) -> list[dict[str, Any]]:
+        now = time.time()
+        data = []
+        for fqdn, series in sorted(self.series.items()):
+            latest = series.latest()
+            if not latest:
+                continue
+            _, rx, tx, handshake = latest
+            rx_rate, tx_rate = series.rates(window)
+            data.append(
+                {
+                    "fqdn": fqdn,
+                    "rx bytes": rx,
+                    "tx bytes": tx,
+                    "rx B/s": f"{rx_rate:.0f}",
+                    "tx B/s": f"{tx_rate:.0f}",
+                    "handshake age": f"{now - handshake:.0f}s" if handshake else "never",
+                    "stale handshake": not handshake or now - handshake > STALE_HANDSHAKE_AFTER,
+                    "idle": series.idle(idle_after, now),
+                }
+            )
+        return data
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "size": self.size,
+            "series": {fqdn: series.to_dict() for fqdn, series in self.series.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> "LinkMetricsCollector":
+        collector = cls(data.get("size", RING_SIZE))
+        collector.series = {
+            fqdn: LinkSeries.from_dict(series) for fqdn, series in data.get("series", {}).items()
+        }
+        return collector
+
+
+def load_collector() -> LinkMetricsCollector:
+    from fractal.cli.utils import data_dir
+
+    try:
+        with open(os.path.join(data_dir, METRICS_FILENAME)) as file:
+            return LinkMetricsCollector.from_dict(json.load(file))
+    except FileNotFoundError:
+        return LinkMetricsCollector()
+
+
+def save_collector(collector: LinkMetricsCollector) -> None:
+    from fractal.cli.utils import data_dir
+
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, METRICS_FILENAME)
+    # the metrics endpoint may be reading the file while it's replaced
+    with open(f"{path}.tmp", "w") as file:
+        json.dump(collector.to_dict(), file)
+    os.replace(f"{path}.tmp", path)
+
+
+def render_metrics(
+    collector: LinkMetricsCollector, idle_after: float = DEFAULT_IDLE_AFTER
+) -> str:
+    """
+    Renders the latest samples in the Prometheus text exposition format, one block (HELP,
+    TYPE and the samples of every link) per metric.
+    """
+    now = time.time()
+    families: dict[str, tuple[str, str, list[str]]] = {
+        "fractal_link_rx_bytes": ("counter", "Bytes received from the link's client.", []),
+        "fractal_link_tx_bytes": ("counter", "Bytes sent to the link's client.", []),
+        "fractal_link_handshake_age_seconds": (
+            "gauge",
+            "Seconds since the latest WireGuard handshake.",
+            [],
+        ),
+        "fractal_link_idle": ("gauge", "Whether the link had no traffic for the idle period.", []),
+    }
+
+    def sample(name: str, label: str, value: Any) -> None:
+        families[name][2].append(f"{name}{label} {value}")
+
+    for fqdn, series in sorted(collector.series.items()):
+        latest = series.latest()
+        if not latest:
+            continue
+        _, rx, tx, handshake = latest
+        label = f'{{link="{fqdn}"}}'
+        sample("fractal_link_rx_bytes", label, rx)
+        sample("fractal_link_tx_bytes", label, tx)
+        if handshake:
+            sample("fractal_link_handshake_age_seconds", label, f"{now - handshake:.0f}")
+        sample("fractal_link_idle", label, int(series.idle(idle_after, now)))
+
+    lines = []
+    for name, (metric_type, description, samples) in families.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
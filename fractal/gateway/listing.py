@@ -0,0 +1,88 @@
+"""
+Streaming output for the list commands.
+
+Rows come from `values()` querysets read with `iterator()`, so the database hands them over
+in chunks of `LIST_CHUNK_SIZE` (with a server-side cursor where the database supports it)
+instead of loading every row at once. The jsonl format prints each row as soon as it's
+read. The table and json formats need all rows of a page to lay them out, so for large
+lists use pages or jsonl.
+"""
+
+import json
+import sys
+from itertools import islice
+from typing import Any, Iterable, Iterator, Optional, TextIO, Union
+
+LIST_CHUNK_SIZE = 2000
+LIST_FORMATS = ("table", "json", "jsonl")
+
+
+def paginate(
+    rows, page: Union[str, int, None] = None, page_size: Union[str, int, None] = None
+):
+    """
+    Returns a page of `rows` (a queryset or a list), counting pages from 1. All rows without
+    a page size. Pages and page sizes may be given as strings, like CLI options are.
+
+    Raises:
+    - ValueError: if the page or page size isn't a number or is less than 1.
+    """
+    try:
+        page = int(page) if page not in (None, "") else None
+        page_size = int(page_size) if page_size not in (None, "") else None
+    except ValueError:
+        raise ValueError(f"Pages and page sizes must be numbers, got {page} and {page_size}")
+
+    if not page_size:
+        if page and page > 1:
+            raise ValueError("Pages other than the first need a page size")
+        return rows
+    page = 1 if page is None else page
+    if page < 1 or page_size < 1:
+        raise ValueError("Pages and page sizes start at 1")
+    return rows[(page - 1) * page_size : page * page_size]
+
+
+def iterate_rows(rows) -> Iterator[dict[str, Any]]:
+    if hasattr(rows, "iterator"):
+        return rows.iterator(chunk_size=LIST_CHUNK_SIZE)
+    return iter(rows)
+
+
+def display_rows(
+    rows: Iterable[dict[str, Any]],
+    title: str,
+    format: str = "table",
+    file: Optional[TextIO] = None,
+) -> int:
+    """
+    Displays rows in one of `LIST_FORMATS`.
+
+    Returns:
+    - int, the number of rows displayed.
+
+    Raises:
+    - ValueError: if the format isn't one of `LIST_FORMATS`.
+    """
+    if format not in LIST_FORMATS:
+        raise ValueError(f"Unknown format {format}. Options are: {', '.join(LIST_FORMATS)}")
+
+    if format != "jsonl":
+        from fractal.cli.fmt import display_data
+
+        data = list(rows)
+        if data:
+            display_data(data, title=title, format=format)
+        return len(data)
+
+    file = file or sys.stdout
+    count = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, LIST_CHUNK_SIZE))
+        if not chunk:
+            break
+        file.write("".join(json.dumps(row, default=str) + "\n" for row in chunk))
+        file.flush()
+        count += len(chunk)
+    return count
@@ -0,0 +1,38 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('fractal_database', '0001_initial'),
+        ('gateway', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='link',
+            name='placement_device',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='placed_links', to='fractal_database.device'),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='placement_policy',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='last_up_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='last_up_latency',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='link',
+            name='last_up_ok',
+            field=models.BooleanField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gateway', '0002_link_placement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='link',
+            name='mtu',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+def remove_duplicate_links(apps, schema_editor):
+    # concurrent creates could record a link twice. Keep the copy that was brought up
+    Link = apps.get_model("gateway", "Link")
+    seen = set()
+    links = Link.objects.order_by(
+        "domain_id",
+        "subdomain",
+        models.F("forward_port").asc(nulls_last=True),
+        models.F("last_up_at").desc(nulls_last=True),
+    )
+    for link in links:
+        key = (link.domain_id, link.subdomain)
+        if key in seen:
+            link.delete()
+        else:
+            seen.add(key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gateway', '0003_link_mtu'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_links, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='link',
+            constraint=models.UniqueConstraint(fields=('domain', 'subdomain'), name='gateway_link_unique_domain_subdomain'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gateway', '0004_link_unique_domain_subdomain'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='link',
+            name='served_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='aliases', to='gateway.link'),
+        ),
+    ]
@@ -1,18 +1,18 @@
+import asyncio
 import json
 import logging
 import os
 import sys
+import time
 import uuid
-from typing import TYPE_CHECKING, Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, Iterable, Optional, Union
 
-import docker
-import tldextract
-import yaml
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 from django.db import models, transaction
 from django.db.models import Q
-from docker.errors import NotFound
-from fractal_database import ssh
+from django.utils import timezone
 from fractal_database.fields import LocalManyToManyField
 from fractal_database.models import (
     DatabaseConfig,
@@ -21,23 +21,33 @@ from fractal_database.models import (
     ReplicatedModel,
     Service,
 )
-from fractal_database.replication.tasks import replicate_fixture
 
-from .tasks import link_up
-from .utils import (
-    GATEWAY_RESOURCE_PATH,
-    build_gateway_containers,
-    generate_link_compose_snippet,
+from .placement import (
+    HEALTH_RECORD_INTERVAL,
+    PlacementPolicy,
+    get_placement_policy,
+    place_link,
 )
+from .sharding import SHARDING_POLICY, GatewayPool, LinkMove, distribution
+
+# docker, tldextract, yaml, sh and the task broker are imported where they're used: this
+# module is loaded by every Django-backed command, including `fractal link list` and the
+# commands run over SSH on gateway devices, most of which never touch them
 
 if TYPE_CHECKING:
     from fractal_database.models import Database
     from fractal_database_matrix.models import MatrixReplicationChannel
 
     from .models import Gateway, Link
+    from .proxy import ProxyProfile
 
 logger = logging.getLogger(__name__)
 
+# links saved while a coalescing window is open, by primary key (see Link.acoalesce_saves)
+_pending_link_saves: ContextVar[Optional[dict[Any, tuple["Link", set[str]]]]] = ContextVar(
+    "pending_link_saves", default=None
+)
+
 
 class Domain(ReplicatedModel):
     links: models.QuerySet["Link"]
@@ -50,6 +60,9 @@ class Domain(ReplicatedModel):
 
 
 class Link(ReplicatedModel):
+    # up: brought up (has a forward port), failing: its last link up failed
+    STATES = ("up", "down", "failing")
+
     id = models.UUIDField(primary_key=True, editable=False, default=uuid.uuid4)
     # gateways = models.ManyToManyField("gateway.Gateway", related_name="links")
     domain = models.ForeignKey(Domain, on_delete=models.CASCADE, related_name="domains")
@@ -63,10 +76,175 @@ class Link(ReplicatedModel):
     subdomain = models.CharField(max_length=255)
     forward_port = models.CharField(max_length=5, null=True, blank=True)
 
+    # placement decision (see fractal.gateway.placement)
+    placement_device = models.ForeignKey(
+        "fractal_database.Device",
+        on_delete=models.SET_NULL,
+        related_name="placed_links",
+        null=True,
+        blank=True,
+    )
+    placement_policy = models.CharField(max_length=64, blank=True, default="")
+    last_up_at = models.DateTimeField(null=True, blank=True)
+    last_up_latency = models.FloatField(null=True, blank=True)
+    last_up_ok = models.BooleanField(null=True, blank=True)
+    # tunnel MTU the link's client measured, used for the link's next compose snippet
+    mtu = models.PositiveSmallIntegerField(null=True, blank=True)
+    # the link whose tunnel (and container) serves this one, for links that a multi-route
+    # client link serves. Aliases are placed (and rebalanced) together with it
+    served_by = models.ForeignKey(
+        "self", on_delete=models.SET_NULL, related_name="aliases", null=True, blank=True
+    )
+
     # TODO: needs an owner
 
+    class Meta:
+        constraints = [
+            # links are looked up by (domain, subdomain) on every create and up, the
+            # constraint's index serves those lookups
+            models.UniqueConstraint(
+                fields=["domain", "subdomain"], name="gateway_link_unique_domain_subdomain"
+            ),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # increment_version refreshes the instance, object_version is never dirty
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname) for field in self._meta.concrete_fields
+        }
+
+    def get_dirty_fields(self) -> list[str]:
+        """
+        Returns the names of the fields that changed since the link was loaded or saved. All
+        fields for links that were never saved.
+        """
+        loaded = getattr(self, "_loaded_values", None)
+        if self._state.adding or loaded is None:
+            return [field.name for field in self._meta.concrete_fields]
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if field.attname in loaded and getattr(self, field.attname) != loaded[field.attname]
+        ]
+
+    def save_changed(self) -> bool:
+        """
+        Saves the fields that changed, if any. Every save replicates the link, so links that
+        didn't change aren't saved.
+
+        Returns:
+        - bool, whether the link was saved (or queued in a coalescing window).
+        """
+        dirty = self.get_dirty_fields()
+        if not dirty:
+            return False
+
+        pending = _pending_link_saves.get()
+        if pending is not None and not self._state.adding:
+            _, fields = pending.get(self.pk, (self, set()))
+            pending[self.pk] = (self, fields | set(dirty))
+            return True
+
+        if self._state.adding:
+            self.save()
+        else:
+            self.save(update_fields=[*dirty, "date_modified"])
+        return True
+
+    async def asave_changed(self) -> bool:
+        return await sync_to_async(self.save_changed)()
+
+    @classmethod
+    @asynccontextmanager
+    async def acoalesce_saves(cls):
+        """
+        Holds back the link saves of `save_changed` until the window closes, then saves them
+        in one transaction. Replication is deferred until the transaction commits, once per
+        target, so the links of a batch are replicated in one event instead of one per link.
+        Link ups started in the window (i.e. with asyncio.gather) share it.
+        """
+        pending: dict[Any, tuple[Link, set[str]]] = {}
+        token = _pending_link_saves.set(pending)
+        try:
+            yield
+        finally:
+            _pending_link_saves.reset(token)
+            if pending:
+                await sync_to_async(cls._save_pending)(pending)
+
+    @staticmethod
+    def _save_pending(pending: dict[Any, tuple["Link", set[str]]]) -> None:
+        logger.info("Saving %s coalesced link updates" % len(pending))
+        with transaction.atomic():
+            for link, fields in pending.values():
+                link.save(update_fields=[*fields, "date_modified"])
+
+    @classmethod
+    def filter_links(
+        cls,
+        gateway: Optional[str] = None,
+        domain: Optional[str] = None,
+        state: Optional[str] = None,
+    ) -> models.QuerySet["Link"]:
+        """
+        Returns the links in a stable order, for listing them page by page.
+
+        Parameters:
+        - gateway: Optional[str], only links of domains served by this gateway (by id).
+        - domain: Optional[str], only links of this domain.
+        - state: Optional[str], only links in this state (see `STATES`).
+
+        Raises:
+        - ValueError: if the state isn't one of `STATES`.
+        """
+        links = cls.objects.order_by("domain__uri", "subdomain")
+        if gateway:
+            links = links.filter(
+                domain__in=Domain.objects.filter(devices__memberships__database=gateway)
+            )
+        if domain:
+            links = links.filter(domain__uri=domain)
+        if state == "up":
+            links = links.filter(forward_port__isnull=False)
+        elif state == "down":
+            links = links.filter(forward_port__isnull=True)
+        elif state == "failing":
+            links = links.filter(last_up_ok=False)
+        elif state:
+            raise ValueError(f"Unknown link state {state}. Options are: {', '.join(cls.STATES)}")
+        return links
+
+    @classmethod
+    def filter_fqdns(cls, fqdns: Iterable[str]) -> models.QuerySet["Link"]:
+        """
+        Returns the links with the given FQDNs, in a single query.
+        """
+        query = Q(pk__in=[])
+        for fqdn in fqdns:
+            # like get_by_url, the subdomain is the first label of the FQDN
+            query |= Q(subdomain="", domain__uri=fqdn)
+            if "." in fqdn:
+                subdomain, domain = fqdn.split(".", 1)
+                query |= Q(subdomain=subdomain, domain__uri=domain)
+        return cls.objects.filter(query).select_related("domain")
+
+    @classmethod
+    def get_state(cls, forward_port: Optional[str], last_up_ok: Optional[bool]) -> str:
+        if last_up_ok is False:
+            return "failing"
+        return "up" if forward_port else "down"
+
     @classmethod
     def get_by_url(cls, url: str, select_related: Optional[list[str]] = None) -> "Link":
+        import tldextract
+
         extracted_url = tldextract.extract(url)
         # registered_domains have the domain + suffix joined together.
         # some domains like localhost don't have a registered domain (dont have a suffix)
@@ -87,6 +265,8 @@ class Link(ReplicatedModel):
 
     @classmethod
     async def aget_by_url(cls, url: str, select_related: Optional[list[str]] = None) -> "Link":
+        import tldextract
+
         extracted_url = tldextract.extract(url)
         # registered_domains have the domain + suffix joined together.
         # some domains like localhost don't have a registered domain (dont have a suffix)
@@ -114,19 +294,27 @@ class Link(ReplicatedModel):
             return self.domain.uri
         return f"{self.subdomain}.{self.domain.uri}"
 
-    async def _up_local(self, tcp_forwarding: bool) -> tuple[str, str, str, str]:
+    async def _up_local(self, tcp_forwarding: bool) -> dict[str, Any]:
+        from .tasks import link_up
+
         return await link_up(
             self.fqdn, tcp_forwarding=tcp_forwarding, forward_port=self.forward_port
         )
 
     def _up_via_ssh(
-        self, gateway: "Gateway", device: "Device", tcp_forwarding: bool = False
-    ) -> tuple[str, str, str, str]:
-        link_up_command = f"fractal link up {str(gateway.pk)} {self.fqdn}"
-        if tcp_forwarding:
-            link_up_command += " --tcp-forwarding"
-        if self.forward_port:
-            link_up_command += f" --forward-port {self.forward_port}"
+        self,
+        gateway: "Gateway",
+        device: "Device",
+        tcp_forwarding: bool = False,
+        aliases: Optional[list[str]] = None,
+    ) -> Union[dict[str, Any], list[str]]:
+        from fractal_database import ssh
+
+        from .utils import get_link_up_command
+
+        link_up_command = get_link_up_command(
+            str(gateway.pk), self.fqdn, tcp_forwarding, self.forward_port, aliases
+        )
 
         ssh_config = device.ssh_config
         try:
@@ -135,128 +323,416 @@ class Link(ReplicatedModel):
             print(f"Error when running link up: {err.stderr.decode()}")
             raise err
 
+        # devices running an older fractal print the link config comma separated
+        if result.startswith("{"):
+            return json.loads(result)
         return result.split(",")
 
+    @classmethod
+    def hosted_fqdns(
+        cls, device: Optional["Device"] = None, brought_up: bool = False
+    ) -> list[str]:
+        """
+        Returns the FQDNs of the links that `device` should host: links placed on it and
+        links that haven't been placed. Without a device, all links.
+
+        Parameters:
+        - brought_up: Bool, only links that were brought up (have a forward port).
+        """
+        links = cls.objects.all()
+        if brought_up:
+            links = links.filter(forward_port__isnull=False)
+        if device:
+            links = links.filter(Q(placement_device__isnull=True) | Q(placement_device=device))
+        return [
+            f"{subdomain}.{uri}" if subdomain else uri
+            for subdomain, uri in links.values_list("subdomain", "domain__uri")
+        ]
+
+    async def _down_on_device(self, gateway: "Gateway", device: "Device") -> None:
+        from fractal_database import ssh
+
+        from .tasks import link_down
+        from .utils import get_link_down_command
+
+        if device.ssh_config:
+            ssh_config = device.ssh_config
+            try:
+                ssh(
+                    ssh_config["host"],
+                    "-p",
+                    ssh_config["port"],
+                    get_link_down_command([self.fqdn]),
+                )
+            except Exception as err:
+                print(f"Error when running link down: {err.stderr.decode()}")
+                raise err
+            return
+
+        if self.gateway_is_local(gateway) and await self._is_current_device(device):
+            await link_down(self.fqdn)
+            return
+
+        channel: Optional["MatrixReplicationChannel"] = await gateway.matrixreplicationchannel_set.afirst()  # type: ignore
+        if not channel:
+            raise Exception(f"Gateway {gateway.name} does not have a matrix replication channel")
+
+        task = await channel.kick_task(
+            link_down,
+            self.fqdn,
+            task_labels={"device": device.name},
+            as_user=True,
+        )
+        result = await task.wait_result(timeout=120.0)
+        if result.is_err:
+            raise Exception(f"Error when running link down: {result.err}")
+
+    async def down(self, gateway: "Gateway") -> None:
+        """
+        Takes the link down on the gateway device it was placed on (or on every device that
+        serves its domain if it wasn't placed). Its forward port is released so that it can
+        be allocated to another link.
+        """
+        if self.placement_device_id:
+            devices = [await Device.objects.aget(pk=self.placement_device_id)]
+        else:
+            devices = [
+                membership.device
+                async for membership in gateway.device_memberships.select_related("device")
+                .filter(device__domains__pk=self.domain_id)
+                .distinct()
+            ]
+
+        for device in devices:
+            await self._down_on_device(gateway, device)
+
+        self.forward_port = None
+        await self.asave_changed()
+
     def gateway_is_local(self, gateway: "Gateway") -> bool:
-        client = docker.from_env()
-        return len(client.containers.list(filters={"label": f"f.gateway={str(gateway.pk)}"})) > 0
+        import docker
 
-    async def up(self, gateway: "Gateway", tcp_forwarding: bool = False) -> tuple[str, str, str]:
-        # get a device membership where the device has ssh_config to gateway
-        membership = (
-            await gateway.device_memberships.select_related("device")
-            .prefetch_related("device__domains")
-            .filter(~Q(device__ssh_config={}), device__domains__pk=self.domain.pk)
-            .afirst()
+        from .inventory import GATEWAY_LABEL, get_inventory
+
+        inventory = get_inventory()
+        if inventory:
+            return len(inventory.list(GATEWAY_LABEL, str(gateway.pk))) > 0
+
+        client = docker.from_env()
+        return (
+            len(client.containers.list(filters={"label": f"{GATEWAY_LABEL}={str(gateway.pk)}"}))
+            > 0
         )
-        # link up via ssh if a device with ssh_config to gateway is found
-        if membership:
-            gateway_link_public_key, link_address, client_private_key, forward_port = (
-                self._up_via_ssh(gateway, membership.device, tcp_forwarding=tcp_forwarding)
+
+    async def _is_current_device(self, device: "Device") -> bool:
+        try:
+            current_device = await sync_to_async(Device.current_device)()
+        except Exception:
+            # without a current device there is only the local gateway to go by
+            return True
+        return current_device.pk == device.pk
+
+    async def _up_on_device(
+        self,
+        gateway: "Gateway",
+        device: "Device",
+        tcp_forwarding: bool = False,
+        aliases: Optional[list[str]] = None,
+    ) -> Union[dict[str, Any], list[str]]:
+        from .tasks import link_up
+
+        # link up via ssh if the device has an ssh_config
+        if device.ssh_config:
+            # off the event loop, so that concurrent link ups (see build_compose) overlap
+            return await sync_to_async(self._up_via_ssh, thread_sensitive=False)(
+                gateway, device, tcp_forwarding=tcp_forwarding, aliases=aliases
             )
 
         # link_up directly if the gateway is local
-        elif self.gateway_is_local(gateway):
-            gateway_link_public_key, link_address, client_private_key, forward_port = (
-                await link_up(
-                    self.fqdn, tcp_forwarding=tcp_forwarding, forward_port=self.forward_port
-                )
+        if self.gateway_is_local(gateway) and await self._is_current_device(device):
+            return await link_up(
+                self.fqdn,
+                tcp_forwarding=tcp_forwarding,
+                forward_port=self.forward_port,
+                aliases=aliases,
             )
 
         # link_up via a matrix replication channel if the gateway is remote
         # and has a matrix replication channel
-        else:
-            channel: Optional["MatrixReplicationChannel"] = await gateway.matrixreplicationchannel_set.afirst()  # type: ignore
-            if not channel:
-                raise Exception(
-                    f"Gateway {gateway.name} does not have a matrix replication channel"
-                )
+        channel: Optional["MatrixReplicationChannel"] = await gateway.matrixreplicationchannel_set.afirst()  # type: ignore
+        if not channel:
+            raise Exception(f"Gateway {gateway.name} does not have a matrix replication channel")
 
-            # fetch a device membership where the device has this link's domain in its domains
-            membership = (
-                await gateway.device_memberships.select_related("device")
-                .prefetch_related("device__domains")
-                .filter(device__domains__pk=self.domain.pk)
-                .afirst()
-            )
-            if not membership:
-                raise Exception(
-                    f"Could not find a device for gateway {gateway.name} that serves the fqdn {self.fqdn}"
-                )
+        task_labels = {
+            "device": device.name,
+        }
 
-            task_labels = {
-                "device": membership.device.name,
-            }
+        logger.info(
+            "Kicking link up task for %s to device %s to channel %s",
+            self.fqdn,
+            device.name,
+            channel,
+        )
+        # gateway devices running an older fractal have a link_up task without aliases, only
+        # multi-route link ups pass them (like _up_via_ssh only adds --aliases when set)
+        task_kwargs = {"aliases": aliases} if aliases else {}
+        # kick link up task as user to the gateway device
+        task = await channel.kick_task(
+            link_up,
+            self.fqdn,
+            tcp_forwarding,
+            self.forward_port,
+            task_labels=task_labels,
+            as_user=True,
+            **task_kwargs,
+        )
+        logger.info("Waiting for %s link up result for up to 2 minutes..." % self.fqdn)
+        result = await task.wait_result(timeout=120.0)
+        logger.info("Link up for %s took %s seconds" % (self.fqdn, result.execution_time))
 
-            logger.info(
-                "Kicking link up task for %s to device %s to channel %s",
-                self.fqdn,
-                membership.device.name,
-                channel,
-            )
-            # kick link up task as user to the gateway device
-            task = await channel.kick_task(
-                link_up,
-                self.fqdn,
-                tcp_forwarding,
-                self.forward_port,
-                task_labels=task_labels,
-                as_user=True,
-            )
-            logger.info("Waiting for %s link up result for up to 2 minutes..." % self.fqdn)
-            result = await task.wait_result(timeout=120.0)
-            logger.info("Link up for %s took %s seconds" % (self.fqdn, result.execution_time))
+        if result.is_err:
+            raise Exception(f"Error when running link up: {result.err}")
+
+        return result.return_value
+
+    async def up(self, gateway: "Gateway", tcp_forwarding: bool = False) -> tuple[str, str, str]:
+        link_config = await self.aget_link_config(gateway, tcp_forwarding=tcp_forwarding)
+        return (
+            link_config["gateway_link_public_key"],
+            link_config["link_address"],
+            link_config["client_private_key"],
+        )
+
+    async def aget_link_config(
+        self,
+        gateway: "Gateway",
+        tcp_forwarding: bool = False,
+        aliases: Optional[list["Link"]] = None,
+    ) -> dict[str, Any]:
+        """
+        Brings the link up on the gateway and returns the configuration its client needs.
+
+        Parameters:
+        - aliases: Optional[list[Link]], other links that the client serves through this
+            link's tunnel (a multi-route client link). They are placed on the same device.
 
-            if result.is_err:
-                raise Exception(f"Error when running link up: {result.err}")
+        Returns:
+        - Dict, with the keys gateway_link_public_key, link_address, client_private_key,
+            tunnel_address (only set for links hosted by the gateway's link hub) and mtu (the
+            tunnel MTU the link's client measured, if it reported one).
+        """
+        aliases = aliases or []
+        # fqdn reads the alias' domain, which may not be loaded yet
+        alias_fqdns = await sync_to_async(lambda: [alias.fqdn for alias in aliases])()
+
+        # place the link on one of the gateway's devices that serve its domain (and the
+        # domains of its aliases)
+        memberships = gateway.device_memberships.select_related("device").filter(
+            device__domains__pk=self.domain_id
+        )
+        for alias in aliases:
+            memberships = memberships.filter(device__domains__pk=alias.domain_id)
+        devices = [membership.device async for membership in memberships.distinct()]
+        if not devices:
+            raise Exception(
+                f"Could not find a device for gateway {gateway.name} that serves the fqdn {self.fqdn}"
+            )
+        device = await sync_to_async(place_link)(self, devices, gateway.get_placement_policy())
 
-            gateway_link_public_key, link_address, client_private_key, forward_port = (
-                result.return_value
+        started = time.monotonic()
+        try:
+            result = await self._up_on_device(
+                gateway, device, tcp_forwarding, aliases=alias_fqdns or None
             )
+        except Exception:
+            # failed link ups count against the device's health for future placements
+            self.last_up_at = timezone.now()
+            self.last_up_ok = False
+            await self.asave_changed()
+            raise
+
+        result = self._parse_link_up_result(result)
+        if result["mtu"]:
+            self.mtu = int(result["mtu"])
 
         # save forward port to the link for subsequent use
-        self.forward_port = forward_port
-        await self.asave()
+        self.forward_port = result["forward_port"] or None
+        # brought up with a tunnel of its own, it's no longer another link's alias
+        self.served_by = None
+        now = timezone.now()
+        if (
+            self.last_up_ok is not True
+            or not self.last_up_at
+            or now - self.last_up_at >= HEALTH_RECORD_INTERVAL
+        ):
+            self.last_up_at = now
+            self.last_up_latency = time.monotonic() - started
+            self.last_up_ok = True
+        await self.asave_changed()
+
+        # aliases ride this link's tunnel, they have no container or forward port of their own
+        for alias in aliases:
+            alias.served_by = self
+            alias.placement_device = device
+            alias.placement_policy = self.placement_policy
+            alias.forward_port = None
+            await alias.asave_changed()
+
+        return {
+            "gateway_link_public_key": result["gateway_link_public_key"],
+            "link_address": result["link_address"],
+            "client_private_key": result["client_private_key"],
+            "tunnel_address": result["tunnel_address"],
+            "mtu": self.mtu,
+        }
 
-        return (gateway_link_public_key, link_address, client_private_key)
+    @staticmethod
+    def _parse_link_up_result(result: Union[dict[str, Any], list[str], tuple]) -> dict[str, Any]:
+        """
+        Returns the result of the link_up task as a dict (see fractal.gateway.tasks.link_up).
+        Devices running an older fractal return it as a sequence: gateway_link_public_key,
+        link_address, client_private_key, forward_port[, tunnel_address[, mtu]].
+        """
+        if isinstance(result, dict):
+            return {"forward_port": None, "tunnel_address": None, "mtu": None, **result}
 
-    def generate_compose_snippet(
-        self, gateway: "Gateway", expose: str, tcp_forwarding: bool = False
-    ) -> str:
-        gateway_link_public_key, link_address, client_private_key = async_to_sync(self.up)(
-            gateway, tcp_forwarding=tcp_forwarding
-        )
-        if "localhost" in link_address:
-            _, port = link_address.split(":")
-            link_address = f"host.docker.internal:{port}"
-
-        new_forwarding = False
-        if expose.startswith("tcp://"):
-            expose = expose.replace("tcp://", "").split(":", maxsplit=1)[1]
-            new_forwarding = True
-        elif expose.startswith("udp://"):
-            expose = expose.replace("udp://", "").split(":", maxsplit=1)[1]
-            new_forwarding = True
-
-        link_config = {
+        gateway_link_public_key, link_address, client_private_key, forward_port, *rest = result
+        return {
             "gateway_link_public_key": gateway_link_public_key,
             "link_address": link_address,
             "client_private_key": client_private_key,
+            "forward_port": forward_port or None,
+            "tunnel_address": rest[0] or None if rest else None,
+            "mtu": rest[1] or None if len(rest) > 1 else None,
         }
 
+    @staticmethod
+    def _client_expose(expose: str) -> tuple[str, bool]:
+        """
+        Returns:
+        - tuple[expose, new_forwarding], the address the client link forwards to and whether
+            it forwards TCP and UDP (tcp:// and udp:// exposes) instead of proxying HTTP.
+        """
+        for scheme in ("tcp://", "udp://"):
+            if expose.startswith(scheme):
+                return expose.replace(scheme, "").split(":", maxsplit=1)[1], True
+        return expose, False
+
+    @staticmethod
+    def _client_link_config(link_config: dict[str, Any]) -> dict[str, Any]:
+        # client links next to a local gateway reach it through the Docker host
+        if "localhost" in link_config["link_address"]:
+            _, port = link_config["link_address"].split(":")
+            return {**link_config, "link_address": f"host.docker.internal:{port}"}
+        return link_config
+
+    def generate_compose_snippet(
+        self,
+        gateway: "Gateway",
+        expose: str,
+        tcp_forwarding: bool = False,
+        profile: Union[str, "ProxyProfile", None] = None,
+        routes: Optional[dict["Link", str]] = None,
+    ) -> str:
+        """
+        Brings the link up and returns the docker-compose snippet of its client link service.
+
+        Parameters:
+        - routes: Optional[dict[Link, str]], other links and the services they expose. The
+            snippet's link service then serves all of them through this link's tunnel, with
+            a single Caddy instance, instead of running a link service per link.
+        """
+        from .utils import generate_link_compose_snippet
+
+        routes = routes or {}
+        if routes and (tcp_forwarding or expose.startswith(("tcp://", "udp://"))):
+            raise ValueError("Links with TCP or UDP forwarding can't serve other links")
+
+        link_config = async_to_sync(self.aget_link_config)(
+            gateway, tcp_forwarding=tcp_forwarding, aliases=list(routes)
+        )
+        expose, new_forwarding = self._client_expose(expose)
+
         return generate_link_compose_snippet(
-            link_config,
+            self._client_link_config(link_config),
             self.fqdn,
             expose,
             new_forwarding=new_forwarding,
+            profile=profile,
+            routes={link.fqdn: link_expose for link, link_expose in routes.items()},
         )
 
+    @classmethod
+    def build_compose(
+        cls,
+        deployments: Iterable[tuple["Link", "Gateway", str]],
+        tcp_forwarding: bool = False,
+        profile: Union[str, "ProxyProfile", None] = None,
+    ) -> dict[str, Any]:
+        """
+        Brings several links up at once and returns a docker-compose document with a client
+        link service (and certificate volume) for each of them. The link ups run concurrently,
+        so this takes about as long as the slowest of them.
+
+        Parameters:
+        - deployments: Iterable[tuple[Link, Gateway, str]], the links with the gateway to bring
+            them up on and the service they expose.
+
+        Returns:
+        - Dict, the compose document with the keys services and volumes.
+        """
+        from .utils import build_link_service, get_link_container_name
+
+        deployments = list(deployments)
+
+        async def get_link_configs():
+            # the links' updates are replicated together once all of them are up
+            async with cls.acoalesce_saves():
+                return await asyncio.gather(
+                    *(
+                        link.aget_link_config(gateway, tcp_forwarding=tcp_forwarding)
+                        for link, gateway, _ in deployments
+                    )
+                )
+
+        link_configs = async_to_sync(get_link_configs)()
+
+        services, volumes = {}, {}
+        for (link, _, expose), link_config in zip(deployments, link_configs):
+            name = f"link-{get_link_container_name(link.fqdn)}"
+            expose, new_forwarding = cls._client_expose(expose)
+            services[name] = build_link_service(
+                cls._client_link_config(link_config),
+                link.fqdn,
+                expose,
+                new_forwarding=new_forwarding,
+                profile=profile,
+                volume=f"{name}-data",
+            )
+            volumes[f"{name}-data"] = {}
+        return {"services": services, "volumes": volumes}
+
+    @classmethod
+    def generate_compose(
+        cls,
+        deployments: Iterable[tuple["Link", "Gateway", str]],
+        tcp_forwarding: bool = False,
+        profile: Union[str, "ProxyProfile", None] = None,
+    ) -> str:
+        """
+        Returns the YAML of `build_compose`.
+        """
+        from .utils import dump_compose
+
+        return dump_compose(cls.build_compose(deployments, tcp_forwarding, profile))
+
 
 class Gateway(Service):
     links: models.QuerySet[Link]
     # homeservers: "models.QuerySet[MatrixHomeserver]"
     COMPOSE_FILE = os.environ.get(
-        "GATEWAY_COMPOSE_PATH", f"{GATEWAY_RESOURCE_PATH}/docker-compose.yml"
+        "GATEWAY_COMPOSE_PATH",
+        os.path.join(os.path.dirname(__file__), "resources", "docker-compose.yml"),
     )
 
     # FIXME: MOVE TO DATABASE
@@ -325,17 +801,20 @@ class Gateway(Service):
                 return gateway_service
 
     def _create_gateway_docker_network(self) -> None:
-        client = docker.from_env()
-        try:
-            network = client.networks.get("fractal-gateway-network")  # type: ignore
-        except NotFound:
-            network = client.networks.create("fractal-gateway-network", driver="bridge")  # type: ignore
-        return network
+        import docker
+
+        from .utils import create_gateway_network
+
+        return create_gateway_network(docker.from_env())
 
     def _build_containers(self) -> None:
+        from .utils import build_gateway_containers
+
         return build_gateway_containers()
 
     def _render_compose_file(self) -> str:
+        import yaml
+
         # ensure docker network for gateway is created
         self._create_gateway_docker_network()
 
@@ -348,14 +827,11 @@ class Gateway(Service):
         return yaml.dump(compose_file)
 
     def get_domain(self, domain: str) -> Domain:
-        return Domain.objects.prefetch_related(
-            "devices__memberships", "devices__memberships__database"
-        ).get(uri=domain, devices__memberships__database=self)
+        # distinct: a domain served by several of the gateway's devices joins once per device
+        return self.get_domains().get(uri=domain)
 
     def get_domains(self) -> models.QuerySet[Domain]:
-        return Domain.objects.prefetch_related(
-            "devices__memberships", "devices__memberships__database"
-        ).filter(devices__memberships__database=self)
+        return Domain.objects.filter(devices__memberships__database=self).distinct()
 
     def _create_link_via_ssh(
         self, domain: Domain, subdomain: str, device: "Device", override_link: bool = False
@@ -364,6 +840,8 @@ class Gateway(Service):
         Intended to be run when the gateway is being interacted with remotely.
         """
         from fractal.gateway.models import Link
+        from fractal_database import ssh
+        from fractal_database.replication.tasks import replicate_fixture
 
         ssh_host = device.ssh_config["host"]
         ssh_port = device.ssh_config["port"]  # type: ignore
@@ -404,32 +882,141 @@ class Gateway(Service):
                     )
             except Link.DoesNotExist:
                 # get all devices that have the fqdn
-                memberships = (
-                    self.device_memberships.prefetch_related("device__domains")
-                    .select_related("device")
-                    .filter(device__domains__pk=domain.pk)
-                )
-                if not memberships.exists():
+                devices = [
+                    membership.device
+                    for membership in self.device_memberships.select_related("device").filter(
+                        device__domains__pk=domain.pk
+                    )
+                ]
+                if not devices:
                     raise Exception(
                         f"Gateway {self} does not have any devices that serve domain {domain}"
                     )
 
-                # if any memberships that have devices with ssh_config, create the link by sshing to that device
-                membership_with_ssh_config = memberships.filter(~Q(device__ssh_config={})).first()
+                # place the link on one of the devices. If it has an ssh_config, create the
+                # link by sshing to that device
+                placed = Link(domain=domain, subdomain=subdomain)
+                device = place_link(placed, devices)
 
-                if membership_with_ssh_config:
+                if device.ssh_config:
                     link = self._create_link_via_ssh(
                         domain,
                         subdomain,
-                        membership_with_ssh_config.device,
+                        device,
                         override_link=override_link,
                     )
+                    link.placement_device = placed.placement_device
+                    link.placement_policy = placed.placement_policy
+                    link.save()
                 else:
-                    link = Link.objects.create(domain=domain, subdomain=subdomain)
+                    link = placed
+                    link.save()
 
             # link.gateways.add(self)
             return link
 
+    def get_placement_policy(self) -> PlacementPolicy:
+        """
+        Returns the policy that places this gateway's links on its devices. Sharded gateways
+        use consistent hashing (see fractal.gateway.sharding).
+        """
+        return get_placement_policy(self.metadata.get("placement_policy"))
+
+    def get_links(self) -> models.QuerySet[Link]:
+        return Link.objects.filter(domain__in=self.get_domains()).select_related(
+            "domain", "placement_device"
+        )
+
+    def get_hosts(self) -> models.QuerySet[Device]:
+        """
+        Returns the gateway's devices that host links: members of the gateway that serve at
+        least one of its domains. Client and user devices are members too, but host nothing.
+        """
+        return Device.objects.filter(
+            memberships__database=self, domains__in=self.get_domains()
+        ).distinct()
+
+    def get_link_distribution(self) -> dict[str, int]:
+        """
+        Returns the number of links placed on each of the gateway's hosts.
+        """
+        names = {device.pk: device.name for device in self.get_hosts()}
+        assignments = {
+            link.fqdn: (
+                names.get(link.placement_device_id, str(link.placement_device_id))
+                if link.placement_device_id
+                else None
+            )
+            for link in self.get_links()
+        }
+        return distribution(assignments, hosts=names.values())
+
+    def rebalance_links(self, apply: bool = False) -> list[tuple[Link, LinkMove]]:
+        """
+        Assigns the gateway's links to its devices by consistent hashing on their FQDN. Only
+        links whose device changed are moved. Links are pooled by the domains they need a
+        device to serve: their own and those of their aliases. Aliases (links served by
+        another link's tunnel) aren't hashed, they move to their primary's device.
+
+        Parameters:
+        - apply: Bool, whether to record the new placements and shard new links from now on.
+            Moved links are brought up on their new device the next time they are brought up.
+
+        Returns:
+        - list[tuple[Link, LinkMove]], the links that move.
+        """
+        links = list(self.get_links())
+        by_pk = {link.pk: link for link in links}
+        aliases: dict[Any, list[Link]] = {}
+        for link in links:
+            if link.served_by_id in by_pk:
+                aliases.setdefault(link.served_by_id, []).append(link)
+
+        def device_key(link: Link) -> Optional[str]:
+            return str(link.placement_device_id) if link.placement_device_id else None
+
+        # primaries (and links without aliases) by the domains their device has to serve
+        pools: dict[frozenset, list[Link]] = {}
+        for link in links:
+            if link.served_by_id not in by_pk:
+                domains = {link.domain_id}
+                domains.update(alias.domain_id for alias in aliases.get(link.pk, []))
+                pools.setdefault(frozenset(domains), []).append(link)
+
+        moves = []
+        for domains, primaries in pools.items():
+            devices = Device.objects.filter(memberships__database=self)
+            for domain_id in domains:
+                devices = devices.filter(domains__pk=domain_id)
+            pool = GatewayPool(str(pk) for pk in devices.distinct().values_list("pk", flat=True))
+            if not pool.hosts:
+                continue
+            pool_links = {link.fqdn: link for link in primaries}
+            assignments = {fqdn: device_key(link) for fqdn, link in pool_links.items()}
+            targets = dict(assignments)
+            for move in pool.plan(assignments):
+                moves.append((pool_links[move.fqdn], move))
+                targets[move.fqdn] = move.target
+
+            # aliases follow their primary, even if only the alias was placed elsewhere
+            for fqdn, link in pool_links.items():
+                for alias in aliases.get(link.pk, []):
+                    source = device_key(alias)
+                    if source != targets[fqdn]:
+                        move = LinkMove(fqdn=alias.fqdn, source=source, target=targets[fqdn])
+                        moves.append((alias, move))
+
+        if apply:
+            with transaction.atomic():
+                for link, move in moves:
+                    link.placement_device_id = move.target
+                    link.placement_policy = SHARDING_POLICY
+                    link.save_changed()
+                self.metadata["placement_policy"] = SHARDING_POLICY
+                self.save()
+
+        return moves
+
     @classmethod
     def get_or_create_service(cls, database: "Database") -> tuple["Gateway", bool]:
         try:
@@ -0,0 +1,129 @@
+"""
+Sharded Docker networks for the gateway's link containers.
+
+A Linux bridge and Docker's embedded DNS slow down as the number of containers on a network
+grows. Link containers are spread across `NETWORK_SHARDS` bridge networks by a hash of their
+FQDN, and the gateway container is attached to all of them so it reaches (and resolves) every
+link. Shard 0 is the original `fractal-gateway-network`, which also carries the gateway, the
+link hub and the links of gateways without sharding.
+
+Shard networks are created when the first link lands on them. The gateway is attached to the
+shard networks whenever routes are published, so a gateway container that was recreated (i.e.
+by `docker compose up`) gets its networks back before it is pointed at links on them.
+"""
+
+import hashlib
+import logging
+import os
+from typing import TYPE_CHECKING, Optional
+
+from docker.errors import APIError
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.containers import Container
+    from docker.models.networks import Network
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_NETWORK_NAME = "fractal-gateway-network"
+GATEWAY_NETWORK_LABEL = "f.gateway.network"
+# every bridge takes a subnet out of Docker's address pools, which only have room for ~30
+MAX_NETWORK_SHARDS = 16
+NETWORK_SHARDS = min(
+    int(os.environ.get("FRACTAL_GATEWAY_NETWORK_SHARDS", "4")), MAX_NETWORK_SHARDS
+)
+
+
+def get_network_shard(link_fqdn: str, shards: Optional[int] = None) -> int:
+    shards = max(shards or NETWORK_SHARDS, 1)
+    digest = hashlib.sha1(link_fqdn.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % shards
+
+
+def get_shard_network_name(shard: int) -> str:
+    if shard == 0:
+        return GATEWAY_NETWORK_NAME
+    return f"{GATEWAY_NETWORK_NAME}-{shard}"
+
+
+def find_network(name: str, client: "DockerClient") -> Optional["Network"]:
+    # inspecting a network lists all of its containers, the list endpoint doesn't. The name
+    # filter matches substrings
+    for network in client.networks.list(names=[name]):
+        if network.name == name:
+            return network  # type: ignore
+    return None
+
+
+def list_gateway_networks(client: "DockerClient") -> list["Network"]:
+    """
+    Returns the gateway's networks, shard 0 first.
+    """
+    networks = {
+        network.name: network
+        for network in client.networks.list(filters={"label": GATEWAY_NETWORK_LABEL})
+    }
+    if GATEWAY_NETWORK_NAME not in networks:
+        # created by the compose file or an older version, without the label
+        network = find_network(GATEWAY_NETWORK_NAME, client)
+        if network:
+            networks[GATEWAY_NETWORK_NAME] = network
+    return sorted(networks.values(), key=lambda network: network.name != GATEWAY_NETWORK_NAME)
+
+
+def connect_gateway(
+    gateway: "Container", client: "DockerClient", networks: Optional[list["Network"]] = None
+) -> list[str]:
+    """
+    Attaches the gateway container to the gateway networks it isn't attached to yet.
+
+    Returns:
+    - list[str], the names of the networks the gateway was attached to.
+    """
+    networks = networks if networks is not None else list_gateway_networks(client)
+    attached = set(gateway.attrs.get("NetworkSettings", {}).get("Networks") or {})
+    connected = []
+    for network in networks:
+        if network.name in attached:
+            continue
+        logger.info("Attaching gateway %s to network %s" % (gateway.name, network.name))
+        try:
+            network.connect(gateway)
+        except APIError as err:
+            # attached concurrently
+            if "already exists" not in str(err):
+                raise
+        connected.append(network.name)
+    return connected
+
+
+def get_shard_network(shard: int, client: "DockerClient") -> Optional["Network"]:
+    """
+    Returns the network of a shard, creating it and attaching the gateway containers to it if
+    it doesn't exist yet. Shard 0 isn't created here, it comes with the gateway.
+
+    Returns:
+    - Optional[Network], None for shard 0 if the gateway's network doesn't exist.
+    """
+    name = get_shard_network_name(shard)
+    network = find_network(name, client)
+    if network or shard == 0:
+        return network
+
+    from fractal.gateway.inventory import GATEWAY_LABEL
+
+    logger.info("Creating gateway network shard %s" % name)
+    try:
+        network = client.networks.create(  # type: ignore
+            name, driver="bridge", labels={GATEWAY_NETWORK_LABEL: str(shard)}
+        )
+    except APIError:
+        # created concurrently
+        network = find_network(name, client)
+        if not network:
+            raise
+
+    for gateway in client.containers.list(filters={"label": GATEWAY_LABEL}):
+        connect_gateway(gateway, client, networks=[network])  # type: ignore
+    return network
@@ -0,0 +1,222 @@
+"""
+Placement of links on the devices of a Gateway.
+
+When a Gateway has several devices that serve a link's domain, a placement policy picks the
+device that hosts the link. Policies only see `Candidate`s (a device with its current link
+count, recent link up latency and health) so they are easy to add and to test:
+
+    @register_placement_policy("random")
+    class RandomPolicy(PlacementPolicy):
+        def choose(self, fqdn, candidates):
+            return random.choice(candidates)
+
+The policy is selected with `FRACTAL_GATEWAY_PLACEMENT_POLICY` (defaults to least-links).
+"""
+
+import bisect
+import hashlib
+import logging
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Optional, Type
+
+if TYPE_CHECKING:
+    from fractal.gateway.models import Link
+    from fractal_database.models import Device
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLACEMENT_POLICY = "least-links"
+# link ups within this window count towards a device's latency and health
+RECENT_WINDOW = timedelta(hours=1)
+# successful link ups of a healthy link are recorded at most this often, so that re-ups of
+# unchanged links don't save (and replicate) the link
+HEALTH_RECORD_INTERVAL = timedelta(minutes=5)
+# a device with this many failed link ups in the window is considered unhealthy
+UNHEALTHY_FAILURES = 3
+# virtual nodes per device on the hash ring, evens out the share of each device
+RING_REPLICAS = 128
+
+
+@dataclass
+class Candidate:
+    key: str
+    link_count: int = 0
+    # average seconds a link up took on the device recently, None if unknown
+    latency: Optional[float] = None
+    healthy: bool = True
+    device: Any = None
+
+
+class HashRing:
+    """
+    Consistent hash ring. Adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = RING_REPLICAS):
+        self.replicas = replicas
+        self._hashes: list[int] = []
+        self._nodes: dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+    def add(self, node: str) -> None:
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if point in self._nodes:
+                continue
+            bisect.insort(self._hashes, point)
+            self._nodes[point] = node
+
+    def remove(self, node: str) -> None:
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            if self._nodes.get(point) == node:
+                del self._nodes[point]
+                self._hashes.remove(point)
+
+    @property
+    def nodes(self) -> set[str]:
+        return set(self._nodes.values())
+
+    def get(self, key: str) -> Optional[str]:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._hashes)
+        return self._nodes[self._hashes[index]]
+
+
+class PlacementPolicy:
+    name: str = ""
+
+    def choose(self, fqdn: str, candidates: list[Candidate]) -> Candidate:
+        raise NotImplementedError()
+
+    def place(self, fqdn: str, candidates: list[Candidate]) -> Candidate:
+        """
+        Chooses among the healthy candidates, or among all of them if none is healthy.
+        """
+        if not candidates:
+            raise ValueError(f"No candidate devices to place {fqdn} on")
+        healthy = [candidate for candidate in candidates if candidate.healthy]
+        return self.choose(fqdn, healthy or candidates)
+
+
+PLACEMENT_POLICIES: dict[str, Type[PlacementPolicy]] = {}
+
+
+def register_placement_policy(
+    name: str,
+) -> Callable[[Type[PlacementPolicy]], Type[PlacementPolicy]]:
+    def register(policy: Type[PlacementPolicy]) -> Type[PlacementPolicy]:
+        policy.name = name
+        PLACEMENT_POLICIES[name] = policy
+        return policy
+
+    return register
+
+
+@register_placement_policy("least-links")
+class LeastLinksPolicy(PlacementPolicy):
+    def choose(self, fqdn: str, candidates: list[Candidate]) -> Candidate:
+        # ties are broken by latency, then deterministically by key
+        return min(
+            candidates,
+            key=lambda c: (c.link_count, c.latency if c.latency is not None else 0.0, c.key),
+        )
+
+
+@register_placement_policy("lowest-latency")
+class LowestLatencyPolicy(PlacementPolicy):
+    def choose(self, fqdn: str, candidates: list[Candidate]) -> Candidate:
+        # devices without recent link ups are tried before slow ones so they get measured
+        return min(
+            candidates,
+            key=lambda c: (c.latency if c.latency is not None else 0.0, c.link_count, c.key),
+        )
+
+
+@register_placement_policy("consistent-hash")
+class ConsistentHashPolicy(PlacementPolicy):
+    def choose(self, fqdn: str, candidates: list[Candidate]) -> Candidate:
+        by_key = {candidate.key: candidate for candidate in candidates}
+        return by_key[HashRing(by_key).get(fqdn)]  # type: ignore
+
+
+def get_placement_policy(name: Optional[str] = None) -> PlacementPolicy:
+    name = name or os.environ.get("FRACTAL_GATEWAY_PLACEMENT_POLICY", DEFAULT_PLACEMENT_POLICY)
+    try:
+        return PLACEMENT_POLICIES[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown placement policy {name}. Options are: {', '.join(PLACEMENT_POLICIES)}"
+        )
+
+
+def get_candidates(link: "Link", devices: list["Device"]) -> list[Candidate]:
+    """
+    Returns the placement candidates for `devices` with their link counts, recent link up
+    latency and health, in a single query.
+    """
+    from django.db.models import Avg, Count, Q
+    from django.utils import timezone
+    from fractal.gateway.models import Link
+
+    recent = Q(last_up_at__gte=timezone.now() - RECENT_WINDOW)
+    stats = {
+        row["placement_device"]: row
+        for row in Link.objects.filter(placement_device__in=devices)
+        .exclude(pk=link.pk)
+        .values("placement_device")
+        .annotate(
+            link_count=Count("pk"),
+            latency=Avg("last_up_latency", filter=recent & Q(last_up_ok=True)),
+            failures=Count("pk", filter=recent & Q(last_up_ok=False)),
+        )
+    }
+
+    candidates = []
+    for device in devices:
+        row = stats.get(device.pk, {})
+        candidates.append(
+            Candidate(
+                key=str(device.pk),
+                link_count=row.get("link_count", 0),
+                latency=row.get("latency"),
+                healthy=row.get("failures", 0) < UNHEALTHY_FAILURES,
+                device=device,
+            )
+        )
+    return candidates
+
+
+def place_link(
+    link: "Link",
+    devices: list["Device"],
+    policy: Optional[PlacementPolicy] = None,
+) -> "Device":
+    """
+    Chooses the device of `devices` that hosts `link` and records the decision on the link
+    (the caller saves it). A link stays on the device it was placed on as long as that device
+    is a candidate.
+    """
+    if link.placement_device_id and any(
+        device.pk == link.placement_device_id for device in devices
+    ):
+        return next(device for device in devices if device.pk == link.placement_device_id)
+
+    policy = policy or get_placement_policy()
+    candidate = policy.place(link.fqdn, get_candidates(link, devices))
+    logger.info(
+        "Placing link %s on device %s (%s, %s links, latency %s)"
+        % (link.fqdn, candidate.device, policy.name, candidate.link_count, candidate.latency)
+    )
+
+    link.placement_device = candidate.device
+    link.placement_policy = policy.name
+    return candidate.device
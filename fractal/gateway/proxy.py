@@ -0,0 +1,93 @@
+"""
+Performance profiles for the Caddy proxy of client-link containers.
+
+A link's compose snippet carries its profile as `CADDY_*` environment variables that the
+client-link entrypoint renders into the Caddyfile: response compression, keepalive and buffer
+sizes of the upstream connections and the HTTP version spoken to the upstream.
+
+Only the settings that differ from `ProxyProfile()` end up in the snippet, the entrypoint
+falls back to the same defaults, so snippets stay short and pick up better defaults with the
+image. The profile is selected with `FRACTAL_GATEWAY_PROXY_PROFILE` (defaults to default).
+
+TLS session resumption for clients is left to Caddy, which enables session tickets and
+rotates their keys on its own.
+"""
+
+import os
+from dataclasses import dataclass, fields, replace
+from typing import Optional, Union
+
+DEFAULT_PROXY_PROFILE = "default"
+
+
+@dataclass(frozen=True)
+class ProxyProfile:
+    # response encodings in order of preference, empty to disable compression
+    compression: tuple[str, ...] = ("zstd", "gzip")
+    # responses smaller than this (in bytes) aren't worth compressing
+    compression_min_length: int = 1024
+    # how long idle upstream connections are kept open ("off" to close them after each request)
+    keepalive: str = "2m"
+    # idle connections kept open to the upstream
+    keepalive_idle_conns: int = 64
+    # sizes of the buffers used to read from and write to the upstream, in bytes
+    read_buffer: int = 65536
+    write_buffer: int = 65536
+    # speak HTTP/2 to the upstream (h2c for plain HTTP upstreams)
+    upstream_http2: bool = False
+    # how often responses are flushed to the client ("-1" to flush immediately),
+    # None for Caddy's default
+    flush_interval: Optional[str] = None
+
+    def to_environment(self) -> dict[str, str]:
+        """
+        Returns the `CADDY_*` environment variables for the settings that differ from the
+        defaults.
+        """
+        default = ProxyProfile()
+        environment = {}
+        for profile_field in fields(self):
+            value = getattr(self, profile_field.name)
+            if value == getattr(default, profile_field.name):
+                continue
+            if isinstance(value, tuple):
+                value = " ".join(value) or "off"
+            elif isinstance(value, bool):
+                value = str(value).lower()
+            environment[f"CADDY_{profile_field.name.upper()}"] = str(value)
+        return environment
+
+
+PROXY_PROFILES: dict[str, ProxyProfile] = {
+    "default": ProxyProfile(),
+    # server-sent events, long polling and other responses that have to reach the client as
+    # they are written: no compression buffering, immediate flushes
+    "streaming": ProxyProfile(compression=(), flush_interval="-1"),
+    # the proxy settings of client-link images before profiles existed
+    "compat": ProxyProfile(
+        compression=(),
+        keepalive_idle_conns=32,
+        read_buffer=8192,
+        write_buffer=4096,
+    ),
+}
+
+
+def get_proxy_profile(
+    profile: Union[str, ProxyProfile, None] = None, **overrides
+) -> ProxyProfile:
+    """
+    Returns a proxy profile by name (or the profile itself), with `overrides` applied.
+
+    Raises:
+    - ValueError: if there is no profile with the name.
+    """
+    if not isinstance(profile, ProxyProfile):
+        name = profile or os.environ.get("FRACTAL_GATEWAY_PROXY_PROFILE", DEFAULT_PROXY_PROFILE)
+        try:
+            profile = PROXY_PROFILES[name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown proxy profile {name}. Options are: {', '.join(PROXY_PROFILES)}"
+            )
+    return replace(profile, **overrides) if overrides else profile
@@ -0,0 +1,389 @@
+"""
+Converging the Docker host of a gateway device to the gateway state in the database.
+
+Each pass reads the desired state (the Gateway's target state and the links hosted on this
+device) and the actual state (one inventory pass over the gateway and link containers, plus
+the peers of the link hub) and plans the actions that close the gap: creating or starting the
+gateway, starting stopped link containers, restarting unhealthy ones and deleting containers
+of links that are gone. Actions run concurrently behind a rate limit, so recovering from a
+host reboot or a dockerd crash takes a bounded amount of time and doesn't stampede Docker.
+
+Link containers that are missing entirely can't be recreated here, the client's WireGuard
+public key only lives in the container. They are reported until the link is brought up again.
+Replacement link containers (see `fractal.gateway.replacement`) are promoted once their client
+connected, in case the process that launched them is gone.
+"""
+
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable, Iterable, Optional
+
+import docker
+from docker.errors import NotFound
+from fractal.gateway.hub import LINK_HUB_LABEL, list_hub_peers, remove_hub_peer
+from fractal.gateway.inventory import (
+    GATEWAY_LABEL,
+    GATEWAY_LINK_LABEL,
+    ContainerRecord,
+    get_inventory,
+    start_inventory,
+)
+from fractal.gateway.replacement import (
+    REPLACEMENT_SUFFIX,
+    check_replacement,
+    is_replacement,
+    watch_in_process,
+)
+from fractal.gateway.routes import sync_link_routes
+from fractal.gateway.utils import (
+    LINK_FQDN_LABEL,
+    get_link_container_name,
+    launch_gateway,
+)
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_CONTAINER_NAME = "fractal-gateway"
+
+CREATE = "create"
+START = "start"
+STOP = "stop"
+RESTART = "restart"
+DELETE = "delete"
+# a link that should be up but has no container, needs a link up from its client
+MISSING = "missing"
+# a replacement link container, promoted once its client connected
+PROMOTE = "promote"
+
+# actions that change the links the gateway routes to
+LINK_ACTIONS = (START, RESTART, DELETE)
+
+# wait between repeated actions on the same container, doubled per attempt
+BACKOFF_BASE = 5.0
+BACKOFF_MAX = 300.0
+# coalesces bursts of Docker events into a single pass
+DEBOUNCE = 1.0
+
+
+@dataclass
+class DesiredState:
+    # target state of the gateway container: "running", "stopped" or None to leave it alone
+    gateway_state: Optional[str] = None
+    gateway_label: str = "true"
+    # FQDNs of the links hosted on this device
+    links: set[str] = field(default_factory=set)
+    # links that were brought up (have a forward port) and should have a container or peer
+    up_links: set[str] = field(default_factory=set)
+
+
+@dataclass
+class Action:
+    kind: str
+    name: str
+    fqdn: Optional[str] = None
+    record: Optional[ContainerRecord] = field(default=None, repr=False)
+
+
+@dataclass
+class ActionResult:
+    action: Action
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def plan(
+    desired: DesiredState, records: Iterable[ContainerRecord], hub_peers: Iterable[str] = ()
+) -> list[Action]:
+    """
+    Returns the actions that bring the containers in `records` and the link hub peers
+    (FQDNs) in `hub_peers` in line with `desired`.
+    """
+    records = list(records)
+    link_names = {get_link_container_name(fqdn): fqdn for fqdn in desired.links}
+    actions = []
+
+    gateways = [record for record in records if GATEWAY_LABEL in record.labels]
+    if desired.gateway_state == "running":
+        if not gateways:
+            actions.append(Action(CREATE, GATEWAY_CONTAINER_NAME))
+        for record in gateways:
+            actions.extend(_converge_running(record))
+    elif desired.gateway_state == "stopped":
+        actions.extend(
+            Action(STOP, record.name, record=record) for record in gateways if record.running
+        )
+
+    present = set()
+    for record in records:
+        if GATEWAY_LINK_LABEL not in record.labels:
+            continue
+        if LINK_HUB_LABEL in record.labels:
+            actions.extend(_converge_running(record))
+            continue
+
+        if is_replacement(record.name):
+            base_name = record.name[: -len(REPLACEMENT_SUFFIX)]
+            if base_name in link_names:
+                actions.append(
+                    Action(PROMOTE, record.name, fqdn=link_names[base_name], record=record)
+                )
+                continue
+
+        fqdn = record.labels.get(LINK_FQDN_LABEL) or link_names.get(record.name)
+        if record.name not in link_names:
+            actions.append(Action(DELETE, record.name, fqdn=fqdn, record=record))
+            continue
+        present.add(record.name)
+        actions.extend(_converge_running(record, fqdn))
+
+    for fqdn in hub_peers:
+        name = get_link_container_name(fqdn)
+        if name in link_names:
+            present.add(name)
+        else:
+            actions.append(Action(DELETE, name, fqdn=fqdn))
+
+    actions.extend(
+        Action(MISSING, get_link_container_name(fqdn), fqdn=fqdn)
+        for fqdn in sorted(desired.up_links)
+        if get_link_container_name(fqdn) not in present
+    )
+    return actions
+
+
+def _converge_running(record: ContainerRecord, fqdn: Optional[str] = None) -> list[Action]:
+    if not record.running:
+        return [Action(START, record.name, fqdn=fqdn, record=record)]
+    if record.health == "unhealthy":
+        return [Action(RESTART, record.name, fqdn=fqdn, record=record)]
+    return []
+
+
+class RateLimiter:
+    """
+    Token bucket allowing `rate` acquisitions per second with bursts of up to `burst`.
+    """
+
+    def __init__(
+        self, rate: float, burst: int = 1, clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self.clock()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self) -> float:
+        """
+        Takes a token if one is available.
+
+        Returns:
+        - float, 0 if a token was taken, otherwise the seconds until the next one.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class Reconciler:
+    """
+    Reconciles the gateway device's Docker host with the database.
+
+    Parameters:
+    - client: DockerClient, the Docker client to use. Defaults to the environment's.
+    - concurrency: Int, the number of actions applied at once. Defaults to 4.
+    - rate: Float, the number of actions started per second. Defaults to 5.
+    """
+
+    def __init__(
+        self,
+        client: Optional["DockerClient"] = None,
+        concurrency: int = 4,
+        rate: float = 5.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.client = client or docker.from_env()
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate, burst=concurrency, clock=clock)
+        self.clock = clock
+        # container name -> (consecutive attempts, time of the last attempt)
+        self._attempts: dict[str, tuple[int, float]] = {}
+
+    def load_desired(self) -> DesiredState:
+        from fractal.gateway.models import Gateway, Link
+        from fractal_database.models import Device, ServiceInstanceConfig
+
+        try:
+            device = Device.current_device()
+        except Exception:
+            device = None
+
+        desired = DesiredState()
+        for gateway in Gateway.objects.all():
+            conf = ServiceInstanceConfig.objects.filter(
+                service=gateway, current_device=device
+            ).first()
+            if conf:
+                desired.gateway_state = conf.target_state
+                desired.gateway_label = str(gateway.pk)
+                break
+
+        desired.links = set(Link.hosted_fqdns(device))
+        desired.up_links = set(Link.hosted_fqdns(device, brought_up=True))
+        return desired
+
+    def observe(self) -> tuple[list[ContainerRecord], list[str]]:
+        """
+        Returns the gateway and link containers and the FQDNs of the link hub's peers.
+        """
+        inventory = get_inventory()
+        if inventory:
+            records = inventory.list(GATEWAY_LABEL) + inventory.list(GATEWAY_LINK_LABEL)
+        else:
+            records = [
+                ContainerRecord.from_summary(summary)
+                for label in (GATEWAY_LABEL, GATEWAY_LINK_LABEL)
+                for summary in self.client.api.containers(all=True, filters={"label": label})
+            ]
+
+        hub_peers = []
+        for record in records:
+            if LINK_HUB_LABEL in record.labels and record.running:
+                hub = self.client.containers.prepare_model(record.attrs)
+                hub_peers = [peer.fqdn for peer in list_hub_peers(hub)]  # type: ignore
+        return records, hub_peers
+
+    def _backing_off(self, name: str) -> bool:
+        attempts, last = self._attempts.get(name, (0, 0.0))
+        if not attempts:
+            return False
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (attempts - 1))
+        return self.clock() - last < delay
+
+    def _apply(self, action: Action, desired: DesiredState) -> ActionResult:
+        self.limiter.acquire()
+        logger.info("Reconciling %s: %s" % (action.name, action.kind))
+        try:
+            if action.kind == CREATE:
+                launch_gateway(action.name, labels={GATEWAY_LABEL: desired.gateway_label})
+            elif action.record is None:
+                # peer of the link hub
+                remove_hub_peer(action.fqdn, self.client, sync_routes=False)  # type: ignore
+            else:
+                container = self.client.containers.prepare_model(action.record.attrs)
+                if action.kind == PROMOTE:
+                    check_replacement(action.record, self.client)
+                elif action.kind == START:
+                    container.start()  # type: ignore
+                elif action.kind == STOP:
+                    container.stop()  # type: ignore
+                elif action.kind == RESTART:
+                    container.restart()  # type: ignore
+                elif action.kind == DELETE:
+                    container.remove(force=True)  # type: ignore
+        except NotFound:
+            pass
+        except Exception as err:
+            logger.warning("Failed to %s %s: %s" % (action.kind, action.name, err))
+            return ActionResult(action, error=str(err))
+        return ActionResult(action)
+
+    def reconcile(self, desired: Optional[DesiredState] = None) -> list[ActionResult]:
+        """
+        Runs a single reconciliation pass.
+
+        Returns:
+        - list[ActionResult], the applied actions (and the missing links).
+        """
+        desired = desired or self.load_desired()
+        records, hub_peers = self.observe()
+        actions = plan(desired, records, hub_peers)
+
+        # containers that don't need anything anymore start with a clean slate
+        pending = {action.name for action in actions}
+        for name in list(self._attempts):
+            if name not in pending:
+                del self._attempts[name]
+
+        runnable = [
+            action
+            for action in actions
+            if action.kind != MISSING and not self._backing_off(action.name)
+        ]
+        results = [ActionResult(action) for action in actions if action.kind == MISSING]
+        if not runnable:
+            return results
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            applied = list(executor.map(lambda action: self._apply(action, desired), runnable))
+
+        now = self.clock()
+        for result in applied:
+            if result.action.kind == PROMOTE:
+                # checked on every pass until the client connects or it times out
+                continue
+            attempts = self._attempts.get(result.action.name, (0, 0.0))[0]
+            self._attempts[result.action.name] = (attempts + 1, now)
+
+        if any(result.ok and result.action.kind in LINK_ACTIONS for result in applied):
+            try:
+                sync_link_routes(self.client)
+            except Exception as err:
+                logger.warning("Failed to publish link routes to the gateway: %s" % err)
+        return applied + results
+
+    def run(
+        self,
+        interval: float = 30.0,
+        on_pass: Optional[Callable[[list[ActionResult]], None]] = None,
+    ) -> None:
+        """
+        Reconciles every `interval` seconds and whenever a gateway or link container changes.
+        """
+        watch_in_process()
+        inventory = start_inventory()
+        generation = inventory.generation if inventory else 0
+        while True:
+            try:
+                results = self.reconcile()
+            except Exception as err:
+                logger.exception("Reconciliation pass failed: %s" % err)
+                results = []
+            if on_pass:
+                on_pass(results)
+
+            if inventory is None:
+                time.sleep(interval)
+                inventory = start_inventory(timeout=0)
+                generation = inventory.generation if inventory else 0
+                continue
+
+            changed = inventory.wait_changed(generation, timeout=interval)
+            if changed != generation:
+                time.sleep(DEBOUNCE)
+            generation = inventory.generation
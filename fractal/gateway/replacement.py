@@ -0,0 +1,265 @@
+"""
+Blue/green replacement of link containers.
+
+When a running link container has to be recreated (new image, port layout or forward mode),
+`launch_link` starts the new container next to it under the link's replacement name
+(`<name>--next`) instead of stopping the old one first. Routes keep pointing at the old
+container until the client completes a WireGuard handshake with the new one, which is when
+its traffic actually moves. The replacement is then promoted:
+
+1. the gateway's routes are switched to the new container (a single nginx reload),
+2. in-flight requests on the old container get `DRAIN_SECONDS` to finish,
+3. the old container is removed and the new one takes over the link's name,
+4. the routes are republished under that name.
+
+Long-lived processes (the agent and the reconciler, see `watch_in_process`) watch for the
+handshake in a background thread. Short-lived ones (`fractal link up` run from a shell or over
+SSH) exit as soon as the link is up, before the client has even received its new config, so
+they hand the watch to a detached `python -m fractal.gateway.replacement <fqdn>` process that
+outlives them. The reconciler finishes replacements whose watcher went away anyway, and
+discards replacements the client never connected to after `REPLACEMENT_TIMEOUT` seconds.
+"""
+
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Optional, Union
+
+import docker
+from docker.errors import APIError, NotFound
+from fractal.gateway.inventory import ContainerRecord, wait_for_container
+from fractal.gateway.routes import (
+    LinkRoute,
+    collect_link_routes,
+    publish_link_routes,
+    sync_link_routes,
+)
+from fractal.gateway.utils import (
+    LINK_FQDN_LABEL,
+    find_container,
+    get_link_aliases,
+    get_link_container_name,
+)
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from docker.models.containers import Container
+
+logger = logging.getLogger(__name__)
+
+# "--" can't end a hostname label, so replacement names never collide with link names
+REPLACEMENT_SUFFIX = "--next"
+# "blue-green" or "recreate" (stop the old container before starting the new one)
+REPLACEMENT_MODE = os.environ.get("FRACTAL_GATEWAY_LINK_REPLACEMENT", "blue-green")
+REPLACEMENT_TIMEOUT = float(os.environ.get("FRACTAL_GATEWAY_LINK_REPLACEMENT_TIMEOUT", "600"))
+DRAIN_SECONDS = float(os.environ.get("FRACTAL_GATEWAY_LINK_DRAIN_SECONDS", "2"))
+HANDSHAKE_POLL_INTERVAL = 0.5
+
+# whether this process outlives the replacements it launches (see watch_in_process)
+_watch_in_process = False
+
+PENDING = "pending"
+PROMOTED = "promoted"
+DISCARDED = "discarded"
+
+
+def get_replacement_name(link_fqdn: str) -> str:
+    return get_link_container_name(link_fqdn) + REPLACEMENT_SUFFIX
+
+
+def is_replacement(name: str) -> bool:
+    return name.endswith(REPLACEMENT_SUFFIX)
+
+
+def can_replace(
+    record: ContainerRecord, tcp_forwarding: bool, forward_port: Optional[str]
+) -> bool:
+    """
+    Returns whether a link container can be replaced blue/green: it's running and the new
+    container doesn't need a host port the old one holds. The forward port of HTTP links is
+    reallocated, the forward port of links with TCP forwarding is public so it has to stay.
+    """
+    if REPLACEMENT_MODE != "blue-green" or not record.running:
+        return False
+    if tcp_forwarding and forward_port:
+        return str(forward_port) != record.host_port("5555/tcp")
+    return True
+
+
+def has_handshake(container: "Container") -> bool:
+    result = container.exec_run(["wg", "show", "link0", "latest-handshakes"])
+    if result.exit_code != 0:
+        return False
+    return any(
+        line.split()[-1] != "0" for line in result.output.decode().splitlines() if line.strip()
+    )
+
+
+def _age(record: ContainerRecord) -> float:
+    created = record.attrs.get("Created")
+    if isinstance(created, (int, float)):
+        # container summaries carry a unix timestamp
+        return time.time() - created
+    if isinstance(created, str):
+        # inspect results carry an RFC 3339 timestamp with nanoseconds
+        created_at = datetime.fromisoformat(created[:26].rstrip("Z") + "+00:00")
+        return (datetime.now(timezone.utc) - created_at).total_seconds()
+    return 0.0
+
+
+def discard_replacement(link_fqdn: str, client: "DockerClient") -> bool:
+    """
+    Removes the link's replacement container, if there is one.
+    """
+    record = find_container(get_replacement_name(link_fqdn), client)
+    if not record:
+        return False
+    logger.info("Discarding replacement link container %s" % record.name)
+    try:
+        client.containers.prepare_model(record.attrs).remove(force=True)
+    except NotFound:
+        pass
+    return True
+
+
+def promote_replacement(link_fqdn: str, client: "DockerClient") -> bool:
+    """
+    Moves the link's traffic to its replacement container and retires the old container.
+
+    Returns:
+    - bool, False if there is no running replacement.
+    """
+    name = get_link_container_name(link_fqdn)
+    replacement = find_container(get_replacement_name(link_fqdn), client)
+    if not replacement or not replacement.running:
+        return False
+
+    logger.info("Switching link %s to its replacement container" % link_fqdn)
+    fqdns = {link_fqdn, *get_link_aliases(replacement)}
+    routes = [route for route in collect_link_routes(client) if route.fqdn not in fqdns]
+    routes.extend(
+        LinkRoute(
+            fqdn=fqdn,
+            http_upstream=f"{replacement.name}:80",
+            https_upstream=f"{replacement.name}:443",
+        )
+        for fqdn in fqdns
+    )
+    publish_link_routes(sorted(routes, key=lambda route: route.fqdn), client=client)
+
+    # nginx's old workers finish the requests they have in flight to the old container
+    time.sleep(DRAIN_SECONDS)
+
+    current = find_container(name, client)
+    if current:
+        try:
+            client.containers.prepare_model(current.attrs).remove(force=True)
+        except NotFound:
+            pass
+
+    container = client.containers.prepare_model(replacement.attrs)
+    try:
+        container.rename(name)  # type: ignore
+    except APIError as err:
+        # routes keep pointing at the replacement under its own name
+        logger.warning("Failed to rename replacement container %s: %s" % (replacement.name, err))
+        name = replacement.name
+
+    # until the reload, nginx uses the address it resolved for the replacement's old name.
+    # The routes are collected from the inventory, which learns about the rename from an event
+    wait_for_container(name, replacement.id)
+    sync_link_routes(client)
+    return True
+
+
+def check_replacement(record: ContainerRecord, client: "DockerClient") -> str:
+    """
+    Promotes a replacement container once its client connected, discards it if the client
+    didn't connect in time.
+
+    Returns:
+    - str, PENDING, PROMOTED or DISCARDED.
+    """
+    fqdn = record.labels[LINK_FQDN_LABEL]
+    container = client.containers.prepare_model(record.attrs)
+    if record.running and has_handshake(container):  # type: ignore
+        return PROMOTED if promote_replacement(fqdn, client) else PENDING
+
+    if _age(record) > REPLACEMENT_TIMEOUT:
+        logger.warning(
+            "Client of link %s didn't connect to its replacement container in %ss"
+            % (fqdn, REPLACEMENT_TIMEOUT)
+        )
+        discard_replacement(fqdn, client)
+        return DISCARDED
+    return PENDING
+
+
+def watch_replacement(link_fqdn: str, client: Optional["DockerClient"] = None) -> str:
+    """
+    Waits for the client to connect to the link's replacement and promotes it.
+
+    Returns:
+    - str, PROMOTED or DISCARDED.
+    """
+    client = client or docker.from_env()
+    deadline = time.monotonic() + REPLACEMENT_TIMEOUT
+    while time.monotonic() < deadline:
+        record = find_container(get_replacement_name(link_fqdn), client)
+        if not record:
+            # superseded by another link up or promoted by the reconciler
+            return DISCARDED
+        try:
+            container = client.containers.prepare_model(record.attrs)
+            if record.running and has_handshake(container):  # type: ignore
+                return PROMOTED if promote_replacement(link_fqdn, client) else DISCARDED
+        except NotFound:
+            return DISCARDED
+        time.sleep(HANDSHAKE_POLL_INTERVAL)
+
+    discard_replacement(link_fqdn, client)
+    return DISCARDED
+
+
+def watch_in_process(enabled: bool = True) -> None:
+    """
+    Marks this process as long-lived, so that it watches the replacements it launches from a
+    background thread instead of handing them to a detached watcher process.
+    """
+    global _watch_in_process
+    _watch_in_process = enabled
+
+
+def start_replacement_watch(
+    link_fqdn: str, client: "DockerClient"
+) -> Union[threading.Thread, subprocess.Popen]:
+    if not _watch_in_process:
+        logger.info("Handing the replacement watch of link %s to a watcher process" % link_fqdn)
+        # a session of its own, so that it isn't hung up with the SSH session that ran link up
+        return subprocess.Popen(
+            [sys.executable, "-m", "fractal.gateway.replacement", link_fqdn],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+
+    def watch():
+        try:
+            result = watch_replacement(link_fqdn, client)
+            logger.info("Replacement of link %s %s" % (link_fqdn, result))
+        except Exception as err:
+            logger.warning("Failed to promote replacement of link %s: %s" % (link_fqdn, err))
+
+    thread = threading.Thread(target=watch, name=f"replace-{link_fqdn}", daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(0 if watch_replacement(sys.argv[1]) == PROMOTED else 1)
@@ -3,57 +3,254 @@ set -euxo pipefail
 
 echo $GATEWAY_CLIENT_WG_PRIVKEY > /etc/wireguard/link0.key
 
+# links hosted by the gateway's link hub get their own address in the hub's network
+LINK_ADDRESS=${LINK_ADDRESS:-10.0.0.2/24}
+GATEWAY_LINK_ADDRESS=${GATEWAY_LINK_ADDRESS:-10.0.0.1}
+GATEWAY_HOST=${GATEWAY_ENDPOINT%:*}
+
+# WireGuard adds 80 bytes to every packet with an IPv6 outer header (60 with IPv4)
+WG_OVERHEAD=80
+MIN_LINK_MTU=1280
+MAX_LINK_MTU=1420
+MTU_REPORT_PORT=18526
+
+# prints the largest packet that reaches the gateway without fragmenting, by binary
+# search between 1280 and 1500 with the don't fragment bit set. Fails if the gateway
+# doesn't answer pings at all.
+probe_path_mtu() {
+    LOW=$MIN_LINK_MTU
+    HIGH=1501
+    # 28 bytes of IPv4 and ICMP headers
+    ping -M do -c 2 -i 0.2 -W 1 -s $((LOW - 28)) $GATEWAY_HOST > /dev/null 2>&1 || return 1
+    while [ $((HIGH - LOW)) -gt 1 ]; do
+        MID=$(((LOW + HIGH) / 2))
+        if ping -M do -c 2 -i 0.2 -W 1 -s $((MID - 28)) $GATEWAY_HOST > /dev/null 2>&1; then
+            LOW=$MID
+        else
+            HIGH=$MID
+        fi
+    done
+    echo $LOW
+}
+
+# prints the tunnel MTU for the measured path, or $LINK_MTU if the path can't be probed
+probe_link_mtu() {
+    if [ "${LINK_MTU_PROBE:-true}" != "true" ]; then
+        echo $LINK_MTU
+        return
+    fi
+    if ! PATH_MTU=$(probe_path_mtu); then
+        echo $LINK_MTU
+        return
+    fi
+    TUNNEL_MTU=$((PATH_MTU - WG_OVERHEAD))
+    [ $TUNNEL_MTU -gt $MAX_LINK_MTU ] && TUNNEL_MTU=$MAX_LINK_MTU
+    [ $TUNNEL_MTU -lt $MIN_LINK_MTU ] && TUNNEL_MTU=$MIN_LINK_MTU
+    echo $TUNNEL_MTU
+}
+
+# the gateway link matches the MTU and keeps it for the link's next compose snippet
+report_link_mtu() {
+    echo $LINK_MTU | socat -u - UDP4-SENDTO:$GATEWAY_LINK_ADDRESS:$MTU_REPORT_PORT 2> /dev/null || true
+}
+
+# paths change (i.e. the client roams between networks), probe again every interval
+watch_link_mtu() {
+    report_link_mtu
+    [ "$LINK_MTU_PROBE_INTERVAL" -gt 0 ] || return 0
+    while true; do
+        sleep $LINK_MTU_PROBE_INTERVAL
+        NEW_LINK_MTU=$(probe_link_mtu)
+        if [ "$NEW_LINK_MTU" != "$LINK_MTU" ]; then
+            echo "Tunnel MTU changed from $LINK_MTU to $NEW_LINK_MTU"
+            ip link set link0 mtu $NEW_LINK_MTU
+            LINK_MTU=$NEW_LINK_MTU
+        fi
+        report_link_mtu
+    done
+}
+
+LINK_MTU=$(probe_link_mtu)
+echo "Using a tunnel MTU of $LINK_MTU"
 
 ip link add link0 type wireguard
 
 wg set link0 private-key /etc/wireguard/link0.key
 wg set link0 listen-port 18521
-ip addr add 10.0.0.2/24 dev link0
+ip addr add $LINK_ADDRESS dev link0
 ip link set link0 up
 ip link set link0 mtu $LINK_MTU
 
-wg set link0 peer $GATEWAY_LINK_WG_PUBKEY allowed-ips 10.0.0.1/32 persistent-keepalive 30 endpoint $GATEWAY_ENDPOINT
+wg set link0 peer $GATEWAY_LINK_WG_PUBKEY allowed-ips $GATEWAY_LINK_ADDRESS/32 persistent-keepalive 30 endpoint $GATEWAY_ENDPOINT
 
+watch_link_mtu &
+
+EXPOSE_HOST=${EXPOSE%:*}
+EXPOSE_PORT=${EXPOSE##*:}
+
+resolve_expose() {
+    getent hosts $EXPOSE_HOST | awk '{ print $1; exit }' || true
+}
+
+# add or delete (A/D) the rules that forward the center port (tcp and udp) to $1:$EXPOSE_PORT
+center_port_rules() {
+    FAILED=0
+    for PROTO in tcp udp; do
+        iptables -t nat -$2 PREROUTING -i link0 -p $PROTO --dport $CENTER_PORT -j DNAT --to-destination $1:$EXPOSE_PORT || FAILED=1
+        iptables -t nat -$2 POSTROUTING ! -o link0 -p $PROTO -d $1 --dport $EXPOSE_PORT -j MASQUERADE || FAILED=1
+    done
+    return $FAILED
+}
+
+# forwards the center port in the kernel instead of a socat process per connection,
+# returns non-zero (without leaving any rules behind) if that isn't possible
+forward_nat() {
+    if [ "$(cat /proc/sys/net/ipv4/ip_forward)" != "1" ]; then
+        echo "IP forwarding is disabled, can't forward port $CENTER_PORT with iptables"
+        return 1
+    fi
+    EXPOSE_IP=$(resolve_expose)
+    if [ -z "$EXPOSE_IP" ]; then
+        echo "Could not resolve $EXPOSE_HOST, can't forward port $CENTER_PORT with iptables"
+        return 1
+    fi
+    if ! center_port_rules $EXPOSE_IP A; then
+        center_port_rules $EXPOSE_IP D 2>/dev/null || true
+        return 1
+    fi
+}
+
+# the rules point at an address, follow the exposed service if it is recreated with a new one.
+# Returns if the rules can't be updated so that socat can take over.
+watch_expose() {
+    trap "exit 0" TERM INT
+    while true; do
+        sleep 30 &
+        wait $!
+        NEW_EXPOSE_IP=$(resolve_expose)
+        if [ -n "$NEW_EXPOSE_IP" ] && [ "$NEW_EXPOSE_IP" != "$EXPOSE_IP" ]; then
+            echo "$EXPOSE_HOST moved from $EXPOSE_IP to $NEW_EXPOSE_IP"
+            center_port_rules $EXPOSE_IP D 2>/dev/null || true
+            if ! center_port_rules $NEW_EXPOSE_IP A; then
+                center_port_rules $NEW_EXPOSE_IP D 2>/dev/null || true
+                return
+            fi
+            EXPOSE_IP=$NEW_EXPOSE_IP
+        fi
+    done
+}
 
 if [ -z ${FORWARD_ONLY+x} ]; then
 
     echo "Using caddy with SSL termination to forward traffic to app."
-    if [ ! -z ${CADDY_TLS_PROXY+x} ]; then          # if CADDY_TLS_PROXY is set
-        echo "Configure Caddy for use with TLS backend"
-        if [ ! -z ${CADDY_TLS_INSECURE+x} ]; then   # if CADDY_TLS_INSECURE
-            echo "Skip TLS verification"
-            EXPOSE=$(cat <<-END
-$EXPOSE {
-         transport http {
-            tls
-            tls_insecure_skip_verify
-            read_buffer 8192
-         }
-         header_up X-Forwarded-Proto {scheme}
-       }
+
+    # performance profile (see fractal/gateway/proxy.py), the defaults match ProxyProfile()
+    CADDY_COMPRESSION=${CADDY_COMPRESSION:-zstd gzip}
+    CADDY_COMPRESSION_MIN_LENGTH=${CADDY_COMPRESSION_MIN_LENGTH:-1024}
+    CADDY_KEEPALIVE=${CADDY_KEEPALIVE:-2m}
+    CADDY_KEEPALIVE_IDLE_CONNS=${CADDY_KEEPALIVE_IDLE_CONNS:-64}
+    CADDY_READ_BUFFER=${CADDY_READ_BUFFER:-65536}
+    CADDY_WRITE_BUFFER=${CADDY_WRITE_BUFFER:-65536}
+    CADDY_UPSTREAM_HTTP2=${CADDY_UPSTREAM_HTTP2:-false}
+    CADDY_FLUSH_INTERVAL=${CADDY_FLUSH_INTERVAL:-}
+
+    ENCODE_CONFIG=""
+    if [ "$CADDY_COMPRESSION" != "off" ]; then
+        ENCODE_CONFIG=$(cat <<-END
+encode $CADDY_COMPRESSION {
+        minimum_length $CADDY_COMPRESSION_MIN_LENGTH
+    }
 END
 )
+    fi
 
-        else    # CADDY_TLS_INSECURE is false
-            EXPOSE=$(cat <<-END
-$EXPOSE {
-         transport http {
-            tls
-            read_buffer 8192
-         }
-         header_up X-Forwarded-Proto {scheme}
-       }
+    TRANSPORT_CONFIG=$(cat <<-END
+keepalive $CADDY_KEEPALIVE
+            keepalive_idle_conns_per_host $CADDY_KEEPALIVE_IDLE_CONNS
+            read_buffer $CADDY_READ_BUFFER
+            write_buffer $CADDY_WRITE_BUFFER
 END
 )
+    if [ ! -z ${CADDY_TLS_PROXY+x} ]; then          # if CADDY_TLS_PROXY is set
+        echo "Configure Caddy for use with TLS backend"
+        TRANSPORT_CONFIG="$TRANSPORT_CONFIG
+            tls"
+        if [ ! -z ${CADDY_TLS_INSECURE+x} ]; then   # if CADDY_TLS_INSECURE
+            echo "Skip TLS verification"
+            TRANSPORT_CONFIG="$TRANSPORT_CONFIG
+            tls_insecure_skip_verify"
         fi
-        else
-         EXPOSE=$(cat <<-END
-$EXPOSE {
-         header_up X-Forwarded-Proto {scheme}
-       }
+        if [ "$CADDY_UPSTREAM_HTTP2" = "true" ]; then
+            TRANSPORT_CONFIG="$TRANSPORT_CONFIG
+            versions 2"
+        fi
+    elif [ "$CADDY_UPSTREAM_HTTP2" = "true" ]; then
+        # plain HTTP upstreams speak HTTP/2 without TLS
+        TRANSPORT_CONFIG="$TRANSPORT_CONFIG
+            versions h2c 2"
+    fi
+
+    PROXY_CONFIG=""
+    if [ -n "$CADDY_FLUSH_INTERVAL" ]; then
+        PROXY_CONFIG="flush_interval $CADDY_FLUSH_INTERVAL"
+    fi
+
+    # the gateway only sees encrypted traffic on port 443, so HTTPS requests for the well-known
+    # documents it pre-rendered (see fractal/gateway/well_known.py) are relayed back to it
+    # through the tunnel. Hostnames without a document (404) are served by their own upstream
+    # as usual. Prints the handle for host $2 served by $3, $1 names its matcher
+    well_known_config() {
+        [ "${GATEWAY_WELL_KNOWN:-false}" = "true" ] || return 0
+        cat <<-END
+@well_known$1 {
+        host $2
+        path /.well-known/matrix/client
+    }
+    handle @well_known$1 {
+        reverse_proxy $GATEWAY_LINK_ADDRESS:${GATEWAY_WELL_KNOWN_PORT:-18527} {
+            @missing status 404
+            handle_response @missing {
+                reverse_proxy $3 {
+                    transport http {
+                        $TRANSPORT_CONFIG
+                    }
+                    header_up X-Forwarded-Proto {scheme}
+                }
+            }
+        }
+    }
+END
+    }
+
+    WELL_KNOWN_CONFIG=$(well_known_config 0 "$LINK_DOMAIN" "$EXPOSE")
+
+    # multi-route link: LINK_ROUTES ("fqdn=expose,...") are served by this Caddy as well,
+    # the gateway routes them through the same tunnel. Matched routes take precedence over
+    # the link's own reverse_proxy, which has no matcher.
+    LINK_DOMAINS=$LINK_DOMAIN
+    ROUTES_CONFIG=""
+    ROUTE_INDEX=0
+    for ROUTE in $(echo "${LINK_ROUTES:-}" | tr ',' ' '); do
+        ROUTE_INDEX=$((ROUTE_INDEX + 1))
+        ROUTE_DOMAIN=${ROUTE%%=*}
+        ROUTE_EXPOSE=${ROUTE#*=}
+        echo "Serving $ROUTE_DOMAIN from $ROUTE_EXPOSE"
+        LINK_DOMAINS="$LINK_DOMAINS, $ROUTE_DOMAIN"
+        ROUTES_CONFIG=$(cat <<-END
+$ROUTES_CONFIG
+    @route$ROUTE_INDEX host $ROUTE_DOMAIN
+    reverse_proxy @route$ROUTE_INDEX $ROUTE_EXPOSE {
+        transport http {
+            $TRANSPORT_CONFIG
+        }
+        header_up X-Forwarded-Proto {scheme}
+        $PROXY_CONFIG
+    }
 END
 )
-    fi
+        WELL_KNOWN_CONFIG="$WELL_KNOWN_CONFIG
+    $(well_known_config $ROUTE_INDEX "$ROUTE_DOMAIN" "$ROUTE_EXPOSE")"
+    done
 
     CADDYFILE='/etc/Caddyfile'
     BASIC_AUTH=${BASIC_AUTH:-}
@@ -84,6 +281,12 @@ END
     fi
     export EXPOSE
     export TLS_INTERNAL_CONFIG
+    export ENCODE_CONFIG
+    export TRANSPORT_CONFIG
+    export PROXY_CONFIG
+    export LINK_DOMAINS
+    export ROUTES_CONFIG
+    export WELL_KNOWN_CONFIG
     envsubst < /etc/Caddyfile.template > $CADDYFILE
     caddy run --config $CADDYFILE
 else
@@ -94,6 +297,11 @@ else
         # Just opening both TCP and UDP is the quick and dirty way of ensuring both protocols work
         # In the future, specifying a protocol in the docker compose snippet may be necessary
         # -- 2024-04-07 zacharylott94@gmail.com
+        if [ "${FORWARD_MODE:-}" = "nat" ] && forward_nat; then
+            echo "Forwarding port $CENTER_PORT to $EXPOSE with iptables"
+            watch_expose
+        fi
+        echo "Forwarding port $CENTER_PORT to $EXPOSE with socat"
         socat TCP4-LISTEN:$CENTER_PORT,fork,reuseaddr TCP4:$EXPOSE,reuseaddr&
         socat UDP4-LISTEN:$CENTER_PORT,fork,reuseaddr UDP4:$EXPOSE,reuseaddr
     else
@@ -1,13 +1,25 @@
 #!/bin/sh
 
+if [ "$LINK_HUB" = "true" ]; then
+    exec hub.sh start
+fi
+
 KEY_PATH="/etc/wireguard/link0.key"
+CLIENT_PUBKEY_PATH="/etc/wireguard/client.pub"
+# tunnel MTU measured by the client. Kept in the link's state directory, which is bind
+# mounted from the host, so `fractal link up` reads it without exec (see read_link_mtu)
+CLIENT_MTU_PATH="/var/lib/fractal-link/client.mtu"
+MTU_REPORT_PORT=18526
 
 FORWARD_PORT=$1
 CENTER_PORT=$3
 
-if [ ! -f "$KEY_PATH" ]; then
+# launch_link generates the link's key so that it knows the public key up front
+if [ -n "$LINK_WG_PRIVKEY" ]; then
+    (umask 077 && echo "$LINK_WG_PRIVKEY" > "$KEY_PATH")
+elif [ ! -f "$KEY_PATH" ]; then
     WG_PRIVKEY=$(wg genkey)
-    echo $WG_PRIVKEY > "$KEY_PATH"
+    (umask 077 && echo $WG_PRIVKEY > "$KEY_PATH")
 else
     echo "A WireGuard private key already exists at $KEY_PATH."
 fi
@@ -19,10 +31,38 @@ wg set link0 private-key /etc/wireguard/link0.key
 wg set link0 listen-port 18521
 ip addr add 10.0.0.1/24 dev link0
 ip link set link0 up
+# keep the MTU the client reported if the container restarts or is recreated
+if [ -f "$CLIENT_MTU_PATH" ]; then
+    LINK_MTU=$(cat "$CLIENT_MTU_PATH")
+fi
 ip link set link0 mtu $LINK_MTU
 
+# the client key may have been replaced in place since the container was created
+if [ -f "$CLIENT_PUBKEY_PATH" ]; then
+    LINK_CLIENT_WG_PUBKEY=$(cat "$CLIENT_PUBKEY_PATH")
+fi
+
 wg set link0 peer $LINK_CLIENT_WG_PUBKEY allowed-ips 10.0.0.2/32
 
+# the client reports the tunnel MTU it measured for its path whenever it probes it
+watch_mtu_reports() {
+    while true; do
+        MTU=$(socat -u -T 5 UDP4-RECVFROM:$MTU_REPORT_PORT,bind=10.0.0.1 STDOUT 2> /dev/null | tr -dc 0-9)
+        if [ -n "$MTU" ] && [ "$MTU" -ge 1280 ] && [ "$MTU" -le 1420 ]; then
+            if [ "$MTU" != "$LINK_MTU" ]; then
+                echo "Client reported a tunnel MTU of $MTU"
+                ip link set link0 mtu $MTU
+                LINK_MTU=$MTU
+            fi
+            echo $MTU > "$CLIENT_MTU_PATH"
+        else
+            # don't spin if the port can't be bound
+            sleep 1
+        fi
+    done
+}
+watch_mtu_reports &
+
 #iptables forward port 80, 443 to 10.0.0.2:80/443
 iptables -A FORWARD -i eth0 -o link0 -p tcp --syn --dport 80 -m conntrack --ctstate NEW -j ACCEPT
 iptables -A FORWARD -i eth0 -o link0 -p tcp --syn --dport 443 -m conntrack --ctstate NEW -j ACCEPT
@@ -37,6 +77,46 @@ iptables -t nat -A PREROUTING -i eth0 -p tcp --dport 443 -j DNAT --to-destinatio
 iptables -t nat -A POSTROUTING -o link0 -p tcp --dport 8080 -j SNAT --to-source 10.0.0.1
 iptables -t nat -A POSTROUTING -o link0 -p tcp --dport 8443 -j SNAT --to-source 10.0.0.1
 
+# relays the client's HTTPS requests for well-known documents to the gateway's internal
+# well-known server (see WELL_KNOWN_CONFIG in the client link's entrypoint). launch_link
+# passes its address as GATEWAY_WELL_KNOWN_ADDRESS (host:port)
+if [ -n "${GATEWAY_WELL_KNOWN_ADDRESS:-}" ]; then
+    WELL_KNOWN_HOST=${GATEWAY_WELL_KNOWN_ADDRESS%:*}
+    WELL_KNOWN_PORT=${GATEWAY_WELL_KNOWN_ADDRESS##*:}
+    WELL_KNOWN_IP=$(getent hosts $WELL_KNOWN_HOST | awk '{ print $1; exit }')
+    if [ -n "$WELL_KNOWN_IP" ]; then
+        iptables -A FORWARD -i link0 -o eth0 -p tcp --syn -d $WELL_KNOWN_IP --dport $WELL_KNOWN_PORT -m conntrack --ctstate NEW -j ACCEPT
+        iptables -t nat -A PREROUTING -i link0 -p tcp -d 10.0.0.1 --dport 18527 -j DNAT --to-destination $WELL_KNOWN_IP:$WELL_KNOWN_PORT
+        iptables -t nat -A POSTROUTING -o eth0 -p tcp -d $WELL_KNOWN_IP --dport $WELL_KNOWN_PORT -j MASQUERADE
+    else
+        echo "Could not resolve $WELL_KNOWN_HOST, HTTPS well-known requests aren't relayed to the gateway"
+    fi
+fi
+
+# add or delete (A/D) the rules that forward the center port (tcp and udp) to the client
+center_port_rules() {
+    FAILED=0
+    for PROTO in tcp udp; do
+        iptables -$1 FORWARD -i eth0 -o link0 -p $PROTO --dport $CENTER_PORT -m conntrack --ctstate NEW -j ACCEPT || FAILED=1
+        iptables -t nat -$1 PREROUTING -i eth0 -p $PROTO --dport $CENTER_PORT -j DNAT --to-destination 10.0.0.2:$CENTER_PORT || FAILED=1
+        iptables -t nat -$1 POSTROUTING -o link0 -p $PROTO --dport $CENTER_PORT -j SNAT --to-source 10.0.0.1 || FAILED=1
+    done
+    return $FAILED
+}
+
+# forwards the center port in the kernel like ports 80 and 443, returns non-zero
+# (without leaving any rules behind) if that isn't possible so we can fall back to socat
+forward_nat() {
+    if [ "$(cat /proc/sys/net/ipv4/ip_forward)" != "1" ]; then
+        echo "IP forwarding is disabled, can't forward port $CENTER_PORT with iptables"
+        return 1
+    fi
+    if ! center_port_rules A; then
+        center_port_rules D 2>/dev/null
+        return 1
+    fi
+}
+
 # generic udp proxies
 
 # $1 is the forwarded port
@@ -44,10 +124,19 @@ if [ -z "$FORWARD_PORT" ]
 then
     socat UDP4-RECVFROM:18522,fork UDP4-SENDTO:10.0.0.2:18522,sp=18524,reuseaddr &
     socat UDP4-RECVFROM:18523,fork UDP4-SENDTO:10.0.0.2:18522,sp=18525,reuseaddr
+elif [ "$FORWARD_MODE" = "nat" ] && forward_nat; then
+    # the kernel forwards the center port, nothing to run per connection
+    echo "Forwarding port $CENTER_PORT to 10.0.0.2:$CENTER_PORT with iptables"
+    trap "exit 0" TERM INT
+    while true; do
+        sleep 3600 &
+        wait $!
+    done
 else
     # Just opening both TCP and UDP is the quick and dirty way of ensuring both protocols work
     # In the future, specifying a protocol in the docker compose snippet may be necessary
     # -- 2024-04-03 Zach
+    echo "Forwarding port $CENTER_PORT to 10.0.0.2:$CENTER_PORT with socat"
     socat TCP4-LISTEN:$CENTER_PORT,fork,reuseaddr TCP4:10.0.0.2:$CENTER_PORT,reuseaddr &
     socat UDP4-LISTEN:$CENTER_PORT,fork,reuseaddr UDP4:10.0.0.2:$CENTER_PORT,reuseaddr
 fi
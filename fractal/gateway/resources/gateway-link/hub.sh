@@ -0,0 +1,148 @@
+#!/bin/sh
+# Link hub: hosts the WireGuard peers of many links on a single link0 interface.
+#
+# usage: hub.sh start
+#        hub.sh add <name> <client pubkey> <fqdn>   -> prints "<hub pubkey> <peer address>"
+#        hub.sh remove <name>
+#        hub.sh list                               -> prints "<name> <index> <peer address> <http port> <https port> <fqdn> <pubkey>" per peer
+#
+# Every peer gets an index that determines its tunnel address (10.1.0.0/16) and the pair of
+# ports the gateway proxies its HTTP and HTTPS(SNI) traffic to. Peers are persisted in
+# $PEERS_DIR so they are restored when the hub restarts.
+
+set -e
+
+KEY_PATH="/etc/wireguard/link0.key"
+PEERS_DIR="/etc/wireguard/peers"
+READY_PATH="/run/hub.ready"
+HUB_ADDRESS="10.1.0.1"
+FIRST_INDEX=2
+# two ports per peer from PORT_BASE up to 65535
+PORT_BASE=10000
+MAX_INDEX=$(( (65535 - PORT_BASE) / 2 - 1 ))
+
+peer_address() {
+    echo "10.1.$(( $1 / 256 )).$(( $1 % 256 ))"
+}
+
+http_port() {
+    echo $(( PORT_BASE + $1 * 2 ))
+}
+
+https_port() {
+    echo $(( PORT_BASE + $1 * 2 + 1 ))
+}
+
+# add or delete (-A/-D) the forwarding rules of the peer with the given index
+peer_rules() {
+    ACTION=$1
+    ADDRESS=$(peer_address $2)
+    iptables -t nat $ACTION PREROUTING -i eth0 -p tcp --dport $(http_port $2) -j DNAT --to-destination $ADDRESS:8080
+    iptables -t nat $ACTION PREROUTING -i eth0 -p tcp --dport $(https_port $2) -j DNAT --to-destination $ADDRESS:8443
+}
+
+apply_peer() {
+    # <index> <pubkey>
+    wg set link0 peer $2 allowed-ips $(peer_address $1)/32
+    peer_rules -D $1 2>/dev/null || true
+    peer_rules -A $1
+}
+
+start() {
+    rm -f "$READY_PATH"
+    mkdir -p "$PEERS_DIR"
+    if [ ! -f "$KEY_PATH" ]; then
+        wg genkey > "$KEY_PATH"
+    fi
+
+    ip link add link0 type wireguard
+    wg set link0 private-key "$KEY_PATH"
+    wg set link0 listen-port 18521
+    ip addr add $HUB_ADDRESS/16 dev link0
+    ip link set link0 up
+    ip link set link0 mtu $LINK_MTU
+
+    iptables -A FORWARD -i eth0 -o link0 -p tcp --syn -m conntrack --ctstate NEW -j ACCEPT
+    iptables -A FORWARD -i eth0 -o link0 -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+    iptables -A FORWARD -i link0 -o eth0 -m conntrack --ctstate ESTABLISHED,RELATED -j ACCEPT
+    iptables -t nat -A POSTROUTING -o link0 -p tcp -j SNAT --to-source $HUB_ADDRESS
+
+    for peer in "$PEERS_DIR"/*; do
+        [ -f "$peer" ] || continue
+        read INDEX PUBKEY FQDN < "$peer"
+        apply_peer $INDEX $PUBKEY
+    done
+    touch "$READY_PATH"
+
+    trap "exit 0" TERM INT
+    while true; do
+        sleep 3600 &
+        wait $!
+    done
+}
+
+# waits for start to finish and serializes changes to the peers
+lock() {
+    for i in $(seq 50); do
+        [ -f "$READY_PATH" ] && break
+        sleep 0.2
+    done
+    if [ ! -f "$READY_PATH" ]; then
+        echo "Link hub is not ready" >&2
+        exit 1
+    fi
+
+    exec 9> /etc/wireguard/hub.lock
+    flock 9
+}
+
+add() {
+    lock
+    NAME=$1
+    PUBKEY=$2
+    FQDN=$3
+
+    if [ -f "$PEERS_DIR/$NAME" ]; then
+        # keep the index of an existing peer, only its key changes
+        read INDEX OLD_PUBKEY OLD_FQDN < "$PEERS_DIR/$NAME"
+        if [ "$OLD_PUBKEY" != "$PUBKEY" ]; then
+            wg set link0 peer $OLD_PUBKEY remove
+        fi
+    else
+        INDEX=$FIRST_INDEX
+        USED=$(cat "$PEERS_DIR"/* 2>/dev/null | cut -d' ' -f1 | sort -n)
+        for USED_INDEX in $USED; do
+            [ "$USED_INDEX" -eq "$INDEX" ] && INDEX=$(( INDEX + 1 ))
+        done
+        if [ "$INDEX" -gt "$MAX_INDEX" ]; then
+            echo "Link hub is full" >&2
+            exit 1
+        fi
+    fi
+
+    echo "$INDEX $PUBKEY $FQDN" > "$PEERS_DIR/$NAME"
+    apply_peer $INDEX $PUBKEY
+    echo "$(wg pubkey < $KEY_PATH) $(peer_address $INDEX)"
+}
+
+remove() {
+    lock
+    NAME=$1
+    [ -f "$PEERS_DIR/$NAME" ] || exit 0
+    read INDEX PUBKEY FQDN < "$PEERS_DIR/$NAME"
+    wg set link0 peer $PUBKEY remove
+    peer_rules -D $INDEX 2>/dev/null || true
+    rm "$PEERS_DIR/$NAME"
+}
+
+list() {
+    for peer in "$PEERS_DIR"/*; do
+        [ -f "$peer" ] || continue
+        read INDEX PUBKEY FQDN < "$peer"
+        echo "$(basename $peer) $INDEX $(peer_address $INDEX) $(http_port $INDEX) $(https_port $INDEX) $FQDN $PUBKEY"
+    done
+}
+
+COMMAND=$1
+shift
+$COMMAND "$@"
@@ -0,0 +1,148 @@
+"""
+Link routes rendered into the gateway's nginx.
+
+Every link gets an upstream block with a keepalive connection pool so that requests reuse
+connections to the link instead of opening one per request. Hostnames are mapped to their
+link's upstream through the `$link_route` (HTTP) and `$link_backend` (SNI) maps. Hostnames
+without a route fall back to the container of the same (dashed) name through Docker's DNS
+(see `http.conf.template`).
+"""
+
+import logging
+import os
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+import docker
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger(__name__)
+
+GATEWAY_ROUTES_DIR = "/etc/nginx/links"
+HTTP_ROUTES_PATH = f"{GATEWAY_ROUTES_DIR}/http.map"
+HTTP_UPSTREAMS_PATH = f"{GATEWAY_ROUTES_DIR}/upstreams.conf"
+STREAM_ROUTES_PATH = f"{GATEWAY_ROUTES_DIR}/stream.map"
+
+# idle connections each nginx worker keeps open to a link
+UPSTREAM_KEEPALIVE = int(os.environ.get("FRACTAL_GATEWAY_UPSTREAM_KEEPALIVE", "32"))
+UPSTREAM_KEEPALIVE_TIMEOUT = "60s"
+
+
+@dataclass
+class LinkRoute:
+    fqdn: str
+    # host:port the gateway proxies HTTP traffic to
+    http_upstream: str
+    # host:port the gateway proxies HTTPS (SNI) traffic to
+    https_upstream: str
+
+    @property
+    def upstream_name(self) -> str:
+        return "link_" + self.fqdn.replace(".", "_").replace("-", "_")
+
+
+def render_http_upstreams(routes: list[LinkRoute]) -> str:
+    blocks = ["# generated by fractal gateway, do not edit"]
+    for route in routes:
+        # `resolve` follows the link container to a new address when it is recreated
+        blocks.append(
+            f"upstream {route.upstream_name} {{\n"
+            f"    zone {route.upstream_name} 64k;\n"
+            f"    server {route.http_upstream} resolve;\n"
+            f"    keepalive {UPSTREAM_KEEPALIVE};\n"
+            f"    keepalive_timeout {UPSTREAM_KEEPALIVE_TIMEOUT};\n"
+            f"}}"
+        )
+    return "\n".join(blocks) + "\n"
+
+
+def render_http_routes(routes: list[LinkRoute]) -> str:
+    lines = ["# generated by fractal gateway, do not edit"]
+    lines.extend(f"{route.fqdn} {route.upstream_name};" for route in routes)
+    return "\n".join(lines) + "\n"
+
+
+def render_stream_routes(routes: list[LinkRoute]) -> str:
+    lines = ["# generated by fractal gateway, do not edit"]
+    lines.extend(f"{route.fqdn} {route.https_upstream};" for route in routes)
+    return "\n".join(lines) + "\n"
+
+
+def _list_link_containers(client: "DockerClient"):
+    from fractal.gateway.inventory import ContainerRecord, get_inventory
+    from fractal.gateway.utils import LINK_FQDN_LABEL
+
+    inventory = get_inventory()
+    if inventory:
+        return inventory.list(LINK_FQDN_LABEL)
+
+    return [
+        ContainerRecord.from_summary(summary)
+        for summary in client.api.containers(filters={"label": LINK_FQDN_LABEL})
+    ]
+
+
+def collect_link_routes(client: "DockerClient") -> list[LinkRoute]:
+    """
+    Returns the routes of all links on the gateway: links with their own container and the
+    peers of the link hub.
+    """
+    from fractal.gateway.hub import get_link_hub, list_hub_peers
+    from fractal.gateway.replacement import is_replacement
+    from fractal.gateway.utils import LINK_FQDN_LABEL, get_link_aliases
+
+    routes = {}
+    # a replacement only gets the link's traffic when the link has no running container of
+    # its own anymore (i.e. it was promoted, but not renamed yet)
+    records = sorted(
+        _list_link_containers(client), key=lambda record: not is_replacement(record.name)
+    )
+    for record in records:
+        if not record.running:
+            continue
+        # multi-route client links serve other links through the same tunnel
+        for fqdn in [record.labels[LINK_FQDN_LABEL], *get_link_aliases(record)]:
+            routes[fqdn] = LinkRoute(
+                fqdn=fqdn,
+                http_upstream=f"{record.name}:80",
+                https_upstream=f"{record.name}:443",
+            )
+
+    hub = get_link_hub(client, create=False)
+    if hub:
+        for peer in list_hub_peers(hub):
+            routes[peer.fqdn] = LinkRoute(
+                fqdn=peer.fqdn,
+                http_upstream=f"{hub.name}:{peer.http_port}",
+                https_upstream=f"{hub.name}:{peer.https_port}",
+            )
+
+    return sorted(routes.values(), key=lambda route: route.fqdn)
+
+
+def publish_link_routes(routes: list[LinkRoute], client: Optional["DockerClient"] = None) -> None:
+    """
+    Writes the rendered routes into the gateway container and reloads nginx.
+    """
+    from fractal.gateway.networks import connect_gateway
+    from fractal.gateway.utils import (
+        get_gateway_container,
+        reload_gateway,
+        write_gateway_file,
+    )
+
+    gateway = get_gateway_container(client=client)
+    # links on a network shard the gateway isn't attached to (anymore) can't be resolved
+    connect_gateway(gateway, client or docker.from_env())
+    write_gateway_file(gateway, HTTP_UPSTREAMS_PATH, render_http_upstreams(routes))
+    write_gateway_file(gateway, HTTP_ROUTES_PATH, render_http_routes(routes))
+    write_gateway_file(gateway, STREAM_ROUTES_PATH, render_stream_routes(routes))
+    reload_gateway(gateway)
+
+
+def sync_link_routes(client: "DockerClient") -> None:
+    routes = collect_link_routes(client)
+    logger.info("Publishing %s link routes to the gateway" % len(routes))
+    publish_link_routes(routes, client=client)
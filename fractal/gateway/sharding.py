@@ -0,0 +1,71 @@
+"""
+Sharding the links of a Gateway across a pool of gateway hosts.
+
+The hosts of a Gateway are its devices. Links are assigned to hosts by consistent hashing on
+their FQDN (the `consistent-hash` placement policy), so when a host joins or leaves the pool
+only the links that hash to a different host move: roughly 1/n of them when a host is added
+and only the links of the host when it is removed.
+
+The pool works on host keys and plain FQDNs. `Gateway.rebalance_links` plans the moves of
+a Gateway's links with it and records the new placements.
+"""
+
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from fractal.gateway.placement import HashRing
+
+SHARDING_POLICY = "consistent-hash"
+
+
+@dataclass
+class LinkMove:
+    fqdn: str
+    # None for links that weren't assigned to a host yet
+    source: Optional[str]
+    target: str
+
+
+class GatewayPool:
+    def __init__(self, hosts: Iterable[str] = ()):
+        self.ring = HashRing(hosts)
+
+    @property
+    def hosts(self) -> set[str]:
+        return self.ring.nodes
+
+    def add_host(self, host: str) -> None:
+        self.ring.add(host)
+
+    def remove_host(self, host: str) -> None:
+        self.ring.remove(host)
+
+    def host_for(self, fqdn: str) -> str:
+        host = self.ring.get(fqdn)
+        if host is None:
+            raise ValueError("Gateway pool has no hosts")
+        return host
+
+    def plan(self, assignments: dict[str, Optional[str]]) -> list[LinkMove]:
+        """
+        Returns the moves that bring `assignments` (fqdn -> host key) in line with the ring.
+        Links that are already on their host are left alone.
+        """
+        moves = []
+        for fqdn, source in sorted(assignments.items()):
+            target = self.host_for(fqdn)
+            if source != target:
+                moves.append(LinkMove(fqdn=fqdn, source=source, target=target))
+        return moves
+
+
+def distribution(
+    assignments: dict[str, Optional[str]], hosts: Iterable[str] = ()
+) -> dict[str, int]:
+    """
+    Returns the number of links per host, including hosts without links.
+    """
+    counts = Counter({host: 0 for host in hosts})
+    counts.update(host or "unassigned" for host in assignments.values())
+    return dict(sorted(counts.items()))
@@ -1,13 +1,7 @@
 import logging
-from typing import Optional
+from typing import Any, Optional
 
-import docker
 from asgiref.sync import sync_to_async
-from fractal.gateway.utils import (
-    generate_wireguard_keypair,
-    get_gateway_container,
-    launch_link,
-)
 from fractal_database.utils import use_django
 from fractal_database_matrix.broker.instance import broker
 from taskiq import Context, TaskiqDepends
@@ -51,22 +45,23 @@ async def link_up(
     link_fqdn: str,
     tcp_forwarding: bool,
     forward_port: Optional[str] = None,
+    aliases: Optional[list[str]] = None,
     context: Context = TaskiqDepends(),  # needed to get the task kicker
-) -> tuple[str, str, str, str]:
+) -> dict[str, Any]:
     """
     Device task intended to be run by a device running next to a Gateway container (Gateway Device)
     If kicked via matrix, will check if the kicker matrix id is a member of the database the link fqdn
     belongs to. If so, the task handles launching a link container and adding it to the gateway network.
 
     On success, returns all of the necessary configuration for the client to connect to the link.
+    `aliases` are the FQDNs of other links that a multi-route client link serves through the
+    link's tunnel, the gateway routes them to the link's container as well.
 
     Returns:
-    - tuple[
-        wireguard_pubkey,
-        link_address,
-        client_private_key,
-        forward_port,
-    ], contains the generated WireGuard public key, the link's address, the client's private key, and the forward_port that was assigned.
+    - Dict, with the keys gateway_link_public_key, link_address, client_private_key,
+        forward_port (None for links hosted by the link hub, see fractal.gateway.hub),
+        tunnel_address (the client's address inside of the link hub's tunnel, None for
+        other links) and mtu (the tunnel MTU the link's client reported, if it did).
     """
     # get the user from the kicked message labels
     # context will have a message attr if the task was yielded from a worker
@@ -74,7 +69,8 @@ async def link_up(
         matrix_id = context.message.labels.get("sender")
 
         try:
-            await _verify_matrix_id_is_database_member(matrix_id, link_fqdn)
+            for fqdn in [link_fqdn, *(aliases or [])]:
+                await _verify_matrix_id_is_database_member(matrix_id, fqdn)
         except Exception as e:
             raise ValueError(f"Error verifying matrix id {matrix_id} is database member: {e}")
 
@@ -82,6 +78,16 @@ async def link_up(
         # FIXME: task was called directly, not from matrix
         logger.warning("FIXME: task was called directly, not from matrix. Can't get matrix_id")
 
+    # imported here since models.py and the CLI load this module just to reference the tasks
+    import docker
+    from fractal.gateway.hub import add_hub_peer, link_hub_enabled, remove_stale_hub_peers
+    from fractal.gateway.utils import (
+        generate_wireguard_keypair,
+        get_gateway_container,
+        launch_link,
+        read_link_mtu,
+    )
+
     client = docker.from_env()
 
     # ensure that the gateway container exists
@@ -90,12 +96,68 @@ async def link_up(
     # generate link client keypair
     client_private_key, client_public_key = generate_wireguard_keypair(client)
 
+    # the link hub's peers have no container of their own to route aliases to
+    if link_hub_enabled() and not tcp_forwarding and not aliases:
+        logger.info("Adding link %s to the link hub", link_fqdn)
+        gateway_link_public_key, link_address, tunnel_address = await sync_to_async(
+            add_hub_peer
+        )(link_fqdn, client_public_key, client=client)
+        return {
+            "gateway_link_public_key": gateway_link_public_key,
+            "link_address": link_address,
+            "client_private_key": client_private_key,
+            "forward_port": None,
+            "tunnel_address": tunnel_address,
+            "mtu": None,
+        }
+
+    # the gateway routes hub peers last, a peer left over from before would shadow the
+    # link's new container
+    await sync_to_async(remove_stale_hub_peers)([link_fqdn, *(aliases or [])], client=client)
+
     logger.info("Launching gateway link with fqdn %s", link_fqdn)
-    gateway_link_public_key, link_address, forward_port = launch_link(
+    gateway_link_public_key, link_address, forward_port = await sync_to_async(
+        launch_link, thread_sensitive=False
+    )(
         link_fqdn,
         client_public_key,
         client=client,
         tcp_forwarding=tcp_forwarding,
         forward_port=forward_port,
+        aliases=aliases,
     )
-    return (gateway_link_public_key, link_address, client_private_key, forward_port)
+    return {
+        "gateway_link_public_key": gateway_link_public_key,
+        "link_address": link_address,
+        "client_private_key": client_private_key,
+        "forward_port": forward_port,
+        "tunnel_address": None,
+        "mtu": read_link_mtu(link_fqdn),
+    }
+
+
+@broker.task(queue="device")
+async def link_down(
+    link_fqdn: str,
+    context: Context = TaskiqDepends(),  # needed to get the task kicker
+) -> bool:
+    """
+    Device task intended to be run by a Gateway Device. Takes the link's container (or its peer
+    on the link hub) down. If kicked via matrix, verifies that the kicker is a member of the
+    database the link belongs to, like `link_up`.
+
+    Returns:
+    - bool, whether the link was up.
+    """
+    if hasattr(context, "message"):
+        matrix_id = context.message.labels.get("sender")
+
+        try:
+            await _verify_matrix_id_is_database_member(matrix_id, link_fqdn)
+        except Exception as e:
+            raise ValueError(f"Error verifying matrix id {matrix_id} is database member: {e}")
+
+    from fractal.gateway.teardown import take_link_down
+
+    logger.info("Taking gateway link with fqdn %s down", link_fqdn)
+    return await sync_to_async(take_link_down)(link_fqdn)
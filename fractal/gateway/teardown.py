@@ -0,0 +1,183 @@
+"""
+Tearing links down and garbage collecting the link containers of links that are gone.
+
+A link container is an orphan when no Link on this gateway host maps to its name: the link
+was deleted, or it was re-pointed (placed on another host). Orphans are found with a single
+Docker list call (or none when the container inventory is running) and removed in parallel,
+which frees their published ports for new links.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Iterable, Optional
+
+import docker
+from docker.errors import NotFound
+from fractal.gateway.hub import (
+    LINK_HUB_LABEL,
+    get_link_hub,
+    list_hub_peers,
+    remove_hub_peer,
+)
+from fractal.gateway.inventory import GATEWAY_LINK_LABEL, ContainerRecord, get_inventory
+from fractal.gateway.replacement import discard_replacement, get_replacement_name
+from fractal.gateway.routes import sync_link_routes
+from fractal.gateway.utils import (
+    LINK_FQDN_LABEL,
+    find_container,
+    get_link_container_name,
+    remove_link_state,
+)
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 16
+
+
+@dataclass
+class Orphan:
+    name: str
+    fqdn: Optional[str]
+    # the container of a dedicated link, None for peers of the link hub
+    record: Optional[ContainerRecord] = None
+
+
+def _remove_container(record: ContainerRecord, client: "DockerClient") -> None:
+    try:
+        client.containers.prepare_model(record.attrs).remove(force=True)
+    except NotFound:
+        pass
+
+
+def take_link_down(
+    link_fqdn: str, client: Optional["DockerClient"] = None, sync_routes: bool = True
+) -> bool:
+    """
+    Removes a link's container (or its peer on the link hub) from the gateway.
+
+    Returns:
+    - bool, whether the link was up.
+    """
+    client = client or docker.from_env()
+    name = get_link_container_name(link_fqdn)
+    was_up = False
+
+    record = find_container(name, client)
+    if record:
+        logger.info("Removing gateway link container %s" % name)
+        _remove_container(record, client)
+        was_up = True
+    discard_replacement(link_fqdn, client)
+    remove_link_state(link_fqdn)
+
+    hub = get_link_hub(client, create=False)
+    if hub and any(peer.name == name for peer in list_hub_peers(hub)):
+        remove_hub_peer(link_fqdn, client, sync_routes=False)
+        was_up = True
+
+    if was_up and sync_routes:
+        sync_link_routes(client)
+    return was_up
+
+
+def take_links_down(
+    link_fqdns: Iterable[str], client: Optional["DockerClient"] = None
+) -> dict[str, bool]:
+    """
+    Takes several links down in parallel and republishes the gateway's routes once.
+
+    Returns:
+    - Dict, fqdn -> whether the link was up.
+    """
+    client = client or docker.from_env()
+    link_fqdns = list(link_fqdns)
+    if not link_fqdns:
+        return {}
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(link_fqdns))) as executor:
+        results = dict(
+            zip(
+                link_fqdns,
+                executor.map(
+                    lambda fqdn: take_link_down(fqdn, client, sync_routes=False), link_fqdns
+                ),
+            )
+        )
+
+    if any(results.values()):
+        sync_link_routes(client)
+    return results
+
+
+def find_orphans(link_fqdns: Iterable[str], client: "DockerClient") -> list[Orphan]:
+    """
+    Returns the link containers and hub peers that don't belong to any of `link_fqdns`.
+    """
+    link_fqdns = list(link_fqdns)
+    names = {get_link_container_name(fqdn) for fqdn in link_fqdns}
+    # pending replacements are the reconciler's to promote or discard
+    names.update(get_replacement_name(fqdn) for fqdn in link_fqdns)
+
+    inventory = get_inventory()
+    if inventory:
+        records = inventory.list(GATEWAY_LINK_LABEL)
+    else:
+        records = [
+            ContainerRecord.from_summary(summary)
+            for summary in client.api.containers(
+                all=True, filters={"label": GATEWAY_LINK_LABEL}
+            )
+        ]
+
+    orphans = [
+        Orphan(name=record.name, fqdn=record.labels.get(LINK_FQDN_LABEL), record=record)
+        for record in records
+        if LINK_HUB_LABEL not in record.labels and record.name not in names
+    ]
+
+    hub = get_link_hub(client, create=False)
+    if hub:
+        orphans.extend(
+            Orphan(name=peer.name, fqdn=peer.fqdn)
+            for peer in list_hub_peers(hub)
+            if peer.name not in names
+        )
+    return orphans
+
+
+def collect_garbage(
+    link_fqdns: Iterable[str], client: Optional["DockerClient"] = None, dry_run: bool = False
+) -> list[Orphan]:
+    """
+    Removes the orphaned link containers and hub peers in parallel.
+
+    Parameters:
+    - link_fqdns: Iterable[str], the FQDNs of the links this gateway host should serve.
+    - dry_run: Bool, only find the orphans. Defaults to False.
+
+    Returns:
+    - list[Orphan], the orphans that were (or would be) removed.
+    """
+    client = client or docker.from_env()
+    orphans = find_orphans(link_fqdns, client)
+    if dry_run or not orphans:
+        return orphans
+
+    def remove(orphan: Orphan) -> None:
+        logger.info("Removing orphaned link %s (%s)" % (orphan.name, orphan.fqdn))
+        if orphan.record:
+            _remove_container(orphan.record, client)
+            if orphan.fqdn:
+                remove_link_state(orphan.fqdn)
+        else:
+            remove_hub_peer(orphan.fqdn, client, sync_routes=False)  # type: ignore
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(orphans))) as executor:
+        list(executor.map(remove, orphans))
+
+    sync_link_routes(client)
+    return orphans
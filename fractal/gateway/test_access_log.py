@@ -0,0 +1,56 @@
+import json
+import math
+
+from .access_log import (
+    LATENCY_BUCKETS,
+    AccessLogIngestor,
+    LinkStats,
+    parse_upstream_time,
+)
+
+
+def _line(**entry) -> bytes:
+    return json.dumps(entry).encode() + b"\n"
+
+
+def test_parse_upstream_time():
+    assert parse_upstream_time("0.004") == 0.004
+    assert parse_upstream_time("0.004, 0.010") == 0.014
+    assert parse_upstream_time("0.004 : 0.010") == 0.014
+    assert parse_upstream_time("-") is None
+    assert parse_upstream_time("") is None
+
+
+def test_feed_keeps_partial_lines():
+    ingestor = AccessLogIngestor()
+    log = _line(time=120.5, host="a.example.com", status=200, upstream_response_time="0.02")
+    log += _line(time=121.0, host="b.example.com", status=502, upstream_response_time="-")
+
+    consumed = 0
+    for i in range(0, len(log), 7):
+        consumed += ingestor.feed(log[i : i + 7])
+
+    assert consumed == len(log)
+    assert ingestor.links["a.example.com"].requests == 1
+    assert ingestor.links["a.example.com"].statuses["2xx"] == 1
+    assert ingestor.links["b.example.com"].statuses["5xx"] == 1
+    # requests that never reached the link don't count towards its latency
+    assert sum(ingestor.links["b.example.com"].latency) == 0
+
+
+def test_link_stats():
+    stats = LinkStats()
+    for i in range(100):
+        stats.record(
+            {"time": 60 * 10 + i % 60, "status": 200, "upstream_response_time": "0.003"}
+        )
+    stats.record({"time": 60 * 10, "status": 404, "upstream_response_time": "0.3"})
+    stats.record({"time": 60 * 10, "kind": "stream", "status": 200, "upstream_connect_time": "20"})
+
+    assert stats.percentile(0.5) == LATENCY_BUCKETS[0]
+    assert stats.percentile(1.0) == math.inf
+    assert stats.rate(1, now=60 * 11) == 102 / 60
+    assert stats.rate(1, now=60 * 12) == 0
+
+    restored = LinkStats.from_dict(json.loads(json.dumps(stats.to_dict())))
+    assert restored == stats
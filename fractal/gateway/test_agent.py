@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from . import agent as agent_module
+from .agent import (
+    AgentUnavailable,
+    GatewayAgent,
+    call_agent,
+    collect_operations,
+    served_by_agent,
+)
+
+
+class EchoController:
+    PLUGIN_NAME = "echo"
+    calls = []
+
+    @served_by_agent
+    def say(self, text: str, fail: bool = False, **kwargs):
+        self.calls.append((threading.current_thread().name, text, kwargs.get("project_name")))
+        print(text)
+        if fail:
+            print("failed", file=sys.stderr)
+            sys.exit(3)
+
+
+@pytest.fixture
+def running_agent(tmp_path, monkeypatch):
+    path = str(tmp_path / "agent.sock")
+    monkeypatch.setattr(agent_module, "AGENT_SOCKET_PATH", path)
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    monkeypatch.setattr(sys, "stderr", sys.stderr)
+
+    agent = GatewayAgent(collect_operations(EchoController), {"project_name": "test"})
+    thread = threading.Thread(target=agent.serve, args=(path,), daemon=True)
+    thread.start()
+    for _ in range(100):
+        if os.path.exists(path):
+            break
+        time.sleep(0.01)
+
+    yield agent
+    agent.shutdown()
+    thread.join()
+    EchoController.calls.clear()
+
+
+def test_operations_run_in_the_agent(running_agent, capfd):
+    EchoController().say("hello")
+    # the call was forwarded, ran in one of the agent's threads and its output replayed
+    assert EchoController.calls == [(EchoController.calls[0][0], "hello", "test")]
+    assert EchoController.calls[0][0] != threading.current_thread().name
+    assert capfd.readouterr().out == "hello\n"
+
+    with pytest.raises(SystemExit) as exit_info:
+        EchoController().say("bye", fail=True)
+    assert exit_info.value.code == 3
+    assert capfd.readouterr().err == "failed\n"
+
+
+def test_unknown_operations(running_agent):
+    response = call_agent("echo.nope")
+    assert response["exit_code"] == 2
+
+
+def test_without_agent_commands_run_in_process(tmp_path, monkeypatch):
+    monkeypatch.setattr(agent_module, "AGENT_SOCKET_PATH", str(tmp_path / "missing.sock"))
+    with pytest.raises(AgentUnavailable):
+        call_agent("echo.say", ["hi"])
+
+    EchoController().say("local")
+    assert EchoController.calls[-1] == (threading.current_thread().name, "local", None)
+    EchoController.calls.clear()
+
+
+def test_handle_stream(monkeypatch):
+    monkeypatch.setattr(sys, "stdout", sys.stdout)
+    monkeypatch.setattr(sys, "stderr", sys.stderr)
+    agent = GatewayAgent(collect_operations(EchoController))
+    wfile = io.BytesIO()
+    agent.handle_stream(
+        io.BytesIO(b'{"operation": "echo.say", "args": ["a"]}\n\nnot json\n'), wfile
+    )
+    responses = wfile.getvalue().splitlines()
+    assert len(responses) == 2
+    assert b'"exit_code": 0' in responses[0] and b'"exit_code": 2' in responses[1]
+    EchoController.calls.clear()
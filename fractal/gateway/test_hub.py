@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from . import hub
+from .hub import remove_stale_hub_peers
+
+
+class FakeHub:
+    def __init__(self, peers: list[str]):
+        self.peers = peers
+        self.calls = []
+
+    def exec_run(self, cmd):
+        self.calls.append(tuple(cmd[1:]))
+        if cmd[1] == "list":
+            # <name> <index> <peer address> <http port> <https port> <fqdn> <pubkey>
+            output = "\n".join(
+                f"{name} {i} 10.1.0.{i} {10000 + 2 * i} {10001 + 2 * i} {name}.com key{i}"
+                for i, name in enumerate(self.peers, start=2)
+            )
+        else:
+            self.peers.remove(cmd[2])
+            output = ""
+        return SimpleNamespace(exit_code=0, output=output.encode())
+
+
+def test_remove_stale_hub_peers(monkeypatch):
+    fake_hub = FakeHub(["a-example-com", "b-example-com"])
+    monkeypatch.setattr(hub, "get_link_hub", lambda client, create: fake_hub)
+
+    assert remove_stale_hub_peers(["a.example.com", "c.example.com"], client=object())
+    assert fake_hub.peers == ["b-example-com"]
+    assert fake_hub.calls == [("list",), ("remove", "a-example-com")]
+
+    # nothing to remove, no remove calls
+    fake_hub.calls.clear()
+    assert not remove_stale_hub_peers(["a.example.com"], client=object())
+    assert fake_hub.calls == [("list",)]
+
+
+def test_remove_stale_hub_peers_without_hub(monkeypatch):
+    monkeypatch.setattr(hub, "get_link_hub", lambda client, create: None)
+    assert not remove_stale_hub_peers(["a.example.com"], client=object())
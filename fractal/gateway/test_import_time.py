@@ -0,0 +1,60 @@
+import re
+import subprocess
+import sys
+
+import pytest
+
+# modules the CLI plugins must not import until a command needs them
+HEAVY_MODULES = (
+    "docker",
+    "tldextract",
+    "taskiq",
+    "sh",
+    "django.db",
+    "fractal_database_matrix",
+    "fractal.gateway.models",
+    "fractal.gateway.utils",
+)
+
+# cumulative import time budget of a plugin module, in microseconds
+IMPORT_BUDGET = 200_000
+
+IMPORTTIME_RE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)$")
+
+
+def _importtime(module: str) -> dict[str, int]:
+    """
+    Imports `module` in a fresh interpreter with `-X importtime`.
+
+    Returns:
+    - dict[str, int], cumulative import time in microseconds of every module imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        pytest.skip(f"{module} can't be imported here: {result.stderr.splitlines()[-1]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            times[match.group(3)] = int(match.group(1))
+    return times
+
+
+@pytest.mark.parametrize(
+    "module", ["fractal.gateway.controllers.link", "fractal.gateway.controllers.gateway"]
+)
+def test_plugin_import_is_lazy(module):
+    times = _importtime(module)
+
+    heavy = [
+        name
+        for name in times
+        if any(name == heavy or name.startswith(f"{heavy}.") for heavy in HEAVY_MODULES)
+    ]
+    assert heavy == []
+    assert times[module] < IMPORT_BUDGET, f"{module} took {times[module] / 1000:.0f}ms to import"
@@ -0,0 +1,242 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from . import inventory
+from .inventory import ContainerInventory, ContainerRecord, get_inventory, start_inventory
+
+
+class FakeInventory:
+    def __init__(self, synced: bool):
+        self.synced = synced
+        self.waited = []
+
+    def wait_synced(self, timeout=None) -> bool:
+        self.waited.append(timeout)
+        return self.synced
+
+
+def test_get_inventory_does_not_start_it(monkeypatch):
+    monkeypatch.setattr(inventory, "_inventory", None)
+    monkeypatch.setattr(inventory.docker, "from_env", pytest.fail)
+    threads = threading.active_count()
+
+    assert get_inventory() is None
+    assert threading.active_count() == threads
+
+
+def test_get_inventory_fails_fast(monkeypatch):
+    unsynced = FakeInventory(synced=False)
+    monkeypatch.setattr(inventory, "_inventory", unsynced)
+    assert get_inventory() is None
+    assert unsynced.waited == [0]
+
+    synced = FakeInventory(synced=True)
+    monkeypatch.setattr(inventory, "_inventory", synced)
+    assert get_inventory() is synced
+
+
+def test_start_inventory_without_docker(monkeypatch):
+    def from_env():
+        raise ConnectionError("no docker")
+
+    monkeypatch.setattr(inventory, "_inventory", None)
+    monkeypatch.setattr(inventory.docker, "from_env", from_env)
+    assert start_inventory() is None
+    assert get_inventory() is None
+
+
+def test_wait_for_container_without_inventory(monkeypatch):
+    monkeypatch.setattr(inventory, "_inventory", None)
+    assert inventory.wait_for_container("a-example-com", "id")
+
+
+def _summary(container_id: str, name: str, status: str = "Up 2 minutes", **labels) -> dict:
+    return {
+        "Id": container_id,
+        "Names": [f"/{name}"],
+        "Labels": labels or {inventory.GATEWAY_LINK_LABEL: "true"},
+        "Ports": [],
+        "State": "running" if status.startswith("Up") else "exited",
+        "Status": status,
+    }
+
+
+def _inspect(container_id: str, name: str, state: str = "running", health=None) -> dict:
+    return {
+        "Id": container_id,
+        "Name": f"/{name}",
+        "Config": {"Labels": {inventory.GATEWAY_LINK_LABEL: "true"}},
+        "NetworkSettings": {"Ports": {}},
+        "State": {"Status": state, **({"Health": {"Status": health}} if health else {})},
+    }
+
+
+def _event(action: str, container_id: str, **attributes) -> dict:
+    attributes = attributes or {inventory.GATEWAY_LINK_LABEL: "true"}
+    return {
+        "Type": "container",
+        "Action": action,
+        "Actor": {"ID": container_id, "Attributes": attributes},
+    }
+
+
+class FakeAPI:
+    """
+    The container list and inspect endpoints of the Docker API, counting the calls made.
+    """
+
+    def __init__(self, summaries=(), inspects=()):
+        self.summaries = list(summaries)
+        self.inspects = {attrs["Id"]: attrs for attrs in inspects}
+        self.calls = []
+
+    def containers(self, all=False, filters=None):
+        self.calls.append(("containers", filters["label"]))
+        return [summary for summary in self.summaries if filters["label"] in summary["Labels"]]
+
+    def inspect_container(self, container_id):
+        self.calls.append(("inspect", container_id))
+        if container_id not in self.inspects:
+            raise inventory.NotFound(f"No such container: {container_id}")
+        return self.inspects[container_id]
+
+
+def _inventory(summaries=(), inspects=()) -> ContainerInventory:
+    client = SimpleNamespace(api=FakeAPI(summaries, inspects))
+    return ContainerInventory(client)  # type: ignore
+
+
+def test_from_summary_ports_and_health():
+    summary = _summary("a", "a-example-com", status="Up 5 minutes (health: starting)")
+    summary["Ports"] = [
+        {"PrivatePort": 18521, "Type": "udp", "IP": "0.0.0.0", "PublicPort": 30000},
+        {"PrivatePort": 18521, "Type": "udp", "IP": "::", "PublicPort": 30000},
+        {"PrivatePort": 80, "Type": "tcp"},
+    ]
+    record = ContainerRecord.from_summary(summary)
+    assert record.name == "a-example-com" and record.running
+    assert record.ports == {
+        "18521/udp": [
+            {"HostIp": "0.0.0.0", "HostPort": "30000"},
+            {"HostIp": "::", "HostPort": "30000"},
+        ],
+        "80/tcp": None,
+    }
+    assert record.host_port("18521/udp") == "30000"
+    assert record.host_port("80/tcp") is None
+    assert record.health == "starting"
+
+    for status, health in [
+        ("Up 1 hour (healthy)", "healthy"),
+        ("Up 1 hour (unhealthy)", "unhealthy"),
+        ("Up 1 hour", None),
+        ("Exited (1) 2 minutes ago", None),
+    ]:
+        assert ContainerRecord.from_summary(_summary("a", "a", status=status)).health == health
+
+
+def test_resync_lists_each_watched_label():
+    gateway = _summary("gw", "fractal-gateway", **{inventory.GATEWAY_LABEL: "1"})
+    links = [_summary("a", "a-example-com"), _summary("b", "b-example-com", status="Exited (0)")]
+    containers = _inventory(summaries=[gateway, *links])
+
+    containers.resync()
+    assert containers.client.api.calls == [
+        ("containers", inventory.GATEWAY_LABEL),
+        ("containers", inventory.GATEWAY_LINK_LABEL),
+    ]
+    assert containers.get("fractal-gateway").id == "gw"
+    assert [record.name for record in containers.list(inventory.GATEWAY_LINK_LABEL)] == [
+        "a-example-com",
+        "b-example-com",
+    ]
+    assert not containers.get("b-example-com").running
+    assert containers.generation == 1
+
+    # a resync replaces the inventory
+    containers.client.api.summaries = [gateway]
+    containers.resync()
+    assert containers.list(inventory.GATEWAY_LINK_LABEL) == []
+    assert containers.generation == 2
+
+
+def test_handle_event():
+    containers = _inventory(
+        summaries=[_summary("a", "a-example-com")],
+        inspects=[_inspect("b", "b-example-com")],
+    )
+    containers.resync()
+    api = containers.client.api
+
+    # started containers are inspected and added
+    containers._handle_event(_event("start", "b"))
+    assert containers.get("b-example-com").running
+
+    # renames and health changes are picked up from the inspect result
+    api.inspects["b"] = _inspect("b", "b-example-com-next", health="unhealthy")
+    containers._handle_event(_event("rename", "b"))
+    assert containers.get("b-example-com") is None
+    assert containers.get("b-example-com-next").health == "unhealthy"
+
+    api.inspects["b"] = _inspect("b", "b-example-com-next", health="healthy")
+    containers._handle_event(_event("health_status: healthy", "b"))
+    assert containers.get("b-example-com-next").health == "healthy"
+
+    # destroyed containers are dropped without an inspect
+    api.calls.clear()
+    containers._handle_event(_event("destroy", "a"))
+    assert containers.get("a-example-com") is None
+    assert api.calls == []
+
+
+def test_handle_event_ignores_unrelated_events():
+    containers = _inventory(inspects=[_inspect("a", "a-example-com")])
+    containers.resync()
+    api = containers.client.api
+    api.calls.clear()
+
+    for event in [
+        _event("exec_start: wg show", "a"),
+        _event("exec_die", "a"),
+        _event("attach", "a"),
+        # not a gateway or link container
+        _event("start", "a", **{"com.example": "1"}),
+    ]:
+        containers._handle_event(event)
+    assert api.calls == []
+    assert containers.get("a-example-com") is None
+    assert containers.generation == 1
+
+
+def test_handle_event_for_a_container_that_is_already_gone():
+    # the container is removed between its event and the inspect
+    containers = _inventory(summaries=[_summary("a", "a-example-com")])
+    containers.resync()
+
+    containers._handle_event(_event("die", "a"))
+    assert containers.get("a-example-com") is None
+    assert containers.client.api.calls[-1] == ("inspect", "a")
+
+
+def test_wait_for_and_wait_changed():
+    containers = _inventory(inspects=[_inspect("a", "a-example-com")])
+    containers.resync()
+    generation = containers.generation
+
+    # nothing changes: both time out
+    assert containers.wait_changed(generation, timeout=0.01) == generation
+    assert containers.wait_for("a-example-com", lambda record: True, timeout=0.01) is None
+
+    timer = threading.Timer(0.05, containers._handle_event, [_event("start", "a")])
+    timer.start()
+    try:
+        record = containers.wait_for("a-example-com", lambda record: record.running, timeout=5)
+    finally:
+        timer.join()
+    assert record is not None and record.id == "a"
+    assert containers.wait_changed(generation, timeout=0) == generation + 1
+
+    # already satisfied, returns right away
+    assert containers.wait_for("a-example-com", lambda record: True, timeout=0) is record
@@ -0,0 +1,85 @@
+import time
+from dataclasses import replace
+
+from .link_metrics import LinkMetricsCollector, LinkSeries, parse_wg_dump, render_metrics
+
+DUMP = (
+    "cHJpdmF0ZQ==\tcHVibGlj\t18521\toff\n"
+    "Y2xpZW50\t(none)\t1.2.3.4:51820\t10.0.0.2/32\t1700000000\t1000\t2000\toff\n"
+)
+
+
+def test_parse_wg_dump():
+    [peer] = parse_wg_dump(DUMP)
+    assert peer.pubkey == "Y2xpZW50"
+    assert peer.latest_handshake == 1700000000
+    assert (peer.rx, peer.tx) == (1000, 2000)
+
+
+def test_link_series_ring():
+    series = LinkSeries(size=4)
+    for i in range(6):
+        series.append(100.0 + i * 10, rx=i * 100, tx=i * 50, latest_handshake=100 + i * 10)
+
+    assert len(series) == 4
+    assert series.latest() == (150.0, 500, 250, 150)
+    # the ring only holds the last 4 samples (t=120..150)
+    assert series.rates(window=1000) == (10.0, 5.0)
+
+    # a restarted link container resets its counters
+    series.append(160.0, rx=100, tx=0, latest_handshake=160)
+    assert series.rates(window=10) == (10.0, 0.0)
+
+
+def test_link_series_idle():
+    series = LinkSeries(size=10)
+    series.append(0.0, 100, 100, 0)
+    series.append(60.0, 200, 100, 60)
+    for t in range(120, 600, 60):
+        series.append(float(t), 200, 100, 60)
+
+    assert series.last_active() == 60.0
+    assert series.idle(idle_after=300, now=540.0)
+    assert not series.idle(idle_after=600, now=540.0)
+
+
+def test_collector_roundtrip():
+    collector = LinkMetricsCollector(size=8)
+    for sample in parse_wg_dump(DUMP):
+        collector.record("app.example.com", sample, 1700000010.0)
+
+    restored = LinkMetricsCollector.from_dict(collector.to_dict())
+    assert restored.series["app.example.com"].latest() == (1700000010.0, 1000, 2000, 1700000000)
+
+
+def test_render_metrics_groups_each_family():
+    collector = LinkMetricsCollector()
+    [peer] = parse_wg_dump(DUMP)
+    now = time.time()
+    collector.record("a.example.com", peer, now)
+    collector.record("b.example.com", replace(peer, latest_handshake=0), now)
+
+    families = {}
+    current = None
+    for line in render_metrics(collector).splitlines():
+        if line.startswith("# HELP "):
+            current = line.split()[2]
+            assert current not in families
+            families[current] = []
+        elif not line.startswith("# TYPE "):
+            # every sample follows its own family's HELP and TYPE
+            assert line.split("{")[0] == current
+            families[current].append(line)
+
+    assert list(families) == [
+        "fractal_link_rx_bytes",
+        "fractal_link_tx_bytes",
+        "fractal_link_handshake_age_seconds",
+        "fractal_link_idle",
+    ]
+    assert families["fractal_link_rx_bytes"] == [
+        'fractal_link_rx_bytes{link="a.example.com"} 1000',
+        'fractal_link_rx_bytes{link="b.example.com"} 1000',
+    ]
+    # b never had a handshake
+    assert len(families["fractal_link_handshake_age_seconds"]) == 1
@@ -0,0 +1,48 @@
+import io
+import json
+
+import pytest
+
+from .listing import LIST_CHUNK_SIZE, display_rows, paginate
+
+
+def test_paginate():
+    rows = list(range(10))
+    assert paginate(rows) == rows
+    assert paginate(rows, page=2, page_size=4) == [4, 5, 6, 7]
+    assert paginate(rows, page=3, page_size=4) == [8, 9]
+    assert paginate(rows, page=4, page_size=4) == []
+
+    # CLI options arrive as strings
+    assert paginate(rows, page="2", page_size="4") == [4, 5, 6, 7]
+    assert paginate(rows, page_size="3") == [0, 1, 2]
+
+    with pytest.raises(ValueError):
+        paginate(rows, page_size="ten")
+    with pytest.raises(ValueError):
+        paginate(rows, page=2)
+    with pytest.raises(ValueError):
+        paginate(rows, page=0, page_size=4)
+
+
+def test_jsonl_streams_rows():
+    written = []
+
+    class Output(io.StringIO):
+        def write(self, text):
+            written.append(text)
+            return super().write(text)
+
+    def rows():
+        for i in range(LIST_CHUNK_SIZE + 1):
+            yield {"fqdn": f"link{i}.example.com", "state": "up"}
+
+    output = Output()
+    assert display_rows(rows(), title="Links", format="jsonl", file=output) == LIST_CHUNK_SIZE + 1
+    # written a chunk at a time, not after reading all rows
+    assert len(written) == 2
+    lines = output.getvalue().splitlines()
+    assert json.loads(lines[-1]) == {"fqdn": f"link{LIST_CHUNK_SIZE}.example.com", "state": "up"}
+
+    with pytest.raises(ValueError):
+        display_rows([], title="Links", format="yaml")
@@ -0,0 +1,43 @@
+from collections import Counter
+
+from .networks import (
+    GATEWAY_NETWORK_NAME,
+    connect_gateway,
+    get_network_shard,
+    get_shard_network_name,
+)
+
+
+class FakeNetwork:
+    def __init__(self, name: str):
+        self.name = name
+        self.connected = []
+
+    def connect(self, container):
+        self.connected.append(container.name)
+
+
+class FakeGateway:
+    name = "fractal-gateway"
+
+    def __init__(self, networks: list[str]):
+        self.attrs = {"NetworkSettings": {"Networks": {name: {} for name in networks}}}
+
+
+def test_links_are_spread_across_shards():
+    fqdns = [f"app{i}.example.com" for i in range(4000)]
+    counts = Counter(get_network_shard(fqdn, shards=4) for fqdn in fqdns)
+    assert sorted(counts) == [0, 1, 2, 3]
+    assert all(800 < count < 1200 for count in counts.values())
+
+    assert get_network_shard("app1.example.com", shards=1) == 0
+
+
+def test_connect_gateway():
+    assert get_shard_network_name(0) == GATEWAY_NETWORK_NAME
+    networks = [FakeNetwork(get_shard_network_name(shard)) for shard in range(3)]
+    gateway = FakeGateway([GATEWAY_NETWORK_NAME])
+
+    connected = connect_gateway(gateway, None, networks=networks)  # type: ignore
+    assert connected == [get_shard_network_name(1), get_shard_network_name(2)]
+    assert networks[0].connected == []
@@ -0,0 +1,72 @@
+import pytest
+
+from .placement import (
+    Candidate,
+    HashRing,
+    PlacementPolicy,
+    get_placement_policy,
+    register_placement_policy,
+)
+
+
+def test_least_links():
+    candidates = [
+        Candidate("a", link_count=5, latency=0.5),
+        Candidate("b", link_count=2, latency=3.0),
+        Candidate("c", link_count=2, latency=1.0),
+    ]
+    assert get_placement_policy("least-links").place("x.example.com", candidates).key == "c"
+
+
+def test_lowest_latency():
+    candidates = [
+        Candidate("a", link_count=5, latency=0.5),
+        Candidate("b", link_count=2, latency=3.0),
+    ]
+    assert get_placement_policy("lowest-latency").place("x.example.com", candidates).key == "a"
+
+
+def test_unhealthy_candidates_are_skipped():
+    candidates = [
+        Candidate("a", link_count=0, healthy=False),
+        Candidate("b", link_count=9),
+    ]
+    assert get_placement_policy("least-links").place("x.example.com", candidates).key == "b"
+
+    # unless nothing is healthy
+    candidates[1].healthy = False
+    assert get_placement_policy("least-links").place("x.example.com", candidates).key == "a"
+
+
+def test_consistent_hash_is_stable():
+    policy = get_placement_policy("consistent-hash")
+    candidates = [Candidate(key) for key in "abcd"]
+    placed = {
+        f"{i}.example.com": policy.place(f"{i}.example.com", candidates).key for i in range(200)
+    }
+
+    # removing a device only moves the links that were on it
+    remaining = [candidate for candidate in candidates if candidate.key != "b"]
+    for fqdn, key in placed.items():
+        if key != "b":
+            assert policy.place(fqdn, remaining).key == key
+
+
+def test_hash_ring_spread():
+    ring = HashRing(["a", "b", "c"])
+    counts = {"a": 0, "b": 0, "c": 0}
+    for i in range(3000):
+        counts[ring.get(f"{i}.example.com")] += 1  # type: ignore
+    assert all(count > 600 for count in counts.values())
+
+
+def test_custom_policy():
+    @register_placement_policy("last")
+    class LastPolicy(PlacementPolicy):
+        def choose(self, fqdn, candidates):
+            return candidates[-1]
+
+    assert get_placement_policy("last").place("x", [Candidate("a"), Candidate("b")]).key == "b"
+
+    with pytest.raises(ValueError):
+        get_placement_policy("nope")
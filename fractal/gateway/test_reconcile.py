@@ -0,0 +1,123 @@
+from . import reconcile
+from .hub import LINK_HUB_LABEL
+from .inventory import GATEWAY_LABEL, GATEWAY_LINK_LABEL, ContainerRecord
+from .reconcile import (
+    CREATE,
+    DELETE,
+    MISSING,
+    PROMOTE,
+    RESTART,
+    START,
+    DesiredState,
+    RateLimiter,
+    Reconciler,
+    plan,
+)
+from .replacement import get_replacement_name
+from .utils import get_link_container_name
+
+
+def _kinds(actions) -> dict[str, str]:
+    return {action.name: action.kind for action in actions}
+
+
+def test_plan_converges_links(link_record):
+    desired = DesiredState(
+        links={"a.example.com", "b.example.com", "c.example.com", "d.example.com"},
+        up_links={"a.example.com", "b.example.com", "c.example.com", "d.example.com"},
+    )
+    records = [
+        link_record("a.example.com"),
+        link_record("b.example.com", state="exited"),
+        link_record("c.example.com", health="unhealthy"),
+        link_record("gone.example.com"),
+    ]
+    assert _kinds(plan(desired, records)) == {
+        get_link_container_name("b.example.com"): START,
+        get_link_container_name("c.example.com"): RESTART,
+        get_link_container_name("gone.example.com"): DELETE,
+        get_link_container_name("d.example.com"): MISSING,
+    }
+
+
+def test_plan_hub_peers_and_gateway():
+    desired = DesiredState(
+        gateway_state="running", links={"a.example.com"}, up_links={"a.example.com"}
+    )
+    hub = ContainerRecord(
+        id="hub",
+        name="fractal-gateway-link-hub",
+        labels={GATEWAY_LINK_LABEL: "true", LINK_HUB_LABEL: "true"},
+        ports={},
+        state="exited",
+    )
+    actions = plan(desired, [hub], hub_peers=["a.example.com", "gone.example.com"])
+    assert _kinds(actions) == {
+        "fractal-gateway": CREATE,
+        "fractal-gateway-link-hub": START,
+        get_link_container_name("gone.example.com"): DELETE,
+    }
+
+    gateway = ContainerRecord(
+        id="gw", name="fractal-gateway", labels={GATEWAY_LABEL: "1"}, ports={}, state="running"
+    )
+    assert plan(DesiredState(gateway_state="running"), [gateway]) == []
+
+
+def test_rate_limiter():
+    now = [0.0]
+    limiter = RateLimiter(rate=2, burst=2, clock=lambda: now[0])
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0.5
+
+    now[0] = 0.5
+    assert limiter.try_acquire() == 0
+    assert limiter.try_acquire() == 0.5
+
+
+def test_reconcile_backs_off_crash_loops(monkeypatch, link_record, fake_client):
+    now = [0.0]
+    record = link_record("a.example.com", state="exited")
+    client = fake_client()
+    synced = []
+    monkeypatch.setattr(reconcile, "get_inventory", lambda: None)
+    monkeypatch.setattr(reconcile, "sync_link_routes", lambda client: synced.append(client))
+
+    reconciler = Reconciler(client, rate=100, clock=lambda: now[0])  # type: ignore
+    monkeypatch.setattr(reconciler, "observe", lambda: ([record], []))
+    desired = DesiredState(links={"a.example.com"}, up_links={"a.example.com"})
+
+    results = reconciler.reconcile(desired)
+    assert [result.ok for result in results] == [True]
+    assert client.calls == [("start", record.name)] and len(synced) == 1
+
+    # the container exited again: wait before starting it again
+    now[0] = 1.0
+    assert reconciler.reconcile(desired) == []
+    now[0] = 6.0
+    assert len(reconciler.reconcile(desired)) == 1
+    now[0] = 12.0
+    assert reconciler.reconcile(desired) == []  # backoff doubled to 10s
+
+    # once it stays up the backoff is forgotten
+    record.state = "running"
+    assert reconciler.reconcile(desired) == []
+    assert reconciler._attempts == {}
+
+
+def test_plan_promotes_replacements(link_record):
+    desired = DesiredState(links={"a.example.com"}, up_links={"a.example.com"})
+    replacement = link_record("a.example.com", name=get_replacement_name("a.example.com"))
+    stale = link_record("gone.example.com", name=get_replacement_name("gone.example.com"))
+
+    # the old container still serves the link while its replacement is pending
+    assert _kinds(plan(desired, [link_record("a.example.com"), replacement, stale])) == {
+        replacement.name: PROMOTE,
+        stale.name: DELETE,
+    }
+    # promoted but not renamed yet
+    assert _kinds(plan(desired, [replacement])) == {
+        replacement.name: PROMOTE,
+        get_link_container_name("a.example.com"): MISSING,
+    }
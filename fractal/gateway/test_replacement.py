@@ -0,0 +1,160 @@
+from . import replacement, routes
+from .replacement import (
+    DISCARDED,
+    PROMOTED,
+    can_replace,
+    get_replacement_name,
+    is_replacement,
+    promote_replacement,
+    watch_replacement,
+)
+from .routes import LinkRoute
+from .utils import LINK_FQDN_LABEL, get_link_container_name
+
+
+def _fake_gateway(monkeypatch, client):
+    monkeypatch.setattr(replacement, "DRAIN_SECONDS", 0)
+    monkeypatch.setattr(replacement, "HANDSHAKE_POLL_INTERVAL", 0)
+    monkeypatch.setattr(
+        replacement, "find_container", lambda name, client: client.containers_by_name.get(name)
+    )
+    monkeypatch.setattr(
+        replacement,
+        "collect_link_routes",
+        lambda client: [
+            LinkRoute(
+                fqdn=record.labels[LINK_FQDN_LABEL],
+                http_upstream=f"{record.name}:80",
+                https_upstream=f"{record.name}:443",
+            )
+            for record in client.containers_by_name.values()
+            if not is_replacement(record.name)
+        ],
+    )
+    monkeypatch.setattr(
+        replacement,
+        "publish_link_routes",
+        lambda routes, client: client.calls.append(("publish", routes)),
+    )
+    monkeypatch.setattr(
+        replacement, "sync_link_routes", lambda client: client.calls.append(("sync",))
+    )
+    monkeypatch.setattr(
+        replacement,
+        "wait_for_container",
+        lambda name, container_id: client.calls.append(("wait", name, container_id)),
+    )
+
+
+def test_replacement_names():
+    name = get_replacement_name("a.example.com")
+    assert is_replacement(name)
+    assert not is_replacement(get_link_container_name("a.example.com"))
+
+
+def test_can_replace(link_record):
+    record = link_record("a.example.com", forward_port="30000")
+    # http links get a new forward port
+    assert can_replace(record, tcp_forwarding=False, forward_port="30000")
+    # a public forward port can't be bound twice
+    assert not can_replace(record, tcp_forwarding=True, forward_port="30000")
+    assert can_replace(record, tcp_forwarding=True, forward_port="30001")
+
+    record.state = "exited"
+    assert not can_replace(record, tcp_forwarding=False, forward_port=None)
+
+
+def test_routes_prefer_the_links_own_container(monkeypatch, link_record):
+    current = link_record("a.example.com")
+    replacement = link_record("a.example.com", name=get_replacement_name("a.example.com"))
+    records = [replacement, current]
+    monkeypatch.setattr(routes, "_list_link_containers", lambda client: records)
+    monkeypatch.setattr("fractal.gateway.hub.get_link_hub", lambda client, create: None)
+
+    assert [route.http_upstream for route in routes.collect_link_routes(None)] == [
+        f"{current.name}:80"
+    ]
+
+    # promoted, the old container is gone but the replacement isn't renamed yet
+    records.remove(current)
+    assert [route.http_upstream for route in routes.collect_link_routes(None)] == [
+        f"{replacement.name}:80"
+    ]
+
+
+def test_promote_replacement(monkeypatch, link_record, fake_client):
+    name = get_link_container_name("a.example.com")
+    client = fake_client(
+        link_record("a.example.com", name=name),
+        link_record("a.example.com", name=get_replacement_name("a.example.com")),
+        link_record("b.example.com"),
+    )
+    _fake_gateway(monkeypatch, client)
+
+    assert promote_replacement("a.example.com", client)
+
+    # routes move to the replacement before the old container goes away
+    published = client.calls[0]
+    assert published[0] == "publish"
+    assert {route.fqdn: route.http_upstream for route in published[1]} == {
+        "a.example.com": f"{get_replacement_name('a.example.com')}:80",
+        "b.example.com": f"{get_link_container_name('b.example.com')}:80",
+    }
+    # the routes are synced once the inventory saw the rename
+    assert client.calls[1:] == [
+        ("remove", name),
+        ("rename", get_replacement_name("a.example.com"), name),
+        ("wait", name, get_replacement_name("a.example.com")),
+        ("sync",),
+    ]
+    assert set(client.containers_by_name) == {name, get_link_container_name("b.example.com")}
+
+    # nothing left to promote
+    assert not promote_replacement("a.example.com", client)
+
+
+def test_watch_replacement(monkeypatch, link_record, fake_client):
+    name = get_link_container_name("a.example.com")
+    replacement_name = get_replacement_name("a.example.com")
+    client = fake_client(
+        link_record("a.example.com"), link_record("a.example.com", name=replacement_name)
+    )
+    _fake_gateway(monkeypatch, client)
+
+    # the client connects to the replacement on the third poll
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 2:
+            client.handshakes[replacement_name] = "1700000000"
+
+    monkeypatch.setattr(replacement.time, "sleep", sleep)
+    assert watch_replacement("a.example.com", client) == PROMOTED
+    assert list(client.containers_by_name) == [name]
+
+
+def test_watch_replacement_times_out(monkeypatch, link_record, fake_client):
+    replacement_name = get_replacement_name("a.example.com")
+    client = fake_client(
+        link_record("a.example.com"),
+        link_record("a.example.com", name=replacement_name),
+    )
+    _fake_gateway(monkeypatch, client)
+    monkeypatch.setattr(replacement, "REPLACEMENT_TIMEOUT", 0)
+
+    assert watch_replacement("a.example.com", client) == DISCARDED
+    assert replacement_name not in client.containers_by_name
+
+
+def test_short_lived_processes_hand_the_watch_off(monkeypatch):
+    started = []
+    monkeypatch.setattr(
+        replacement.subprocess, "Popen", lambda args, **kwargs: started.append((args, kwargs))
+    )
+    monkeypatch.setattr(replacement, "_watch_in_process", False)
+
+    replacement.start_replacement_watch("a.example.com", None)
+    args, kwargs = started[0]
+    assert args[1:] == ["-m", "fractal.gateway.replacement", "a.example.com"]
+    assert kwargs["start_new_session"]
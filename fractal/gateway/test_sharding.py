@@ -0,0 +1,67 @@
+import pytest
+
+from .sharding import GatewayPool, LinkMove, distribution
+
+FQDNS = [f"app{i}.example.com" for i in range(1000)]
+
+
+def _rebalance(assignments: dict, pool: GatewayPool) -> list[LinkMove]:
+    """
+    Plans the moves like Gateway.rebalance_links and records the new placements.
+    """
+    moves = pool.plan(assignments)
+    assignments.update({move.fqdn: move.target for move in moves})
+    return moves
+
+
+def test_links_are_spread_across_hosts():
+    pool = GatewayPool(f"host{i}" for i in range(4))
+    assignments = {fqdn: None for fqdn in FQDNS}
+    moves = _rebalance(assignments, pool)
+    # unplaced links are placed, nothing moves away from a host
+    assert len(moves) == len(FQDNS)
+    assert all(move.source is None for move in moves)
+
+    counts = distribution(assignments, hosts=pool.hosts)
+    assert sum(counts.values()) == len(FQDNS)
+    assert all(150 < count < 350 for count in counts.values())
+    # placed links stay put
+    assert pool.plan(assignments) == []
+
+
+def test_adding_a_host_moves_only_its_share():
+    pool = GatewayPool(f"host{i}" for i in range(4))
+    assignments = {fqdn: None for fqdn in FQDNS}
+    _rebalance(assignments, pool)
+    before = dict(assignments)
+
+    pool.add_host("host4")
+    moves = _rebalance(assignments, pool)
+
+    # every moved link moved to the new host, and only about 1/5 of them moved
+    assert all(move.target == "host4" and move.source == before[move.fqdn] for move in moves)
+    assert {fqdn for fqdn in FQDNS if before[fqdn] != assignments[fqdn]} == {
+        move.fqdn for move in moves
+    }
+    assert 100 < len(moves) < 320
+
+
+def test_removing_a_host_moves_only_its_links():
+    pool = GatewayPool(f"host{i}" for i in range(4))
+    assignments = {fqdn: None for fqdn in FQDNS}
+    _rebalance(assignments, pool)
+    before = dict(assignments)
+
+    pool.remove_host("host1")
+    moves = _rebalance(assignments, pool)
+
+    assert {move.fqdn for move in moves} == {
+        fqdn for fqdn, host in before.items() if host == "host1"
+    }
+    assert all(move.source == "host1" and move.target != "host1" for move in moves)
+    assert "host1" not in distribution(assignments, hosts=pool.hosts)
+
+
+def test_empty_pool_has_no_host():
+    with pytest.raises(ValueError):
+        GatewayPool().host_for("a.example.com")
@@ -0,0 +1,114 @@
+from types import SimpleNamespace
+
+from . import teardown
+from .hub import HubPeer
+from .replacement import get_replacement_name
+from .utils import get_link_container_name
+
+
+def _peer(fqdn: str) -> HubPeer:
+    return HubPeer(
+        name=get_link_container_name(fqdn),
+        index=2,
+        address="10.1.0.2",
+        http_port=10080,
+        https_port=10443,
+        fqdn=fqdn,
+        pubkey="pubkey",
+    )
+
+
+class FakeGateway:
+    """
+    Link containers and hub peers on a gateway, with what teardown did to them.
+    """
+
+    def __init__(self, monkeypatch, records=(), peers=()):
+        self.records = {record.name: record for record in records}
+        self.peers = list(peers)
+        self.removed = []
+        self.syncs = 0
+
+        inventory = SimpleNamespace(list=lambda label: list(self.records.values()))
+        monkeypatch.setattr(teardown, "get_inventory", lambda: inventory)
+        monkeypatch.setattr(teardown, "find_container", lambda name, client: self.records.get(name))
+        monkeypatch.setattr(teardown, "_remove_container", self._remove_container)
+        monkeypatch.setattr(teardown, "discard_replacement", lambda fqdn, client: False)
+        monkeypatch.setattr(
+            teardown, "get_link_hub", lambda client, create: object() if self.peers else None
+        )
+        monkeypatch.setattr(teardown, "list_hub_peers", lambda hub: list(self.peers))
+        monkeypatch.setattr(teardown, "remove_hub_peer", self._remove_hub_peer)
+        monkeypatch.setattr(teardown, "sync_link_routes", self._sync)
+
+    def _remove_container(self, record, client):
+        self.records.pop(record.name)
+        self.removed.append(record.name)
+
+    def _remove_hub_peer(self, fqdn, client, sync_routes=True):
+        self.peers = [peer for peer in self.peers if peer.fqdn != fqdn]
+        self.removed.append(f"peer:{fqdn}")
+
+    def _sync(self, client):
+        self.syncs += 1
+
+
+def test_take_links_down(monkeypatch, link_record):
+    gateway = FakeGateway(
+        monkeypatch, records=[link_record("a.example.com")], peers=[_peer("b.example.com")]
+    )
+
+    results = teardown.take_links_down(
+        ["a.example.com", "b.example.com", "c.example.com"], client=object()
+    )
+    assert results == {"a.example.com": True, "b.example.com": True, "c.example.com": False}
+    assert sorted(gateway.removed) == [
+        get_link_container_name("a.example.com"),
+        "peer:b.example.com",
+    ]
+    # routes are republished once for the whole batch
+    assert gateway.syncs == 1
+
+    assert teardown.take_links_down(["c.example.com"], client=object()) == {"c.example.com": False}
+    assert gateway.syncs == 1
+
+
+def test_find_orphans(monkeypatch, link_record):
+    FakeGateway(
+        monkeypatch,
+        records=[
+            link_record("a.example.com"),
+            link_record("a.example.com", name=get_replacement_name("a.example.com")),
+            link_record("gone.example.com"),
+        ],
+        peers=[_peer("b.example.com"), _peer("moved.example.com")],
+    )
+
+    orphans = teardown.find_orphans(["a.example.com", "b.example.com"], client=object())
+    assert {(orphan.fqdn, orphan.record is not None) for orphan in orphans} == {
+        ("gone.example.com", True),
+        ("moved.example.com", False),
+    }
+
+
+def test_collect_garbage(monkeypatch, link_record):
+    gateway = FakeGateway(
+        monkeypatch,
+        records=[link_record("a.example.com"), link_record("gone.example.com")],
+        peers=[_peer("moved.example.com")],
+    )
+
+    orphans = teardown.collect_garbage(["a.example.com"], client=object(), dry_run=True)
+    assert len(orphans) == 2 and not gateway.removed and not gateway.syncs
+
+    teardown.collect_garbage(["a.example.com"], client=object())
+    assert sorted(gateway.removed) == [
+        get_link_container_name("gone.example.com"),
+        "peer:moved.example.com",
+    ]
+    assert list(gateway.records) == [get_link_container_name("a.example.com")]
+    assert gateway.syncs == 1
+
+    # nothing left to collect, nothing to republish
+    assert teardown.collect_garbage(["a.example.com"], client=object()) == []
+    assert gateway.syncs == 1
@@ -0,0 +1,100 @@
+import json
+from contextlib import contextmanager
+
+import pytest
+from django.db import transaction
+
+from .transport import (
+    JSON_FORMAT,
+    MSGPACK_FORMAT,
+    MSGPACK_ZSTD_FORMAT,
+    dump_replication_event,
+    iter_replication_batches,
+    replicate_batches,
+)
+
+EVENT = {
+    "replication_id": "7b0c7d4e-4b5b-4d1e-9f3a-2d1f0c3b8a11",
+    "payload": [
+        {"model": "gateway.domain", "pk": str(i), "fields": {"uri": f"domain-{i}.com"}}
+        for i in range(25)
+    ],
+}
+
+
+@pytest.mark.parametrize("format", [JSON_FORMAT, MSGPACK_FORMAT, MSGPACK_ZSTD_FORMAT])
+def test_replication_event_roundtrip(format):
+    if format != JSON_FORMAT:
+        pytest.importorskip("msgpack")
+    if format == MSGPACK_ZSTD_FORMAT:
+        pytest.importorskip("zstandard")
+
+    data = dump_replication_event(EVENT, format)
+    # feed the stream byte by byte to exercise the incremental decoder
+    batches = list(iter_replication_batches((data[i : i + 1] for i in range(len(data))), 10))
+
+    assert [len(records) for _, records in batches] == [10, 10, 5]
+    assert {replication_id for replication_id, _ in batches} == {EVENT["replication_id"]}
+    assert [record for _, records in batches for record in records] == EVENT["payload"]
+
+
+def test_binary_is_smaller_than_json():
+    pytest.importorskip("msgpack")
+    pytest.importorskip("zstandard")
+
+    assert len(dump_replication_event(EVENT, MSGPACK_ZSTD_FORMAT)) < len(json.dumps(EVENT))
+
+
+class FakeDatabase:
+    """
+    Records loaded by the replication task, committed or rolled back with the transaction.
+    """
+
+    def __init__(self):
+        self.committed: list = []
+        self.pending: list = []
+        self.in_transaction = False
+
+    @contextmanager
+    def atomic(self):
+        self.in_transaction = True
+        try:
+            yield
+        except BaseException:
+            self.pending = []
+            raise
+        else:
+            self.committed.extend(self.pending)
+            self.pending = []
+        finally:
+            self.in_transaction = False
+
+    async def replicate_fixture(self, fixture: str, project_dir):
+        assert self.in_transaction
+        self.pending.extend(json.loads(fixture)["payload"])
+
+
+def test_replicate_batches(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(transaction, "atomic", database.atomic)
+    data = dump_replication_event(EVENT, JSON_FORMAT)
+
+    batches = iter_replication_batches([data], 10)
+    assert replicate_batches(batches, database.replicate_fixture) == len(EVENT["payload"])
+    assert database.committed == EVENT["payload"]
+
+
+def test_replicate_batches_rolls_back_a_broken_stream(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(transaction, "atomic", database.atomic)
+
+    def broken_stream():
+        batches = iter_replication_batches([dump_replication_event(EVENT, JSON_FORMAT)], 10)
+        yield next(batches)
+        yield next(batches)
+        raise ConnectionError("ssh connection closed")
+
+    with pytest.raises(ConnectionError):
+        replicate_batches(broken_stream(), database.replicate_fixture)
+    # the two batches loaded before the stream broke are rolled back
+    assert database.committed == [] and database.pending == []
@@ -1,6 +1,27 @@
+import os
+import shlex
+
+import pytest
 import sh
+import yaml
 
-from .utils import generate_wireguard_keypair
+from . import routes
+from .inventory import GATEWAY_LINK_LABEL, ContainerRecord
+from .proxy import get_proxy_profile
+from .utils import (
+    DEFAULT_LINK_MTU,
+    LINK_ALIASES_LABEL,
+    LINK_FQDN_LABEL,
+    build_link_service,
+    dump_compose,
+    generate_link_compose_snippet,
+    generate_wireguard_keypair,
+    get_gateway_capacity,
+    get_link_down_command,
+    get_link_state_dir,
+    get_link_up_command,
+    read_link_mtu,
+)
 
 
 def test_generate_wireguard_keypair():
@@ -9,3 +30,197 @@ def test_generate_wireguard_keypair():
         assert len(private_key) == 44
         assert len(public_key) == 44
         assert sh.wg("pubkey", _in=private_key).strip() == public_key
+
+
+def test_get_gateway_capacity():
+    # small hosts get nginx's default
+    assert get_gateway_capacity(4, 1024**3) == {
+        "worker_connections": 1024,
+        "worker_rlimit_nofile": 3072,
+    }
+
+    capacity = get_gateway_capacity(8, 64 * 1024**3)
+    assert capacity["worker_connections"] == 32768
+    assert capacity["worker_rlimit_nofile"] == 32768 * 2 + 1024
+
+    # large hosts are capped
+    assert get_gateway_capacity(1, 1024**4)["worker_connections"] == 65536
+
+
+def _environment(snippet: str) -> dict[str, str]:
+    return yaml.safe_load(snippet)["link"]["environment"]
+
+
+def test_compose_snippet_uses_measured_mtu():
+    link_config = {
+        "gateway_link_public_key": "pubkey",
+        "link_address": "a.example.com:30000",
+        "client_private_key": "privkey",
+    }
+    snippet = generate_link_compose_snippet(link_config, "a.example.com", "app:80")
+    assert _environment(snippet)["LINK_MTU"] == str(DEFAULT_LINK_MTU)
+
+    snippet = generate_link_compose_snippet({**link_config, "mtu": 1420}, "a.example.com", "app:80")
+    assert _environment(snippet)["LINK_MTU"] == "1420"
+
+
+def test_read_link_mtu(tmp_path, monkeypatch):
+    monkeypatch.setattr("fractal.cli.utils.data_dir", str(tmp_path))
+    assert read_link_mtu("a.example.com") is None
+
+    state_dir = get_link_state_dir("a.example.com")
+    assert state_dir.startswith(str(tmp_path))
+    os.makedirs(state_dir)
+    with open(os.path.join(state_dir, "client.mtu"), "w") as file:
+        file.write("1400\n")
+    assert read_link_mtu("a.example.com") == 1400
+
+    # out of bounds reports are ignored
+    with open(os.path.join(state_dir, "client.mtu"), "w") as file:
+        file.write("9000\n")
+    assert read_link_mtu("a.example.com") is None
+
+
+def test_compose_document_for_many_links():
+    services = {
+        f"link-{name}": build_link_service(
+            {
+                "gateway_link_public_key": "pubkey",
+                "link_address": f"{name}.example.com:30000",
+                "client_private_key": "privkey",
+            },
+            f"{name}.example.com",
+            "app:80",
+            volume=f"link-{name}-data",
+        )
+        for name in ("a", "b")
+    }
+    document = yaml.safe_load(
+        dump_compose({"services": services, "volumes": {"link-a-data": {}, "link-b-data": {}}})
+    )
+    assert list(document["services"]) == ["link-a", "link-b"]
+    assert document["services"]["link-b"]["environment"]["LINK_DOMAIN"] == "b.example.com"
+    assert document["services"]["link-b"]["volumes"] == ["link-b-data:/data"]
+    # environment values stay strings, i.e. no "off" turning into a boolean
+    assert all(
+        isinstance(value, str) for value in document["services"]["link-a"]["environment"].values()
+    )
+
+
+def test_https_well_known_is_relayed_to_the_gateway():
+    link_config = {
+        "gateway_link_public_key": "pubkey",
+        "link_address": "a.example.com:30000",
+        "client_private_key": "privkey",
+    }
+    snippet = generate_link_compose_snippet(link_config, "a.example.com", "app:80")
+    assert _environment(snippet)["GATEWAY_WELL_KNOWN"] == "true"
+
+    # forwarded links don't terminate TLS, the link hub doesn't relay
+    snippet = generate_link_compose_snippet(
+        link_config, "a.example.com", "app:5432", new_forwarding=True
+    )
+    assert "GATEWAY_WELL_KNOWN" not in _environment(snippet)
+    snippet = generate_link_compose_snippet(
+        {**link_config, "tunnel_address": "10.1.0.2/16"}, "a.example.com", "app:80"
+    )
+    assert "GATEWAY_WELL_KNOWN" not in _environment(snippet)
+
+
+def test_compose_snippet_proxy_profile():
+    link_config = {
+        "gateway_link_public_key": "pubkey",
+        "link_address": "a.example.com:30000",
+        "client_private_key": "privkey",
+    }
+    # the entrypoint's defaults match the default profile
+    snippet = generate_link_compose_snippet(link_config, "a.example.com", "app:80")
+    assert "CADDY_" not in snippet
+
+    snippet = generate_link_compose_snippet(
+        link_config, "a.example.com", "app:80", profile="streaming"
+    )
+    assert _environment(snippet)["CADDY_COMPRESSION"] == "off"
+    assert _environment(snippet)["CADDY_FLUSH_INTERVAL"] == "-1"
+
+    profile = get_proxy_profile("compat", upstream_http2=True)
+    assert profile.to_environment() == {
+        "CADDY_COMPRESSION": "off",
+        "CADDY_KEEPALIVE_IDLE_CONNS": "32",
+        "CADDY_READ_BUFFER": "8192",
+        "CADDY_WRITE_BUFFER": "4096",
+        "CADDY_UPSTREAM_HTTP2": "true",
+    }
+
+
+def test_multi_route_link():
+    link_config = {
+        "gateway_link_public_key": "pubkey",
+        "link_address": "a.example.com:30000",
+        "client_private_key": "privkey",
+    }
+    snippet = generate_link_compose_snippet(
+        link_config,
+        "a.example.com",
+        "app:80",
+        routes={"c.example.com": "other:8080", "b.example.com": "api:80"},
+    )
+    assert list(yaml.safe_load(snippet)) == ["link"]
+    assert _environment(snippet)["LINK_ROUTES"] == "b.example.com=api:80,c.example.com=other:8080"
+
+    with pytest.raises(ValueError):
+        generate_link_compose_snippet(
+            link_config, "a.example.com", "app:80", new_forwarding=True, routes={"b": "x:1"}
+        )
+
+
+def test_routes_include_link_aliases(monkeypatch):
+    record = ContainerRecord(
+        id="a",
+        name="a-example-com",
+        labels={
+            GATEWAY_LINK_LABEL: "true",
+            LINK_FQDN_LABEL: "a.example.com",
+            LINK_ALIASES_LABEL: "b.example.com,c.example.com",
+        },
+        ports={},
+        state="running",
+    )
+    monkeypatch.setattr(routes, "_list_link_containers", lambda client: [record])
+    monkeypatch.setattr("fractal.gateway.hub.get_link_hub", lambda client, create: None)
+
+    assert [
+        (route.fqdn, route.http_upstream) for route in routes.collect_link_routes(None)
+    ] == [
+        ("a.example.com", "a-example-com:80"),
+        ("b.example.com", "a-example-com:80"),
+        ("c.example.com", "a-example-com:80"),
+    ]
+
+
+def _parse_fractal_command(command: str):
+    from clicz import CLICZ
+
+    from .controllers.link import FractalLinkController
+
+    cli = CLICZ(cli_module="fractal", autodiscover=False)
+    cli.register_controller(FractalLinkController)
+    program, *argv = shlex.split(command)
+    assert program == "fractal"
+    return cli.base_parser.parse_args(argv)
+
+
+def test_ssh_link_commands_parse():
+    args = _parse_fractal_command(get_link_down_command(["a.example.com", "b.example.com"]))
+    assert (args.subcommand, args.link_fqdns) == ("down", "a.example.com,b.example.com")
+
+    args = _parse_fractal_command(
+        get_link_up_command("gateway-id", "a.example.com", True, "30000", ["b.example.com"])
+    )
+    assert args.subcommand == "up"
+    assert (args.gateway_id, args.link_fqdn) == ("gateway-id", "a.example.com")
+    assert (args.tcp_forwarding, args.forward_port, args.aliases) == (
+        True,
+        "30000",
+        "b.example.com",
+    )
@@ -0,0 +1,87 @@
+from types import SimpleNamespace
+
+from . import well_known
+from .well_known import build_well_known_documents, render_well_known_map, resolve_well_known
+
+
+def _homeserver(url: str, priority=0):
+    return SimpleNamespace(url=url, priority=priority)
+
+
+class FakeResponse:
+    def __init__(self, ok: bool):
+        self.ok = ok
+
+    def json(self):
+        return {"versions": ["v1.11"]}
+
+
+def _serve(monkeypatch, up: set[str]) -> list[str]:
+    requested = []
+
+    def get(url, timeout):
+        requested.append(url)
+        if not any(url.startswith(homeserver) for homeserver in up):
+            raise ConnectionError(url)
+        return FakeResponse(ok=True)
+
+    monkeypatch.setattr(well_known.requests, "get", get)
+    return requested
+
+
+def test_render_well_known_map():
+    rendered = render_well_known_map(
+        {
+            "b.example.com": {"m.homeserver": {"base_url": "https://b.example.com"}},
+            "a.example.com": {"m.homeserver": {"base_url": "https://a.example.com/$it's"}},
+        }
+    )
+    lines = rendered.splitlines()
+    assert lines[0].startswith("#")
+    # sorted by hostname, `$` escaped for nginx and quotes for the map's string
+    assert lines[1] == (
+        "a.example.com "
+        "'{\"m.homeserver\":{\"base_url\":\"https://a.example.com/\\\\u0024it\\'s\"}}';"
+    )
+    assert lines[2].startswith("b.example.com '")
+    assert rendered.endswith(";\n")
+
+
+def test_homeservers_are_probed_on_their_client_api(monkeypatch):
+    requested = _serve(monkeypatch, up={"https://a.example.com"})
+    document = resolve_well_known([_homeserver("https://a.example.com/", priority=1)])
+
+    # not the well-known, which the gateway answers itself for its homeservers
+    assert requested == ["https://a.example.com/_matrix/client/versions"]
+    assert document == {
+        "m.homeserver": {"base_url": "https://a.example.com"},
+        "f.homeserver.priority": 1,
+    }
+
+
+def test_failover_to_the_next_homeserver(monkeypatch):
+    _serve(monkeypatch, up={"https://backup.example.com"})
+    homeservers = [
+        _homeserver("https://primary.example.com", priority=0),
+        _homeserver("https://backup.example.com", priority=1),
+    ]
+    document = resolve_well_known(homeservers)
+    assert document["m.homeserver"]["base_url"] == "https://backup.example.com"
+    assert document["f.homeserver.priority"] == 1
+
+    _serve(monkeypatch, up=set())
+    assert resolve_well_known(homeservers) is None
+
+
+def test_build_well_known_documents(monkeypatch):
+    _serve(monkeypatch, up={"https://a.example.com", "https://a.backup.net"})
+    documents = build_well_known_documents(
+        [
+            _homeserver("https://a.backup.net", priority=2),
+            _homeserver("https://a.example.com", priority=1),
+            _homeserver("https://b.example.com", priority=None),
+        ]
+    )
+    # b's only homeserver is down, the gateway falls back to WellKnownView for it
+    assert set(documents) == {"a.example.com", "a.backup.net"}
+    assert documents["a.example.com"]["f.homeserver.priority"] == 1
@@ -0,0 +1,17 @@
+import base64
+
+from .wireguard import generate_keypair, public_key
+
+
+def test_public_key_rfc7748_vector():
+    alice = bytes.fromhex("77076d0a7318a57d3c16c17251b26645df4c2f87ebc0992ab177fba51db92c2a")
+    assert base64.b64decode(public_key(base64.b64encode(alice).decode())).hex() == (
+        "8520f0098930a754748b7ddcb43ef75a0dbf3a0d26381af4eba4a98eaa9b4e6a"
+    )
+
+
+def test_generate_keypair():
+    private_key, public = generate_keypair()
+    assert len(private_key) == len(public) == 44
+    assert public_key(private_key) == public
+    assert generate_keypair()[0] != private_key
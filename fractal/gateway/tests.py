@@ -1,3 +1,210 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import AnonymousUser
+from django.db import IntegrityError, transaction
+from django.test import RequestFactory, TestCase
+from fractal.gateway.models import Domain, Gateway, Link
+from fractal.gateway.placement import get_candidates
+from fractal.gateway.sharding import GatewayPool
+from fractal.gateway.views import MetricsPermission
+from fractal_database.models import Device
+
+
+class GatewayQueryTests(TestCase):
+    """
+    Pins the number of queries of the gateway's hot paths, which run on every link create
+    and up.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.gateway = Gateway.objects.create(name="test_gateway")
+        cls.devices = [Device.objects.create(name=f"gateway-device-{i}") for i in range(2)]
+        cls.domain = Domain.objects.create(uri="example.com")
+        for device in cls.devices:
+            device.add_membership(cls.gateway)
+            cls.domain.devices.add(device)
+        cls.link = Link.objects.create(domain=cls.domain, subdomain="app", forward_port="30000")
+
+    def test_get_domain(self):
+        # served by two of the gateway's devices, still found once
+        with self.assertNumQueries(1):
+            self.assertEqual(self.gateway.get_domain("example.com"), self.domain)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(list(self.gateway.get_domains()), [self.domain])
+
+    def test_create_link(self):
+        # the link's replicated save is fractal_database's, only the lookups are pinned here
+        with mock.patch.object(Link, "save"):
+            # lookup, the devices serving the domain and their placement stats
+            with self.assertNumQueries(3):
+                link = self.gateway.create_link(self.domain, "new")
+        self.assertIn(link.placement_device, self.devices)
+
+        with self.assertNumQueries(1):
+            link = self.gateway.create_link(self.domain, "app", override_link=True)
+        self.assertEqual(link, self.link)
+
+    def test_link_up(self):
+        link_config = {
+            "gateway_link_public_key": "pubkey",
+            "link_address": "app.example.com:30000",
+            "client_private_key": "privkey",
+            "forward_port": "30000",
+            "tunnel_address": None,
+            "mtu": None,
+        }
+        link = Link.objects.select_related("domain").get(pk=self.link.pk)
+        with mock.patch.object(
+            Link, "_up_on_device", mock.AsyncMock(return_value=link_config)
+        ), mock.patch.object(Link, "save"):
+            # the gateway's devices that serve the domain and their placement stats
+            with self.assertNumQueries(2):
+                async_to_sync(link.aget_link_config)(self.gateway)
+            # placed links stay on their device without looking at the others
+            with self.assertNumQueries(1):
+                async_to_sync(link.aget_link_config)(self.gateway)
+        self.assertIn(link.placement_device, self.devices)
+
+    def test_get_by_url(self):
+        with self.assertNumQueries(1):
+            link = Link.get_by_url("app.example.com", select_related=["domain"])
+            self.assertEqual(link.fqdn, "app.example.com")
+
+    def test_get_links(self):
+        with self.assertNumQueries(1):
+            self.assertEqual([link.fqdn for link in self.gateway.get_links()], ["app.example.com"])
+
+    def test_filter_fqdns(self):
+        with self.assertNumQueries(1):
+            links = list(Link.filter_fqdns(["app.example.com", "missing.example.com"]))
+            self.assertEqual([link.fqdn for link in links], ["app.example.com"])
+
+    def test_hosted_fqdns(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Link.hosted_fqdns(self.devices[0], brought_up=True), ["app.example.com"]
+            )
+
+    def test_placement_candidates(self):
+        with self.assertNumQueries(1):
+            candidates = get_candidates(Link(domain=self.domain, subdomain="new"), self.devices)
+        self.assertEqual(len(candidates), 2)
+
+    def test_link_distribution_only_counts_hosts(self):
+        # a client device is a member of the gateway, but serves none of its domains
+        client = Device.objects.create(name="client-device")
+        client.add_membership(self.gateway)
+
+        self.assertEqual(set(self.gateway.get_hosts()), set(self.devices))
+        self.assertEqual(
+            set(self.gateway.get_link_distribution()), {device.name for device in self.devices}
+        )
+
+    def test_rebalance_moves_aliases_with_their_primary(self):
+        hosts = {str(device.pk): device for device in self.devices}
+        primary = Link.objects.create(domain=self.domain, subdomain="primary")
+        target = GatewayPool(hosts).host_for(primary.fqdn)
+        (source,) = set(hosts) - {target}
+        primary.placement_device = hosts[source]
+        primary.save()
+        # the alias hashes to wherever, it's served by the primary's container
+        alias = Link.objects.create(
+            domain=self.domain, subdomain="alias", served_by=primary, placement_device=hosts[source]
+        )
+
+        moves = {link.fqdn: move for link, move in self.gateway.rebalance_links(apply=True)}
+        self.assertEqual(moves[primary.fqdn].target, target)
+        self.assertEqual(moves[alias.fqdn].source, source)
+        self.assertEqual(moves[alias.fqdn].target, target)
+
+        alias.refresh_from_db()
+        self.assertEqual(str(alias.placement_device_id), target)
+        # placed together, nothing moves anymore
+        self.assertNotIn(alias.fqdn, {link.fqdn for link, _ in self.gateway.rebalance_links()})
+
+    def test_rebalance_moves_only_the_new_devices_share(self):
+        for i in range(20):
+            Link.objects.create(domain=self.domain, subdomain=f"app{i}")
+        self.gateway.rebalance_links(apply=True)
+        before = {link.fqdn: link.placement_device_id for link in self.gateway.get_links()}
+
+        device = Device.objects.create(name="gateway-device-2")
+        device.add_membership(self.gateway)
+        self.domain.devices.add(device)
+
+        moves = self.gateway.rebalance_links(apply=True)
+        # links only move to the new device, the others stay where they were
+        self.assertTrue(all(move.target == str(device.pk) for _, move in moves))
+        moved = {link.fqdn for link, _ in moves}
+        for link in self.gateway.get_links():
+            if link.fqdn not in moved:
+                self.assertEqual(link.placement_device_id, before[link.fqdn])
+        self.assertEqual(self.gateway.rebalance_links(), [])
+
+    def test_links_are_unique_per_domain(self):
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Link.objects.create(domain=self.domain, subdomain="app")
+
+
+class LinkSaveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.domain = Domain.objects.create(uri="example.com")
+
+    def test_unchanged_links_are_not_saved(self):
+        link = Link.objects.create(domain=self.domain, subdomain="app", forward_port="30000")
+        link = Link.objects.get(pk=link.pk)
+        with self.assertNumQueries(0):
+            self.assertFalse(link.save_changed())
+
+        link.forward_port = "30001"
+        self.assertEqual(link.get_dirty_fields(), ["forward_port"])
+        self.assertTrue(link.save_changed())
+        self.assertEqual(link.get_dirty_fields(), [])
+        self.assertEqual(Link.objects.get(pk=link.pk).forward_port, "30001")
+
+    def test_coalesced_saves(self):
+        links = [
+            Link.objects.create(domain=self.domain, subdomain=f"app{i}") for i in range(3)
+        ]
+
+        async def up_all():
+            async with Link.acoalesce_saves():
+                for i, link in enumerate(links):
+                    link.forward_port = str(30000 + i)
+                    await link.asave_changed()
+                # nothing is saved until the window closes
+                self.assertFalse(
+                    await Link.objects.filter(forward_port__isnull=False).aexists()
+                )
+
+        async_to_sync(up_all)()
+        self.assertEqual(
+            sorted(Link.objects.values_list("forward_port", flat=True)),
+            ["30000", "30001", "30002"],
+        )
+
+
+class MetricsPermissionTests(TestCase):
+    def _allowed(self, **meta) -> bool:
+        request = RequestFactory().get("/metrics", **meta)
+        request.user = AnonymousUser()
+        return MetricsPermission().has_permission(request, None)
+
+    def test_metrics_are_private(self):
+        self.assertTrue(self._allowed(REMOTE_ADDR="127.0.0.1"))
+        # i.e. proxied in by a link
+        self.assertFalse(self._allowed(REMOTE_ADDR="172.18.0.5"))
+        self.assertFalse(self._allowed(REMOTE_ADDR="172.18.0.5", HTTP_X_FORWARDED_FOR="127.0.0.1"))
+
+    def test_metrics_token(self):
+        with mock.patch.dict("os.environ", {"FRACTAL_GATEWAY_METRICS_TOKEN": "secret"}):
+            self.assertTrue(
+                self._allowed(REMOTE_ADDR="172.18.0.5", HTTP_AUTHORIZATION="Bearer secret")
+            )
+            self.assertFalse(
+                self._allowed(REMOTE_ADDR="172.18.0.5", HTTP_AUTHORIZATION="Bearer wrong")
+            )
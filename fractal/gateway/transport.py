@@ -0,0 +1,283 @@
+"""
+Compact transport for replication events moved over SSH.
+
+A binary stream starts with `MAGIC` followed by a flags byte. The rest of the stream is a
+sequence of msgpack objects (zstd compressed when `FLAG_ZSTD` is set): the replication id
+followed by one object per fixture record, so a receiver can start replicating records
+before the whole payload has arrived. Anything that doesn't start with `MAGIC` is treated
+as a plain JSON replication event.
+
+msgpack and zstandard are optional (`pip install fractal-gateway[transport]`). Senders
+downgrade the requested format to what they support and receivers detect the format from
+the stream itself, so both ends fall back to JSON.
+"""
+
+import json
+import queue
+import threading
+from typing import Any, Awaitable, Callable, Iterable, Iterator, Optional
+
+MAGIC = b"FGW\x01"
+FLAG_ZSTD = 0x01
+
+JSON_FORMAT = "json"
+MSGPACK_FORMAT = "msgpack"
+MSGPACK_ZSTD_FORMAT = "msgpack+zstd"
+FORMATS = [JSON_FORMAT, MSGPACK_FORMAT, MSGPACK_ZSTD_FORMAT]
+
+DEFAULT_BATCH_SIZE = 500
+FLUSH_SIZE = 64 * 1024
+
+
+def _msgpack_available() -> bool:
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def _zstd_available() -> bool:
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def negotiate_format(requested: Optional[str] = None) -> str:
+    """
+    Returns the best format that is supported locally, never better than `requested`.
+
+    Parameters:
+    - requested: Optional[str], the format requested by the other end. Defaults to the
+        best format available.
+    """
+    requested = requested or MSGPACK_ZSTD_FORMAT
+    if requested not in FORMATS:
+        raise ValueError(f"Invalid format: {requested}")
+
+    if requested == JSON_FORMAT or not _msgpack_available():
+        return JSON_FORMAT
+    if requested == MSGPACK_ZSTD_FORMAT and _zstd_available():
+        return MSGPACK_ZSTD_FORMAT
+    return MSGPACK_FORMAT
+
+
+def encode_replication_event(event: dict[str, Any], format: str) -> Iterator[bytes]:
+    """
+    Encodes a replication event (`{"replication_id": ..., "payload": [...]}`) as a stream of chunks.
+
+    Parameters:
+    - event: Dict, the replication event to encode.
+    - format: String, one of `FORMATS`. Should be the result of `negotiate_format`.
+    """
+    if format == JSON_FORMAT:
+        yield json.dumps(event).encode()
+        return
+
+    import msgpack
+
+    packer = msgpack.Packer()
+    compressor = None
+    flags = 0
+    if format == MSGPACK_ZSTD_FORMAT:
+        import zstandard
+
+        compressor = zstandard.ZstdCompressor().compressobj()
+        flags |= FLAG_ZSTD
+
+    yield MAGIC + bytes([flags])
+
+    def objects() -> Iterator[bytes]:
+        yield packer.pack(event["replication_id"])
+        for record in event["payload"]:
+            yield packer.pack(record)
+
+    pending = 0
+    for chunk in objects():
+        if compressor:
+            pending += len(chunk)
+            chunk = compressor.compress(chunk)
+            # flush complete blocks regularly so the receiver can decode while we send
+            if pending >= FLUSH_SIZE:
+                chunk += compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+                pending = 0
+        if chunk:
+            yield chunk
+
+    if compressor:
+        yield compressor.flush()
+
+
+def dump_replication_event(event: dict[str, Any], format: str) -> bytes:
+    return b"".join(encode_replication_event(event, format))
+
+
+class ReplicationEventDecoder:
+    """
+    Incrementally decodes a replication event encoded by `encode_replication_event`.
+
+    Records of binary streams are returned by `feed` as soon as they are complete.
+    JSON events can only be parsed once complete and are returned by `close`.
+    """
+
+    def __init__(self):
+        self.replication_id: Optional[str] = None
+        self.format: Optional[str] = None
+        self._buffer = b""
+        self._unpacker = None
+        self._decompressor = None
+
+    def feed(self, chunk: bytes) -> list[dict[str, Any]]:
+        if self.format is None:
+            self._buffer += chunk
+            if len(self._buffer) <= len(MAGIC) and MAGIC.startswith(self._buffer):
+                # not enough data to tell the formats apart yet
+                return []
+
+            if not self._buffer.startswith(MAGIC):
+                self.format = JSON_FORMAT
+                return []
+
+            import msgpack
+
+            flags = self._buffer[len(MAGIC)]
+            self.format = MSGPACK_FORMAT
+            if flags & FLAG_ZSTD:
+                import zstandard
+
+                self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+                self.format = MSGPACK_ZSTD_FORMAT
+            self._unpacker = msgpack.Unpacker(raw=False)
+            chunk, self._buffer = self._buffer[len(MAGIC) + 1 :], b""
+
+        if self.format == JSON_FORMAT:
+            self._buffer += chunk
+            return []
+
+        if self._decompressor:
+            chunk = self._decompressor.decompress(chunk)
+        self._unpacker.feed(chunk)  # type: ignore
+
+        records = []
+        for obj in self._unpacker:  # type: ignore
+            if self.replication_id is None:
+                self.replication_id = obj
+            else:
+                records.append(obj)
+        return records
+
+    def close(self) -> list[dict[str, Any]]:
+        if self.format == MSGPACK_FORMAT or self.format == MSGPACK_ZSTD_FORMAT:
+            if self.replication_id is None:
+                raise ValueError("Truncated replication event")
+            return []
+
+        event = json.loads(self._buffer)
+        self._buffer = b""
+        self.format = JSON_FORMAT
+        self.replication_id = event["replication_id"]
+        return event["payload"]
+
+
+def iter_replication_batches(
+    chunks: Iterable[bytes], batch_size: int = DEFAULT_BATCH_SIZE
+) -> Iterator[tuple[str, list[dict[str, Any]]]]:
+    """
+    Decodes a stream of chunks into batches of at most `batch_size` records.
+
+    Yields:
+    - tuple[replication_id, records]
+    """
+    decoder = ReplicationEventDecoder()
+    batch: list[dict[str, Any]] = []
+    for chunk in chunks:
+        batch.extend(decoder.feed(chunk))
+        while len(batch) >= batch_size:
+            yield decoder.replication_id, batch[:batch_size]  # type: ignore
+            batch = batch[batch_size:]
+
+    batch.extend(decoder.close())
+    for i in range(0, len(batch), batch_size):
+        yield decoder.replication_id, batch[i : i + batch_size]  # type: ignore
+
+
+def replicate_batches(
+    batches: Iterable[tuple[str, list[dict[str, Any]]]],
+    replicate: Callable[..., Awaitable[Any]],
+) -> int:
+    """
+    Replicates streamed batches into the local database in a single transaction, so that a
+    stream that breaks partway doesn't leave a partially loaded event behind.
+
+    Parameters:
+    - batches: Iterable[tuple[replication_id, records]], i.e. from `iter_replication_batches`.
+    - replicate: The replication task to load each batch with (`replicate_fixture`).
+
+    Returns:
+    - int, the number of records replicated.
+
+    Raises:
+        Whatever the stream or `replicate` raised, after rolling back the batches loaded so far.
+    """
+    from asgiref.sync import async_to_sync
+    from django.db import transaction
+
+    async def replicate_batch(event: dict[str, Any]) -> None:
+        await replicate(json.dumps(event), None)
+
+    count = 0
+    with transaction.atomic():
+        for replication_id, records in batches:
+            # unlike asyncio.run, async_to_sync runs the task's database work on this thread,
+            # inside the transaction
+            async_to_sync(replicate_batch)({"replication_id": replication_id, "payload": records})
+            count += len(records)
+    return count
+
+
+def iter_ssh_output(ssh_url: str, ssh_port: str, command: str) -> Iterator[bytes]:
+    """
+    Runs a command over SSH and yields its stdout as raw chunks as they arrive.
+
+    Raises:
+        sh.ErrorReturnCode: Once the output is exhausted if the command failed.
+    """
+    from fractal_database import ssh
+
+    chunks: "queue.Queue[Optional[bytes]]" = queue.Queue()
+    errors: list[Exception] = []
+
+    def on_out(chunk: bytes | str) -> None:
+        # sh hands over chunks that happen to be valid utf-8 as str
+        chunks.put(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+
+    process = ssh(
+        ssh_url,
+        "-p",
+        str(ssh_port),
+        command,
+        _out=on_out,
+        _out_bufsize=0,
+        _encoding="utf-8",
+        _bg=True,
+        _bg_exc=False,
+    )
+
+    def wait() -> None:
+        # waiting also drains any output that is still buffered
+        try:
+            process.wait()
+        except Exception as err:
+            errors.append(err)
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=wait, daemon=True).start()
+
+    while (chunk := chunks.get()) is not None:
+        yield chunk
+
+    if errors:
+        raise errors[0]
@@ -1,6 +1,7 @@
 from django.urls import path
-from fractal.gateway.views import WellKnownView
+from fractal.gateway.views import MetricsView, WellKnownView
 
 urlpatterns = [
     path(".well-known/matrix/client", WellKnownView.as_view(), name="well-known-matrix-client"),
+    path("metrics", MetricsView.as_view(), name="metrics"),
 ]
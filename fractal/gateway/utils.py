@@ -1,8 +1,11 @@
+import io
 import logging
 import os
 import re
+import shutil
+import tarfile
 import time
-from typing import Any, Optional
+from typing import Any, Optional, Union
 
 import docker
 import fractal.gateway
@@ -10,11 +13,30 @@ from docker import DockerClient
 from docker.errors import APIError, NotFound
 from docker.models.containers import Container
 from docker.models.networks import Network
+from docker.types import Ulimit
 from fractal.gateway.exceptions import (
     GatewayContainerNotFound,
     GatewayNetworkNotFound,
+    GatewayReloadError,
     PortAlreadyAllocatedError,
 )
+from fractal.gateway.inventory import (
+    GATEWAY_LABEL,
+    GATEWAY_LINK_LABEL,
+    ContainerRecord,
+    get_inventory,
+    wait_for_container,
+)
+from fractal.gateway.networks import (
+    GATEWAY_NETWORK_LABEL,
+    GATEWAY_NETWORK_NAME,
+    connect_gateway,
+    find_network,
+    get_network_shard,
+    get_shard_network,
+)
+from fractal.gateway.proxy import ProxyProfile, get_proxy_profile
+from fractal.gateway.wireguard import generate_keypair
 
 GATEWAY_DOCKERFILE_PATH = "gateway"
 GATEWAY_IMAGE_TAG = "fractalnetworks/fractal-gateway:latest"
@@ -23,6 +45,48 @@ GATEWAY_LINK_IMAGE_TAG = "fractalnetworks/fractal-gateway-link:latest"
 CLIENT_LINK_DOCKERFILE_PATH = "client-link"
 CLIENT_LINK_IMAGE_TAG = "fractalnetworks/client-link:latest"
 
+LINK_FQDN_LABEL = "f.gateway.link.fqdn"
+LINK_TCP_FORWARDING_LABEL = "f.gateway.link.tcp_forwarding"
+LINK_FORWARD_MODE_LABEL = "f.gateway.link.forward_mode"
+# other links served through the link's tunnel by a multi-route client link, comma separated
+LINK_ALIASES_LABEL = "f.gateway.link.aliases"
+
+# how links with TCP forwarding forward their port: "nat" programs DNAT/SNAT rules so the
+# kernel forwards connections, "socat" runs a socat process per connection. Links fall back
+# to socat if the rules can't be programmed.
+FORWARD_MODE = os.environ.get("FRACTAL_GATEWAY_FORWARD_MODE", "nat")
+
+# tunnel MTU of clients that haven't measured their path yet (see client-link/entrypoint.sh)
+DEFAULT_LINK_MTU = 1360
+# bounds of a measured tunnel MTU: IPv6's minimum MTU and WireGuard's default on a 1500 path
+MIN_LINK_MTU = 1280
+MAX_LINK_MTU = 1420
+# the gateway's internal server for well-known documents requested over HTTPS, which link
+# containers relay their clients' requests to (see resources/gateway/http.conf.template)
+GATEWAY_WELL_KNOWN_PORT = 8081
+# where the gateway link container keeps state that outlives it, bind mounted from the
+# link's state directory on the host (see get_link_state_dir)
+LINK_STATE_PATH = "/var/lib/fractal-link"
+# the tunnel MTU the link's client reported, inside of the link's state directory
+LINK_MTU_FILENAME = "client.mtu"
+
+# replaces the link's client peer in place and prints the gateway link's public key.
+# the client key is persisted so the entrypoint restores it if the container restarts
+UPDATE_LINK_PEER_SCRIPT = """
+set -e
+wg set link0 peer "$1" allowed-ips 10.0.0.2/32
+for peer in $(wg show link0 peers); do
+    [ "$peer" = "$1" ] || wg set link0 peer "$peer" remove
+done
+echo "$1" > /etc/wireguard/client.pub
+wg pubkey < /etc/wireguard/link0.key
+"""
+
+# nginx buffers per proxied connection, used to size the gateway
+CONNECTION_MEMORY = 64 * 1024
+MIN_WORKER_CONNECTIONS = 1024
+MAX_WORKER_CONNECTIONS = 65536
+
 logger = logging.getLogger(__name__)
 
 GATEWAY_RESOURCE_PATH = f"{fractal.gateway.__path__[0]}/resources"
@@ -114,11 +178,43 @@ def get_port_from_error(err_msg: str) -> int:
 
 
 def create_gateway_network(client: DockerClient) -> Network:
-    try:
-        network: Network = client.networks.get("fractal-gateway-network")  # type: ignore
-    except NotFound:
-        network: Network = client.networks.create("fractal-gateway-network", driver="bridge")  # type: ignore
-    return network
+    """
+    Returns the gateway's network (the first network shard, see fractal.gateway.networks),
+    creating it if it doesn't exist.
+    """
+    network = find_network(GATEWAY_NETWORK_NAME, client)
+    if not network:
+        network: Network = client.networks.create(  # type: ignore
+            GATEWAY_NETWORK_NAME, driver="bridge", labels={GATEWAY_NETWORK_LABEL: "0"}
+        )
+    return network  # type: ignore
+
+
+def get_gateway_capacity(cpus: int, memory: int) -> dict[str, int]:
+    """
+    Derives nginx's capacity settings from the resources of the Docker host.
+
+    Every proxied connection holds a client and an upstream socket and roughly
+    `CONNECTION_MEMORY` bytes of buffers. A quarter of the host's memory is budgeted for
+    connections and split across one worker per CPU.
+
+    Parameters:
+    - cpus: Int, the number of CPUs of the Docker host.
+    - memory: Int, the total memory of the Docker host in bytes.
+
+    Returns:
+    - Dict, with the keys worker_connections and worker_rlimit_nofile.
+    """
+    cpus = max(cpus, 1)
+    worker_connections = memory // 4 // CONNECTION_MEMORY // cpus
+    worker_connections = min(
+        max(worker_connections, MIN_WORKER_CONNECTIONS), MAX_WORKER_CONNECTIONS
+    )
+    return {
+        "worker_connections": worker_connections,
+        # two sockets per connection plus headroom for logs, upstream zones and listeners
+        "worker_rlimit_nofile": worker_connections * 2 + 1024,
+    }
 
 
 def launch_gateway(container_name: str, labels: Optional[dict[str, Any]] = None) -> Container:
@@ -130,11 +226,14 @@ def launch_gateway(container_name: str, labels: Optional[dict[str, Any]] = None)
         labels = {"f.gateway": container_name}
 
     # get or create gateway network
-    network_name = "fractal-gateway-network"
-    try:
-        network: Network = client.networks.get(network_name)  # type: ignore
-    except NotFound:
-        network: Network = client.networks.create(network_name, driver="bridge")  # type: ignore
+    network = create_gateway_network(client)
+
+    info = client.info()
+    capacity = get_gateway_capacity(info["NCPU"], info["MemTotal"])
+    logger.info(
+        "Sizing gateway for %s CPUs and %s bytes of memory: %s"
+        % (info["NCPU"], info["MemTotal"], capacity)
+    )
 
     try:
         gateway = client.containers.run(
@@ -145,8 +244,21 @@ def launch_gateway(container_name: str, labels: Optional[dict[str, Any]] = None)
             restart_policy={"Name": "always"},
             labels=labels,
             detach=True,
-            environment={"NGINX_ENVSUBST_OUTPUT_DIR": "/etc/nginx"},
+            environment={
+                "NGINX_ENVSUBST_OUTPUT_DIR": "/etc/nginx",
+                "NGINX_WORKER_CONNECTIONS": str(capacity["worker_connections"]),
+                "NGINX_WORKER_RLIMIT_NOFILE": str(capacity["worker_rlimit_nofile"]),
+            },
+            ulimits=[
+                Ulimit(
+                    name="nofile",
+                    soft=capacity["worker_rlimit_nofile"],
+                    hard=capacity["worker_rlimit_nofile"],
+                )
+            ],
         )
+        # the gateway reaches the links on the other network shards through their networks
+        connect_gateway(gateway, client)  # type: ignore
         return gateway  # type: ignore
     except APIError as err:
         container: Container = client.containers.get(container_name)  # type: ignore
@@ -174,40 +286,202 @@ def get_gateway_container(
     Raises:
         GatewayContainerNotFound: If the container with the specified name is not found.
     """
+    inventory = get_inventory()
+    if inventory:
+        records = [record for record in inventory.list(GATEWAY_LABEL) if record.running]
+        if not records:
+            raise GatewayContainerNotFound(name)
+        return inventory.container(records[0])
+
     client = client or docker.from_env()
-    try:
-        return client.containers.list(filters={"label": "f.gateway"})[0]  # type: ignore
-    except NotFound:
+    containers = client.containers.list(filters={"label": GATEWAY_LABEL})
+    if not containers:
         raise GatewayContainerNotFound(name)
+    return containers[0]  # type: ignore
 
 
-def generate_wireguard_keypair(client: Optional[DockerClient] = None) -> tuple[str, str]:
+def write_gateway_file(container: Container, path: str, content: str) -> None:
+    """
+    Writes a file into a running container with a single archive upload.
+
+    Parameters:
+    - container: Container, the container to write the file into.
+    - path: String, the absolute path of the file inside of the container. The parent
+        directory must already exist.
+    - content: String, the content of the file.
+    """
+    data = content.encode()
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        info = tarfile.TarInfo(name=os.path.basename(path))
+        info.size = len(data)
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+
+    container.put_archive(os.path.dirname(path), archive.getvalue())
+
+
+def reload_gateway(container: Container) -> None:
+    """
+    Validates the gateway's nginx configuration and gracefully reloads it.
+
+    Raises:
+        GatewayReloadError: If the configuration is invalid. The running configuration is kept.
     """
-    Generate a WireGuard keypair.
+    result = container.exec_run(["sh", "-c", "nginx -t && nginx -s reload"])
+    if result.exit_code != 0:
+        raise GatewayReloadError(result.output.decode())
 
-    TODO: Handle generating WireGuard keypairs locally if the environment has WireGuard installed.
+
+def generate_wireguard_keypair(client: Optional[DockerClient] = None) -> tuple[str, str]:
+    """
+    Generate a WireGuard keypair. Keys are generated in-process (see fractal.gateway.wireguard),
+    neither WireGuard nor a container is needed.
 
     Parameters:
-    - client: DockerClient, the Docker client to use for the operation. If not provided, will
-        use the default Docker client.
+    - client: DockerClient, unused. Kept for compatibility with callers that pass one.
 
     Returns:
     - tuple[private_key, public_key], a tuple containing the generated private and public keys.
     """
-    client = client or docker.from_env()
-    command = "bash -c 'privkey=$(wg genkey); echo $privkey; echo $privkey|wg pubkey'"
+    return generate_keypair()
+
+
+def get_link_container_name(link_fqdn: str) -> str:
+    """
+    Returns the name of the gateway link container for a link. The gateway routes traffic
+    for the link's fqdn to this name.
+    """
+    link_container_name = "-".join(link_fqdn.split(".")[-4:])
+    if link_container_name.startswith("-"):
+        link_container_name = link_container_name[1:]
+    return link_container_name
+
+
+def find_container(name: str, client: DockerClient) -> Optional[ContainerRecord]:
+    inventory = get_inventory()
+    if inventory:
+        return inventory.get(name)
+
+    try:
+        return ContainerRecord.from_inspect(client.containers.get(name).attrs)  # type: ignore
+    except NotFound:
+        return None
+
+
+def get_link_aliases(record: ContainerRecord) -> list[str]:
+    """
+    Returns the FQDNs of the other links a link container serves.
+    """
+    aliases = record.labels.get(LINK_ALIASES_LABEL, "")
+    return [alias for alias in aliases.split(",") if alias]
+
+
+def get_link_up_command(
+    gateway_id: str,
+    link_fqdn: str,
+    tcp_forwarding: bool = False,
+    forward_port: Optional[str] = None,
+    aliases: Optional[list[str]] = None,
+) -> str:
+    """
+    Returns the `fractal link up` command line that brings a link up on a gateway device over
+    SSH.
+    """
+    command = f"fractal link up {gateway_id} {link_fqdn}"
+    if tcp_forwarding:
+        command += " --tcp-forwarding"
+    if forward_port:
+        command += f" --forward-port {forward_port}"
+    if aliases:
+        command += f" --aliases {','.join(aliases)}"
+    return command
+
+
+def get_link_down_command(link_fqdns: list[str]) -> str:
+    """
+    Returns the `fractal link down` command line that takes links down on a gateway device
+    over SSH.
+    """
+    return f"fractal link down --link-fqdns {','.join(link_fqdns)}"
+
+
+def get_link_state_dir(link_fqdn: str) -> str:
+    """
+    Returns the host directory that is bind mounted into a link's containers (and its
+    replacements) at `LINK_STATE_PATH`.
+    """
+    from fractal.cli.utils import data_dir
+
+    return os.path.join(data_dir, "links", get_link_container_name(link_fqdn))
+
+
+def remove_link_state(link_fqdn: str) -> None:
+    shutil.rmtree(get_link_state_dir(link_fqdn), ignore_errors=True)
+
+
+def read_link_mtu(link_fqdn: str) -> Optional[int]:
+    """
+    Returns the tunnel MTU the link's client measured and reported to its gateway link
+    container, None if its client didn't report one. Read from the link's state directory,
+    so it doesn't need the container.
+    """
+    try:
+        with open(os.path.join(get_link_state_dir(link_fqdn), LINK_MTU_FILENAME)) as file:
+            mtu = int(file.read().strip())
+    except (OSError, ValueError):
+        return None
+    return mtu if MIN_LINK_MTU <= mtu <= MAX_LINK_MTU else None
+
 
-    keypair: bytes = client.containers.run(
-        image=GATEWAY_LINK_IMAGE_TAG,
-        entrypoint=command,
-        stdout=True,
-        stderr=True,
-        remove=True,
-        detach=False,
-    )  # type: ignore
+def _reuse_link_container(
+    record: ContainerRecord,
+    link_fqdn: str,
+    link_pubkey: str,
+    tcp_forwarding: bool,
+    forward_port: Optional[str],
+    client: DockerClient,
+    aliases: list[str],
+) -> Optional[tuple[str, str, str]]:
+    """
+    Points a running link container at a new client public key without recreating it.
+
+    Returns:
+    - Optional[tuple[wireguard_pubkey, link_address, forward_port]], None if the container
+        has to be recreated because it isn't running or its image or port layout differs.
+    """
+    if not record.running:
+        return None
+
+    if record.labels.get(LINK_TCP_FORWARDING_LABEL) != str(tcp_forwarding).lower():
+        return None
+    if tcp_forwarding and record.labels.get(LINK_FORWARD_MODE_LABEL) != FORWARD_MODE:
+        return None
+    if get_link_aliases(record) != aliases:
+        return None
+
+    if record.image_id != client.images.get(GATEWAY_LINK_IMAGE_TAG).id:
+        return None
+
+    wireguard_port = record.host_port("18521/udp")
+    current_forward_port = record.host_port("5555/tcp")
+    if not wireguard_port or not current_forward_port:
+        return None
+    if forward_port and str(forward_port) != current_forward_port:
+        return None
+
+    container: Container = client.containers.prepare_model(record.attrs)  # type: ignore
+    result = container.exec_run(["sh", "-c", UPDATE_LINK_PEER_SCRIPT, "sh", link_pubkey])
+    if result.exit_code != 0:
+        logger.warning(
+            "Failed to update peer of link container %s: %s"
+            % (record.name, result.output.decode())
+        )
+        return None
 
-    private_key, public_key = keypair.decode().strip().split("\n")
-    return private_key, public_key
+    wireguard_pubkey = result.output.decode().strip()
+    return wireguard_pubkey, f"{link_fqdn}:{wireguard_port}", current_forward_port
 
 
 def launch_link(
@@ -216,41 +490,73 @@ def launch_link(
     tcp_forwarding: bool = False,
     client: Optional[DockerClient] = None,
     forward_port: Optional[str] = None,
+    aliases: Optional[list[str]] = None,
 ) -> tuple[str, str, str]:
     """
-    Launches a link container with the specified FQDN and public key.
+    Launches a link container with the specified FQDN and public key. A running link container
+    whose image and port layout match is reused, only its WireGuard peer is replaced.
+
+    Parameters:
+    - aliases: Optional[list[str]], the FQDNs of other links the gateway routes to this
+        container, for clients that serve several links through one tunnel.
 
     Returns:
     - tuple[wireguard_pubkey, link_address], a tuple containing the generated WireGuard public key and the link's address.
     """
     client = client or docker.from_env()
+    aliases = sorted(set(aliases or []) - {link_fqdn})
     build_gateway_containers()
 
-    # get or create gateway network
-    try:
-        network: Network = client.networks.get("fractal-gateway-network")  # type: ignore
-    except NotFound:
-        raise GatewayNetworkNotFound("fractal-gateway-network")
-
-    link_container_name = "-".join(link_fqdn.split(".")[-4:])
-    if link_container_name.startswith("-"):
-        link_container_name = link_container_name[1:]
+    # the link's network shard, shard 0 comes with the gateway
+    if not find_network(GATEWAY_NETWORK_NAME, client):
+        raise GatewayNetworkNotFound(GATEWAY_NETWORK_NAME)
+    network: Network = get_shard_network(get_network_shard(link_fqdn), client)  # type: ignore
+    # the link relays well-known requests to the gateway by name, on any network shard
+    gateway_name = get_gateway_container(client=client).name
+
+    from fractal.gateway.replacement import (
+        can_replace,
+        discard_replacement,
+        get_replacement_name,
+        start_replacement_watch,
+    )
+
+    link_container_name = get_link_container_name(link_fqdn)
+    # a replacement left over from a previous launch is superseded by this one
+    discard_replacement(link_fqdn, client)
+
+    inventory = get_inventory()
+    replacing = False
+    existing = find_container(link_container_name, client)
+    if existing:
+        # fast path: keep the running container (and the tunnel) if nothing but the client key changed
+        reused = _reuse_link_container(
+            existing, link_fqdn, link_pubkey, tcp_forwarding, forward_port, client, aliases
+        )
+        if reused:
+            logger.info("Reusing running gateway link container %s" % link_container_name)
+            return reused
+
+        if can_replace(existing, tcp_forwarding, forward_port):
+            # blue/green: the old container keeps serving until the client moved over
+            replacing = True
+            if not tcp_forwarding and str(forward_port) == existing.host_port("5555/tcp"):
+                forward_port = None
+        else:
+            link_container: Container = client.containers.prepare_model(existing.attrs)  # type: ignore
+            link_container.stop()
+            link_container.remove()
 
-    try:
-        link_container: Container = client.containers.get(link_container_name)  # type: ignore
-        link_container.stop()
-        link_container.remove()
-    except NotFound:
-        pass
+    launch_name = get_replacement_name(link_fqdn) if replacing else link_container_name
 
     try:
         link_container: Container = client.containers.run(
             image=GATEWAY_LINK_IMAGE_TAG,
-            name=link_container_name,
+            name=launch_name,
             network=network.name,
             restart_policy={"Name": "unless-stopped"},
             cap_add=["NET_ADMIN"],
-            labels={"f.gateway.link": "true"},
+            labels={GATEWAY_LINK_LABEL: "true"},
             tty=True,
             detach=True,
             environment={
@@ -260,7 +566,7 @@ def launch_link(
             remove=False,
         )  # type: ignore
     except APIError as err:
-        container: Container = client.containers.get(link_container_name)  # type: ignore
+        container: Container = client.containers.get(launch_name)  # type: ignore
         container.remove()
         port_number = get_port_from_error(err.explanation)  # type: ignore
         if port_number:
@@ -268,147 +574,212 @@ def launch_link(
         raise err
 
     # get port that was assigned by docker
-    # FIXME: have to sleep a second to allow the port to be assigned for some reason
-    time.sleep(1)
-    link_container.reload()
-    wireguard_port = link_container.attrs["NetworkSettings"]["Ports"]["18521/udp"][0]["HostPort"]  # type: ignore
-    if not forward_port:
-        forward_port: str = link_container.attrs["NetworkSettings"]["Ports"]["18531/udp"][0]["HostPort"]  # type: ignore
+    record = None
+    if inventory:
+        record = inventory.wait_for(
+            launch_name,
+            lambda record: record.id == link_container.id
+            and bool(record.host_port("18521/udp"))
+            and bool(record.host_port("18531/udp")),
+            timeout=5,
+        )
+    if record:
+        wireguard_port = record.host_port("18521/udp")
+        if not forward_port:
+            forward_port = record.host_port("18531/udp")
+    else:
+        # FIXME: have to sleep a second to allow the port to be assigned for some reason
+        time.sleep(1)
+        link_container.reload()
+        wireguard_port = link_container.attrs["NetworkSettings"]["Ports"]["18521/udp"][0]["HostPort"]  # type: ignore
+        if not forward_port:
+            forward_port: str = link_container.attrs["NetworkSettings"]["Ports"]["18531/udp"][0]["HostPort"]  # type: ignore
 
     link_container.stop()
     link_container.remove()
 
-    # launch link container but with the port that was assigned by docker
+    # launch link container but with the port that was assigned by docker. The link's own
+    # keypair is generated here so that its public key is known without asking the container
+    wireguard_privkey, wireguard_pubkey = generate_keypair()
+    # keeps the MTU the client reported across container restarts and recreations
+    state_dir = get_link_state_dir(link_fqdn)
+    os.makedirs(state_dir, exist_ok=True)
     environment = {
         "LINK_CLIENT_WG_PUBKEY": link_pubkey,
+        "LINK_WG_PRIVKEY": wireguard_privkey,
+        "GATEWAY_WELL_KNOWN_ADDRESS": f"{gateway_name}:{GATEWAY_WELL_KNOWN_PORT}",
     }
     if tcp_forwarding:
         environment["CENTER_PORT"] = str(5555)
         environment["FORWARD_PORT"] = "true"
+        environment["FORWARD_MODE"] = FORWARD_MODE
     try:
         link_container: Container = client.containers.run(
             image=GATEWAY_LINK_IMAGE_TAG,
-            name=link_container_name,
+            name=launch_name,
             network=network.name,
             restart_policy={"Name": "unless-stopped"},
             cap_add=["NET_ADMIN"],
-            labels={"f.gateway.link": "true"},
+            labels={
+                GATEWAY_LINK_LABEL: "true",
+                LINK_FQDN_LABEL: link_fqdn,
+                LINK_TCP_FORWARDING_LABEL: str(tcp_forwarding).lower(),
+                LINK_FORWARD_MODE_LABEL: FORWARD_MODE,
+                LINK_ALIASES_LABEL: ",".join(aliases),
+            },
             tty=True,
             detach=True,
             environment=environment,
+            volumes={state_dir: {"bind": LINK_STATE_PATH, "mode": "rw"}},
             command=[forward_port, "abc", "5555"] if tcp_forwarding else None,
             ports={"18521/udp": int(wireguard_port), "5555/tcp": forward_port},
             remove=False,
         )  # type: ignore
     except APIError as err:
-        container: Container = client.containers.get(link_container_name)  # type: ignore
+        container: Container = client.containers.get(launch_name)  # type: ignore
         container.remove()
         port_number = get_port_from_error(err.explanation)  # type: ignore
         if port_number:
             raise PortAlreadyAllocatedError(port_number)
         raise err
 
-    logger.info("Successfully launched gateway link container %s" % link_container_name)
+    logger.info("Successfully launched gateway link container %s" % launch_name)
+
+    if replacing:
+        # routes move to the replacement once the client's handshake shows up on it
+        start_replacement_watch(link_fqdn, client)
+        return wireguard_pubkey, f"{link_fqdn}:{wireguard_port}", forward_port
+
+    # give the new container a keepalive upstream on the gateway, the gateway falls back to
+    # resolving the container by name until the routes are published
+    from fractal.gateway.routes import sync_link_routes
+
+    # the routes are collected from the inventory, which learns about the container from an
+    # event and would publish the aliases without it
+    wait_for_container(launch_name, link_container.id)  # type: ignore
+    try:
+        sync_link_routes(client)
+    except Exception as err:
+        logger.warning("Failed to publish link routes to the gateway: %s" % err)
 
-    # get generated wireguard pubkey from link container
-    command = "bash -c 'cat /etc/wireguard/link0.key | wg pubkey'"
-    wireguard_pubkey = link_container.exec_run(command).output.decode().strip()
     return wireguard_pubkey, f"{link_fqdn}:{wireguard_port}", forward_port
 
 
-def generate_link_compose_snippet(
+def build_link_service(
     link_config: dict[str, Any],
     link_fqdn: str,
     expose: str,
     new_forwarding: bool = False,
-) -> str:
+    profile: Union[str, ProxyProfile, None] = None,
+    routes: Optional[dict[str, str]] = None,
+    volume: str = "link-data",
+) -> dict[str, Any]:
     """
-    Generate a docker-compose snippet for a link container using the specified link configuration.
+    Builds the docker-compose service definition of a client link container.
 
     Parameters:
-    - link_config: Dict, the link configuration to use for the snippet. Should contain the following keys:
+    - link_config: Dict, the link configuration to use for the service. Should contain the following keys:
         - gateway_link_public_key: String, the WireGuard public key for the link.
         - link_address: String, the address for the link (i.e. subdomain.mydomain.com:18521).
         - client_private_key: String, the WireGuard private key for the client.
+        - tunnel_address: Optional[String], the client's address inside of the tunnel when
+            the link is hosted by the link hub.
+        - mtu: Optional[Int], the tunnel MTU the client measured for a previous deployment.
+    - new_forwarding: Bool, forward TCP and UDP to `expose` instead of proxying HTTP with Caddy.
+    - profile: Optional[Union[str, ProxyProfile]], the performance profile of the link's Caddy
+        proxy, or its name (see fractal.gateway.proxy). Ignored for forward only links.
+    - routes: Optional[dict[str, str]], the FQDNs and exposed services of other links the link
+        service serves through the same tunnel (the gateway link must have them as aliases).
+    - volume: String, the named volume that keeps Caddy's certificates.
 
     Returns:
-    - str, the docker-compose YAML snippet for the link container.
+    - Dict, the service definition.
     """
+    if routes and new_forwarding:
+        raise ValueError("Links with TCP or UDP forwarding can't serve other links")
+
+    gateway_address = "10.0.0.1"
+    # compose reads environment values as strings, they are kept as strings so that YAML
+    # doesn't turn values like "off" into booleans
+    environment = {
+        "LINK_DOMAIN": link_fqdn,
+        "EXPOSE": expose,
+        "GATEWAY_CLIENT_WG_PRIVKEY": link_config["client_private_key"],
+        "GATEWAY_LINK_WG_PUBKEY": link_config["gateway_link_public_key"],
+        "GATEWAY_ENDPOINT": link_config["link_address"],
+    }
     if new_forwarding:
-        return f"""
-  link:
-    image: {CLIENT_LINK_IMAGE_TAG}
-    environment:
-      LINK_DOMAIN: {link_fqdn}
-      EXPOSE: {expose}
-      GATEWAY_CLIENT_WG_PRIVKEY: {link_config['client_private_key']}
-      GATEWAY_LINK_WG_PUBKEY: {link_config['gateway_link_public_key']}
-      GATEWAY_ENDPOINT: {link_config['link_address']}
-      TLS_INTERNAL: true
-      FORWARD_ONLY: true
-      NEW_FORWARDING_BEHAVIOR: true
-      CENTER_PORT: 5555
-      LINK_MTU: 1360
-    cap_add:
-      - NET_ADMIN
-    healthcheck:
-      test: "ping -c 5 10.0.0.1"
-      interval: 10s
-      timeout: 7s
-      retries: 5
-    restart: unless-stopped
-    extra_hosts:
-        host.docker.internal: host-gateway
-    volumes:
-      - link-data:/data
-"""
+        environment.update(
+            {
+                "TLS_INTERNAL": "true",
+                "FORWARD_ONLY": "true",
+                "NEW_FORWARDING_BEHAVIOR": "true",
+                "CENTER_PORT": "5555",
+                "FORWARD_MODE": FORWARD_MODE,
+            }
+        )
+    elif "localhost" in link_fqdn:
+        environment["TLS_INTERNAL"] = "true"
+    environment["LINK_MTU"] = str(link_config.get("mtu") or DEFAULT_LINK_MTU)
+
+    if link_config.get("tunnel_address"):
+        from fractal.gateway.hub import LINK_HUB_ADDRESS
+
+        gateway_address = LINK_HUB_ADDRESS
+        environment["LINK_ADDRESS"] = link_config["tunnel_address"]
+        environment["GATEWAY_LINK_ADDRESS"] = gateway_address
+
+    if not new_forwarding:
+        environment.update(get_proxy_profile(profile).to_environment())
+        if not link_config.get("tunnel_address"):
+            # HTTPS well-known requests are relayed to the gateway by the gateway link
+            # container, the link hub doesn't relay them
+            environment["GATEWAY_WELL_KNOWN"] = "true"
+        if routes:
+            environment["LINK_ROUTES"] = ",".join(
+                f"{fqdn}={route_expose}" for fqdn, route_expose in sorted(routes.items())
+            )
+
+    return {
+        "image": CLIENT_LINK_IMAGE_TAG,
+        "environment": environment,
+        "cap_add": ["NET_ADMIN"],
+        "healthcheck": {
+            "test": f"ping -c 5 {gateway_address}",
+            "interval": "10s",
+            "timeout": "7s",
+            "retries": 5,
+        },
+        "restart": "unless-stopped",
+        "extra_hosts": {"host.docker.internal": "host-gateway"},
+        "volumes": [f"{volume}:/data"],
+    }
 
-    if "localhost" in link_fqdn:
-        return f"""
-  link:
-    image: {CLIENT_LINK_IMAGE_TAG}
-    environment:
-      LINK_DOMAIN: {link_fqdn}
-      EXPOSE: {expose}
-      GATEWAY_CLIENT_WG_PRIVKEY: {link_config['client_private_key']}
-      GATEWAY_LINK_WG_PUBKEY: {link_config['gateway_link_public_key']}
-      GATEWAY_ENDPOINT: {link_config['link_address']}
-      TLS_INTERNAL: true
-      LINK_MTU: 1360
-    healthcheck:
-      test: "ping -c 5 10.0.0.1"
-      interval: 10s
-      timeout: 7s
-      retries: 5
-    cap_add:
-      - NET_ADMIN
-    restart: unless-stopped
-    extra_hosts:
-        host.docker.internal: host-gateway
-    volumes:
-      - link-data:/data
-"""
 
-    return f"""
-  link:
-    image: {CLIENT_LINK_IMAGE_TAG}
-    environment:
-      LINK_DOMAIN: {link_fqdn}
-      EXPOSE: {expose}
-      GATEWAY_CLIENT_WG_PRIVKEY: {link_config['client_private_key']}
-      GATEWAY_LINK_WG_PUBKEY: {link_config['gateway_link_public_key']}
-      GATEWAY_ENDPOINT: {link_config['link_address']}
-      LINK_MTU: 1360
-    cap_add:
-      - NET_ADMIN
-    healthcheck:
-      test: "ping -c 5 10.0.0.1"
-      interval: 10s
-      timeout: 7s
-      retries: 5
-    restart: unless-stopped
-    volumes:
-      - link-data:/data
-    extra_hosts:
-        host.docker.internal: host-gateway
-"""
+def dump_compose(document: dict[str, Any]) -> str:
+    import yaml
+
+    return yaml.safe_dump(document, sort_keys=False, default_flow_style=False)
+
+
+def generate_link_compose_snippet(
+    link_config: dict[str, Any],
+    link_fqdn: str,
+    expose: str,
+    new_forwarding: bool = False,
+    profile: Union[str, ProxyProfile, None] = None,
+    routes: Optional[dict[str, str]] = None,
+) -> str:
+    """
+    Generate a docker-compose snippet for a link container using the specified link
+    configuration (see `build_link_service` for the parameters).
+
+    Returns:
+    - str, the docker-compose YAML snippet for the link container, indented to be placed
+        under an app's services.
+    """
+    service = build_link_service(
+        link_config, link_fqdn, expose, new_forwarding=new_forwarding, profile=profile, routes=routes
+    )
+    snippet = dump_compose({"link": service})
+    return "\n" + "".join(f"  {line}" for line in snippet.splitlines(keepends=True))
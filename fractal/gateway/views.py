@@ -1,9 +1,13 @@
+import hmac
 import logging
-from typing import Optional
+import os
 
-import requests
+from django.http import HttpResponse
+from fractal.gateway.link_metrics import load_collector, render_metrics
+from fractal.gateway.well_known import resolve_well_known
 from fractal_database_matrix.models import MatrixHomeserver
 from rest_framework import status
+from rest_framework.permissions import BasePermission
 from rest_framework.request import Request
 from rest_framework.response import Response
 from rest_framework.views import APIView
@@ -12,28 +16,18 @@ from rest_framework.views import APIView
 logger = logging.getLogger("django")
 # logger = logging.getLogger(__name__)
 
-WELL_KNOWN_ENDPOINT = ".well-known/matrix/client"
-
 
 class WellKnownView(APIView):
-    def _get_well_known(self, homeserver_url: str) -> Optional[str]:
-        """
-        FIXME: this is blocking for now
-        """
-        logger.info(f"Making request to {homeserver_url}")
-        try:
-            resp = requests.get(f"{homeserver_url}/{WELL_KNOWN_ENDPOINT}")
-            if resp.ok:
-                return resp.json()["m.homeserver"]["base_url"]
-        except:
-            return None
-
     def get(self, request: Request):
         """
         Returns the first available well-known from the configured homeservers
         for the current Database's primary Gateway.
 
         If no well-known is found, 404 is returned.
+
+        NOTE: When `fractal gateway well_known` is running on the Gateway, these
+        responses are served directly by the gateway's nginx.
+        FIXME: this is blocking for now
         """
         # get the hostname from the request
         hostname = request.get_host().split(":")[0]
@@ -42,32 +36,46 @@ class WellKnownView(APIView):
             return Response(
                 {"err": f"Homeserver {hostname} not found"}, status=status.HTTP_404_NOT_FOUND
             )
-        primary_homeserver = homeservers[0]
-        homeserver_priority = primary_homeserver.priority
-
-        # which homeserver to use? use the host in the request then find
-        # make request to the current Gateway's primary homeserver
-        base_url = self._get_well_known(primary_homeserver.url)
-
-        # if the primary homeserver is unavailable, attempt to find a well-known
-        # from all other configured homeservres on the gateway
-        if not base_url:
-            logger.info(f"Primary homeserver {primary_homeserver.url} is unavailable")
-
-            homeservers = homeservers.exclude(url=primary_homeserver.url)
-            for homeserver in homeservers:
-                base_url = self._get_well_known(homeserver.url)
-                if base_url:
-                    homeserver_priority = homeserver.priority
-                    break
-
-            if not base_url:
-                return Response({}, status=status.HTTP_404_NOT_FOUND)
-
-        return Response(
-            {
-                "m.homeserver": {"base_url": base_url},
-                "f.homeserver.priority": homeserver_priority,
-            },
-            status=status.HTTP_200_OK,
+
+        # make request to the primary homeserver, falling back to the
+        # other configured homeservers by priority
+        well_known = resolve_well_known(homeservers)
+        if not well_known:
+            return Response({}, status=status.HTTP_404_NOT_FOUND)
+
+        return Response(well_known, status=status.HTTP_200_OK)
+
+
+class MetricsPermission(BasePermission):
+    """
+    The metrics name every link and its traffic, so they're only served to authenticated
+    users, to scrapers presenting `FRACTAL_GATEWAY_METRICS_TOKEN` as a bearer token and to
+    requests from this host. Requests proxied in by a link come from the link's proxy, not
+    from localhost.
+    """
+
+    LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
+
+    def has_permission(self, request, view) -> bool:
+        if request.user and request.user.is_authenticated:
+            return True
+
+        token = os.environ.get("FRACTAL_GATEWAY_METRICS_TOKEN")
+        authorization = request.META.get("HTTP_AUTHORIZATION", "")
+        if token and hmac.compare_digest(authorization, f"Bearer {token}"):
+            return True
+
+        return request.META.get("REMOTE_ADDR") in self.LOCAL_ADDRESSES
+
+
+class MetricsView(APIView):
+    permission_classes = [MetricsPermission]
+
+    def get(self, request: Request):
+        """
+        Returns the per-link WireGuard metrics sampled by `fractal link metrics --watch`
+        in the Prometheus text format.
+        """
+        return HttpResponse(
+            render_metrics(load_collector()), content_type="text/plain; version=0.0.4"
         )
@@ -0,0 +1,155 @@
+import json
+import logging
+import time
+from typing import TYPE_CHECKING, Iterable, Optional
+from urllib.parse import urlparse
+
+import requests
+
+if TYPE_CHECKING:
+    from docker import DockerClient
+    from fractal_database_matrix.models import MatrixHomeserver
+
+logger = logging.getLogger(__name__)
+
+# probed to tell whether a homeserver is up. Not its well-known: for homeservers behind the
+# gateway, the gateway answers that itself from the documents published here
+HEALTH_ENDPOINT = "_matrix/client/versions"
+WELL_KNOWN_MAP_PATH = "/etc/nginx/well-known/matrix-client.map"
+WELL_KNOWN_TIMEOUT = 5
+
+
+def probe_homeserver(homeserver_url: str) -> Optional[str]:
+    """
+    Checks that a homeserver answers the client API.
+
+    Returns:
+    - Optional[str], the homeserver's base url or None if the homeserver is unavailable.
+    """
+    base_url = homeserver_url.rstrip("/")
+    logger.info(f"Making request to {base_url}")
+    try:
+        resp = requests.get(f"{base_url}/{HEALTH_ENDPOINT}", timeout=WELL_KNOWN_TIMEOUT)
+        if resp.ok and "versions" in resp.json():
+            return base_url
+    except Exception:
+        return None
+    return None
+
+
+def resolve_well_known(homeservers: Iterable["MatrixHomeserver"]) -> Optional[dict]:
+    """
+    Returns the well-known document of the first available homeserver.
+
+    Parameters:
+    - homeservers: Iterable[MatrixHomeserver], the homeservers to try ordered by priority.
+
+    Returns:
+    - Optional[dict], the well-known document or None if no homeserver is available.
+    """
+    for homeserver in homeservers:
+        base_url = probe_homeserver(homeserver.url)
+        if base_url:
+            return {
+                "m.homeserver": {"base_url": base_url},
+                "f.homeserver.priority": homeserver.priority,
+            }
+        logger.info(f"Homeserver {homeserver.url} is unavailable")
+    return None
+
+
+def build_well_known_documents(homeservers: Iterable["MatrixHomeserver"]) -> dict[str, dict]:
+    """
+    Computes the well-known document for every hostname of `homeservers`, from the
+    homeservers whose url contains it (like `WellKnownView` picks them).
+
+    Hostnames whose homeservers are all unavailable are left out so that the gateway
+    falls back to the `WellKnownView` for them.
+    """
+    # homeservers without a priority come last
+    homeservers = sorted(
+        homeservers,
+        key=lambda homeserver: (homeserver.priority is None, homeserver.priority or 0),
+    )
+    hostnames = {urlparse(homeserver.url).hostname for homeserver in homeservers}
+
+    documents = {}
+    for hostname in sorted(filter(None, hostnames)):
+        document = resolve_well_known(
+            homeserver for homeserver in homeservers if hostname in homeserver.url
+        )
+        if document:
+            documents[hostname] = document
+    return documents
+
+
+def collect_well_known_documents() -> dict[str, dict]:
+    """
+    Computes the well-known documents of the configured homeservers.
+    """
+    from fractal_database_matrix.models import MatrixHomeserver
+
+    return build_well_known_documents(MatrixHomeserver.objects.all())
+
+
+def _nginx_quote(value: str) -> str:
+    # `$` would be interpreted as a variable by nginx, JSON allows it to be escaped instead
+    value = value.replace("$", "\\u0024")
+    return "'%s'" % value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def render_well_known_map(documents: dict[str, dict]) -> str:
+    """
+    Renders well-known documents as entries of the gateway's `$well_known_matrix_client` map.
+    """
+    lines = ["# generated by fractal gateway, do not edit"]
+    for hostname, document in sorted(documents.items()):
+        body = json.dumps(document, separators=(",", ":"))
+        lines.append(f"{hostname} {_nginx_quote(body)};")
+    return "\n".join(lines) + "\n"
+
+
+def publish_well_known(rendered: str, client: Optional["DockerClient"] = None) -> None:
+    """
+    Writes a rendered well-known map into the gateway container and reloads nginx.
+    """
+    from fractal.gateway.utils import (
+        get_gateway_container,
+        reload_gateway,
+        write_gateway_file,
+    )
+
+    container = get_gateway_container(client=client)
+    write_gateway_file(container, WELL_KNOWN_MAP_PATH, rendered)
+    reload_gateway(container)
+
+
+def refresh_well_known(
+    previous: Optional[str] = None, client: Optional["DockerClient"] = None
+) -> str:
+    """
+    Recomputes the well-known documents and publishes them to the gateway if they changed
+    since the `previous` render.
+
+    Returns:
+    - str, the current render.
+    """
+    rendered = render_well_known_map(collect_well_known_documents())
+    if rendered != previous:
+        logger.info("Well-known documents changed, publishing to gateway")
+        publish_well_known(rendered, client=client)
+    return rendered
+
+
+def watch_well_known(interval: int, client: Optional["DockerClient"] = None) -> None:
+    """
+    Keeps the gateway's pre-rendered well-known documents up to date, picking up
+    homeserver priority and health changes every `interval` seconds.
+    """
+    rendered = None
+    while True:
+        try:
+            rendered = refresh_well_known(rendered, client=client)
+        except Exception as err:
+            logger.error("Failed to refresh well-known documents: %s" % err)
+        time.sleep(interval)
@@ -0,0 +1,41 @@
+"""
+WireGuard key generation without WireGuard tools or containers.
+
+WireGuard keys are X25519 keys, encoded in base64. They are generated with `cryptography`.
+"""
+
+import base64
+
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+    PublicFormat,
+)
+
+
+def public_key(private_key: str) -> str:
+    """
+    Returns the public key of a base64 encoded private key, like `wg pubkey`.
+    """
+    key = X25519PrivateKey.from_private_bytes(base64.b64decode(private_key))
+    return base64.b64encode(key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)).decode()
+
+
+def generate_private_key() -> str:
+    """
+    Returns a new base64 encoded private key, like `wg genkey`.
+    """
+    key = X25519PrivateKey.generate()
+    raw = key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+    return base64.b64encode(raw).decode()
+
+
+def generate_keypair() -> tuple[str, str]:
+    """
+    Returns:
+    - tuple[private_key, public_key], base64 encoded.
+    """
+    private_key = generate_private_key()
+    return private_key, public_key(private_key)